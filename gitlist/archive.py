@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+
+from django.conf import settings
+
+from .cache import get_cache_path, iter_write_through, touch_file, prune_files
+from .instrumentation import instrumented
+
+ARCHIVE_CACHE_SIZE = getattr(settings, 'GITLIST_ARCHIVE_CACHE_SIZE', 1024 * 1024 * 1024)
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+
+def get_archive_path(repository, sha, format):
+    # Keyed by commit rather than tree: git archive writes the commit id
+    # (and uses the commit time for the files) in the archive.
+    return get_cache_path(repository, 'archives', '%s.%s' % (sha, format))
+
+
+def get_cached_archive(repository, sha, format):
+    """
+    Returns the path of the cached archive of commit sha in the given
+    format, or None if it isn't cached. Hits are touched so eviction is LRU.
+    """
+    return touch_file(get_archive_path(repository, sha, format))
+
+
+def prune_archives(max_size=ARCHIVE_CACHE_SIZE):
+    """
+    Removes the least recently used archives (of all repositories) until
+    the cached archives take at most max_size bytes.
+    """
+    prune_files(os.path.join('*', 'archives', '*'), max_size)
+
+
+def _iter_archive(proc):
+    for chunk in iter(lambda: proc.stdout.read(ARCHIVE_CHUNK_SIZE), b''):
+        yield chunk
+    proc.wait()
+
+
+@instrumented('archive')
+def stream_archive(repository, sha, format):
+    """
+    Yields the archive of commit sha straight from the ``git archive`` pipe,
+    so memory use is bounded regardless of the archive size. The archive is
+    written to the cache as it goes and only made visible there once it's
+    complete.
+    """
+    proc = repository.git.archive(sha, format=format, as_process=True)
+    path = get_archive_path(repository, sha, format)
+    for chunk in iter_write_through(path, _iter_archive(proc)):
+        yield chunk
+    prune_archives()
+
+
+def build_archive(repository, sha, format):
+    """
+    Writes the archive of commit sha to the cache (for background jobs).
+    """
+    for _ in stream_archive(repository, sha, format):
+        pass
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+import time
+import random
+import resource
+import traceback
+import subprocess
+from contextlib import contextmanager
+
+import git
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.test import Client
+from django.utils.encoding import force_bytes
+
+from . import urls
+
+BASE_TIMESTAMP = 1400000000
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit',
+         'sed', 'do', 'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore')
+
+
+class RepositoryGenerator(object):
+    """
+    Generates a reproducible repository of the given shape with a single
+    ``git fast-import``: the same arguments always give the same shas.
+    """
+    def __init__(self, commits=500, files=200, depth=3, tags=20, blob_size=2048, merges=5, merge_width=3, seed=0):
+        self.commits = commits
+        self.files = files
+        self.depth = depth
+        self.tags = tags
+        self.blob_size = blob_size
+        self.merges = merges
+        self.merge_width = merge_width
+        self.random = random.Random(seed)
+        self.mark = 0
+        self.timestamp = BASE_TIMESTAMP
+        self.paths = self._make_paths()
+
+    def _make_paths(self):
+        paths = []
+        for i in range(self.files):
+            dirs = ['dir%d' % self.random.randrange(4) for _ in range(self.random.randint(0, self.depth))]
+            paths.append('/'.join(dirs + ['file%d.txt' % i]))
+        return paths
+
+    def _content(self):
+        words = []
+        size = 0
+        while size < self.blob_size:
+            word = self.random.choice(WORDS)
+            words.append(word + ('\n' if self.random.random() < 0.1 else ' '))
+            size += len(word) + 1
+        return ''.join(words)
+
+    def _data(self, text):
+        data = force_bytes(text)
+        return force_bytes('data %d\n' % len(data)) + data + b'\n'
+
+    def _commit(self, ref, message, parents, paths):
+        self.mark += 1
+        self.timestamp += 3600
+        author = 'Author %d <author%d@example.com> %d +0000' % (self.mark % 7, self.mark % 7, self.timestamp)
+        chunks = [force_bytes('commit %s\nmark :%d\nauthor %s\ncommitter %s\n' % (ref, self.mark, author, author))]
+        chunks.append(self._data(message + '\n'))
+        for i, parent in enumerate(parents):
+            chunks.append(force_bytes('%s :%d\n' % ('from' if i == 0 else 'merge', parent)))
+        for path in paths:
+            chunks.append(force_bytes('M 100644 inline %s\n' % path))
+            chunks.append(self._data(self._content()))
+        return b''.join(chunks)
+
+    def iter_stream(self):
+        merge_every = self.commits // (self.merges + 1) if self.merges else None
+        tag_every = max(1, self.commits // self.tags) if self.tags else None
+        tip = None
+        tag = 0
+        for i in range(self.commits):
+            if merge_every and tip and i % merge_every == 0 and i // merge_every <= self.merges:
+                # Wide merge: merge_width - 1 side branches merged at once
+                sides = []
+                for side in range(self.merge_width - 1):
+                    ref = 'refs/heads/side-%d-%d' % (i, side)
+                    yield self._commit(ref, 'Side %d of merge %d' % (side, i), [tip], self.random.sample(self.paths, 2))
+                    sides.append(self.mark)
+                yield self._commit('refs/heads/master', 'Merge %d' % i, [tip] + sides, [])
+            elif tip is None:
+                yield self._commit('refs/heads/master', 'Initial commit', [], self.paths)
+            else:
+                count = self.random.randint(1, 3)
+                yield self._commit('refs/heads/master', 'Change %d' % i, [tip], self.random.sample(self.paths, count))
+            tip = self.mark
+            if tag_every and i % tag_every == 0 and tag < self.tags:
+                yield force_bytes('reset refs/tags/v%d\nfrom :%d\n\n' % (tag, tip))
+                tag += 1
+
+    def generate(self, path):
+        subprocess.check_call(['git', 'init', '--quiet', '--bare', path])
+        proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+        for chunk in self.iter_stream():
+            proc.stdin.write(chunk)
+        proc.stdin.close()
+        if proc.wait():
+            raise RuntimeError("git fast-import failed")
+        return path
+
+
+@contextmanager
+def count_git_commands(counter):
+    """
+    Counts the git commands run (through ``Git.execute``) inside the block.
+    """
+    execute = git.cmd.Git.execute
+
+    def counting_execute(self, *args, **kwargs):
+        counter[0] += 1
+        return execute(self, *args, **kwargs)
+
+    git.cmd.Git.execute = counting_execute
+    try:
+        yield counter
+    finally:
+        git.cmd.Git.execute = execute
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def get_sample_urls(repo, repository):
+    """
+    Returns a (name, url) for every URL pattern in gitlist/urls.py, filled
+    in with refs, commits and paths which exist in repository.
+    """
+    branch = repository.head.reference.name
+    commit = repository.git.log('-1', '--no-merges', '--format=%H').strip()
+    file = repository.git.diff_tree('--no-commit-id', '--name-only', '-r', commit).splitlines()[0]
+    file = file.decode('utf-8') if isinstance(file, bytes) else file
+    directory = file.rpartition('/')[0]
+    commitish_paths = {
+        'blob': '%s/%s' % (branch, file),
+        'blob_raw': '%s/%s' % (branch, file),
+        'blame': '%s/%s' % (branch, file),
+        'diff': '%s/%s' % (commit, file),
+        'commit': commit,
+        'tree': '%s/%s' % (branch, directory) if directory else branch,
+    }
+    queries = {
+        'searchbranch': '?query=lorem',
+        'searchcommits': '?query=change',
+    }
+
+    samples = []
+    for pattern in urls.urlpatterns:
+        groups = pattern.regex.groupindex
+        kwargs = {}
+        for group in groups:
+            if group == 'repo':
+                kwargs[group] = repo
+            elif group == 'branch':
+                kwargs[group] = branch
+            elif group == 'commitishPath':
+                kwargs[group] = commitish_paths.get(pattern.name, branch)
+            elif group == 'format':
+                kwargs[group] = 'zip'
+            elif group == 'page':
+                kwargs[group] = '0'
+        name = pattern.name
+        if 'branch' in groups or 'commitishPath' in groups:
+            name += '+ref'
+        samples.append((name, reverse(pattern.name, kwargs=kwargs) + queries.get(pattern.name, '')))
+    return samples
+
+
+def run_benchmark(repo, runs=5, views=None):
+    """
+    Requests every sample URL of repo runs times through the Django test
+    client, returning a dict with the latency percentiles (in milliseconds)
+    and git commands run of each view. The first (cold cache) request of
+    each view is reported apart. Views raising an exception get a
+    ``failed`` status and the error.
+
+    Memory is only measured per process: ``peak_rss_kb`` is the peak of the
+    benchmark process so far (and of its children), and
+    ``peak_rss_growth_kb`` how much that peak grew while requesting the
+    view, which is 0 for views needing less memory than some earlier one.
+    """
+    repository = git.Repo(os.path.expanduser(settings.GITLIST_REPOSITORIES[repo]))
+    client = Client()
+    results = {}
+    for name, url in get_sample_urls(repo, repository):
+        if views and name.split('+')[0] not in views:
+            continue
+        timings = []
+        commands = [0]
+        status = None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            for run in range(runs + 1):
+                with count_git_commands(commands if run else [0]):
+                    start = time.time()
+                    response = client.get(url)
+                    if response.streaming:
+                        for _ in response.streaming_content:
+                            pass
+                    elapsed = (time.time() - start) * 1000
+                status = response.status_code
+                if run == 0:
+                    cold = elapsed
+                else:
+                    timings.append(elapsed)
+        except Exception:
+            results[name] = dict(url=url, status='failed', error=traceback.format_exc())
+            continue
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results[name] = dict(
+            url=url,
+            status=status,
+            cold_ms=cold,
+            p50_ms=percentile(timings, 50),
+            p90_ms=percentile(timings, 90),
+            p99_ms=percentile(timings, 99),
+            max_ms=max(timings) if timings else None,
+            git_commands=float(commands[0]) / runs if runs else None,
+            peak_rss_kb=rss,
+            peak_rss_growth_kb=rss - peak,
+            children_peak_rss_kb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+    return results
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import re
+from array import array
+
+from django.conf import settings
+from django.utils.six.moves import range
+
+from .cache import LRUDiskStore, get_store
+from .instrumentation import instrumented
+from .utils import iter_git_lines
+
+BLAME_WINDOW = getattr(settings, 'GITLIST_BLAME_WINDOW', 2000)
+# Number of blames (whole files or chunks of BLAME_WINDOW lines) kept.
+BLAME_CACHE_ENTRIES = getattr(settings, 'GITLIST_BLAME_CACHE_ENTRIES', 10000)
+
+# Block headers of `git blame --incremental`: sha, source line, result line
+# and number of lines.
+BLOCK_RE = re.compile(br'^([0-9a-f]{40}) \d+ (\d+) (\d+)$')
+
+
+class BlameStore(LRUDiskStore):
+    max_entries = BLAME_CACHE_ENTRIES
+
+
+def _run_blame(repository, sha, path, start=None, stop=None):
+    args = ['--incremental']
+    if start is not None:
+        args.append('-L%d,%d' % (start + 1, stop))
+    args.extend([sha, '--', path])
+
+    commits = []
+    indexes = {}
+    owners = {}
+    for line in iter_git_lines(repository, 'blame', *args):
+        match = BLOCK_RE.match(line)
+        if match:
+            commit = match.group(1).decode('ascii')
+            try:
+                index = indexes[commit]
+            except KeyError:
+                index = indexes[commit] = len(commits)
+                commits.append(commit)
+            first = int(match.group(2)) - 1
+            for n in range(first, first + int(match.group(3))):
+                owners[n] = index
+
+    end = max(owners) + 1 if owners else 0
+    if start is None:
+        start, stop = 0, end
+    else:
+        # Ranges may go past the end of the file
+        stop = max(start, min(stop, end))
+    lines = array(str('I'), (owners.get(n, 0) for n in range(start, stop)))
+    return commits, lines
+
+
+@instrumented('blame')
+def get_blame(repository, sha, path, start=None, stop=None):
+    """
+    Blames path at commit sha, returning a list of commit shas and an array
+    with the index (in that list) of the commit owning each line, for the
+    lines in [start, stop) or for the whole file.
+
+    Blame only depends on the last commit which touched path, so results
+    are cached per (last commit, path): commits added on top which don't
+    change the file reuse the cached blame. Whole file blames also answer
+    line range requests; otherwise ranges are blamed (and cached) in
+    chunks of BLAME_WINDOW lines aligned on multiples of it, so huge files
+    can be blamed a window at a time and each file has a bounded number of
+    cached chunks whatever ranges are requested. Only the
+    GITLIST_BLAME_CACHE_ENTRIES most recently used blames are kept.
+    """
+    store = get_store(repository, 'blame', BlameStore)
+
+    last_key = 'last:%s:%s' % (sha, path)
+    last = store.get(last_key)
+    if last is None:
+        last = repository.git.rev_list('-1', sha, '--', path) or sha
+        store.set(last_key, last)
+
+    key = 'blame:%s:%s' % (last, path)
+    blame = store.get(key)
+    if blame is not None:
+        commits, lines = blame
+        if start is not None:
+            lines = lines[start:stop]
+        return commits, lines
+
+    if start is None:
+        blame = _run_blame(repository, last, path)
+        store.set(key, blame)
+        return blame
+
+    commits = []
+    indexes = {}
+    lines = array(str('I'))
+    for chunk_start in range(start - start % BLAME_WINDOW, stop, BLAME_WINDOW):
+        chunk_key = '%s:%d' % (key, chunk_start)
+        chunk = store.get(chunk_key)
+        if chunk is None:
+            chunk = _run_blame(repository, last, path, chunk_start, chunk_start + BLAME_WINDOW)
+            store.set(chunk_key, chunk)
+        chunk_commits, chunk_lines = chunk
+        for commit in chunk_commits:
+            if commit not in indexes:
+                indexes[commit] = len(commits)
+                commits.append(commit)
+        lines.extend(indexes[chunk_commits[owner]]
+                     for owner in chunk_lines[max(start, chunk_start) - chunk_start:stop - chunk_start])
+    return commits, lines
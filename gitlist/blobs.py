@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+import itertools
+import threading
+from array import array
+from multiprocessing.pool import ThreadPool
+
+import git
+
+from django.conf import settings
+from django.utils.six.moves import range
+
+from .cache import LRUCache, get_cache_path, get_store, iter_write_through, touch_file, prune_files
+from .responses import MAX_CHUNK_SIZE, get_chunk_size
+from .search import is_binary
+
+BLOB_CACHE_SIZE = getattr(settings, 'GITLIST_BLOB_CACHE_SIZE', 1024 * 1024 * 1024)
+# Only blobs at least this big, requested at least GITLIST_BLOB_CACHE_HITS
+# times, are written to the cache.
+BLOB_CACHE_MIN_SIZE = getattr(settings, 'GITLIST_BLOB_CACHE_MIN_SIZE', 1024 * 1024)
+BLOB_CACHE_HITS = getattr(settings, 'GITLIST_BLOB_CACHE_HITS', 2)
+# Threads writing blobs to the cache in the background.
+BLOB_CACHE_THREADS = getattr(settings, 'GITLIST_BLOB_CACHE_THREADS', 2)
+
+# Files bigger than this are shown GITLIST_BLOB_WINDOW lines at a time.
+BLOB_VIEW_MAX_SIZE = getattr(settings, 'GITLIST_BLOB_VIEW_MAX_SIZE', 512 * 1024)
+BLOB_WINDOW = getattr(settings, 'GITLIST_BLOB_WINDOW', 1000)
+# The line index keeps the offset of one every LINE_INDEX_STEP lines.
+LINE_INDEX_STEP = 256
+
+blob_hits = LRUCache(10000)
+
+_lock = threading.Lock()
+_pool = None
+_filling = set()  # (git_dir, sha) of the blobs being written to the cache
+
+
+def get_blob_path(repository, sha):
+    return get_cache_path(repository, 'blobs', sha)
+
+
+def get_cached_blob(repository, sha):
+    """
+    Returns the path of the cached contents of blob sha, or None.
+    """
+    return touch_file(get_blob_path(repository, sha))
+
+
+def prune_blobs(max_size=BLOB_CACHE_SIZE):
+    prune_files(os.path.join('*', 'blobs', '*'), max_size)
+
+
+def is_hot(repository, blob):
+    """
+    Counts a request for blob, returning True once it has been requested
+    often enough to be worth caching.
+    """
+    if blob.size < BLOB_CACHE_MIN_SIZE:
+        return False
+    key = (repository.git_dir, blob.hexsha)
+    hits = blob_hits.get(key, 0) + 1
+    blob_hits.set(key, hits)
+    return hits >= BLOB_CACHE_HITS
+
+
+def _iter_blob(blob, chunk_size):
+    f = blob.data_stream
+    try:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+    finally:
+        # GitPython reads whatever is left of a dropped stream in one go
+        # (to keep its cat-file process in sync), so skip it chunk by chunk
+        while f.read(chunk_size):
+            pass
+
+
+def iter_blob(repository, blob, cache=False):
+    """
+    Yields the contents of blob in chunks sized after the blob. With cache,
+    the contents are written to the blob cache on the way.
+    """
+    chunks = _iter_blob(blob, get_chunk_size(blob.size))
+    if not cache:
+        return chunks
+    return _iter_cached_blob(repository, blob, chunks)
+
+
+def _iter_cached_blob(repository, blob, chunks):
+    for chunk in iter_write_through(get_blob_path(repository, blob.hexsha), chunks):
+        yield chunk
+    prune_blobs()
+
+
+def materialize_blob(repository, blob):
+    """
+    Writes blob to the blob cache (if it isn't there yet), returning the
+    path of its contents.
+    """
+    path = get_cached_blob(repository, blob.hexsha)
+    if path is None:
+        for _ in iter_blob(repository, blob, cache=True):
+            pass
+        path = get_blob_path(repository, blob.hexsha)
+    return path
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPool(BLOB_CACHE_THREADS)
+        return _pool
+
+
+def _fill_blob_cache(path, key):
+    try:
+        # Repository handles can't be shared between threads
+        repository = git.Repo(path)
+        try:
+            materialize_blob(repository, repository.rev_parse(key[1]))
+        finally:
+            repository.git.clear_cache()
+    finally:
+        with _lock:
+            _filling.discard(key)
+
+
+def fill_blob_cache(repository, blob):
+    """
+    Writes blob to the blob cache in the background, unless it's being
+    written already.
+    """
+    key = (repository.git_dir, blob.hexsha)
+    with _lock:
+        if key in _filling:
+            return
+        _filling.add(key)
+    _get_pool().apply_async(_fill_blob_cache, (repository.working_dir, key))
+
+
+class BlobReader(object):
+    """
+    Forward only file object reading the chunks of a blob, so ranges of
+    blobs which aren't in the blob cache are sent from the blob stream:
+    seeking ahead skips the chunks in between.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.position = 0
+        self.pending = b''
+
+    def read(self, size):
+        while len(self.pending) < size:
+            chunk = next(self.chunks, b'')
+            if not chunk:
+                break
+            self.pending += chunk
+        data, self.pending = self.pending[:size], self.pending[size:]
+        self.position += len(data)
+        return data
+
+    def seek(self, position):
+        if position < self.position:
+            raise IOError("Can't seek back in a blob stream")
+        while self.position < position:
+            if not self.read(min(position - self.position, MAX_CHUNK_SIZE)):
+                break
+
+    def close(self):
+        self.chunks.close()
+
+
+def _build_line_index(chunks):
+    offsets = array(str('L'), [0])
+    lines = 0
+    position = 0
+    last = b''
+    binary = None
+    for chunk in chunks:
+        if binary is None:
+            binary = is_binary(chunk)
+        start = 0
+        count = chunk.count(b'\n')
+        while lines + count >= len(offsets) * LINE_INDEX_STEP:
+            # Find the newline ending the last line before the next mark
+            for _ in range(len(offsets) * LINE_INDEX_STEP - lines):
+                start = chunk.index(b'\n', start) + 1
+                lines += 1
+                count -= 1
+            offsets.append(position + start)
+        lines += count
+        position += len(chunk)
+        last = chunk[-1:] or last
+    if last and last != b'\n':
+        lines += 1  # Last line without a newline
+    return lines, offsets, bool(binary)
+
+
+def _get_line_index(repository, blob):
+    store = get_store(repository, 'line_index')
+    index = store.get(blob.hexsha)
+    if index is None or len(index) != 3:
+        index = _build_line_index(_iter_blob(blob, get_chunk_size(blob.size)))
+        store.set(blob.hexsha, index)
+    return index
+
+
+def get_line_index(repository, blob):
+    """
+    Returns the number of lines of blob and an array with the offset of
+    every LINE_INDEX_STEP-th line, so any window of lines can be read
+    without splitting the whole file. Indexes are kept per blob sha.
+    """
+    return _get_line_index(repository, blob)[:2]
+
+
+def is_binary_blob(repository, blob):
+    """
+    Returns whether blob looks binary. Big blobs are only sniffed once,
+    while their line index is built, as reading even the start of a blob
+    means reading it all.
+    """
+    if blob.size > BLOB_VIEW_MAX_SIZE:
+        return _get_line_index(repository, blob)[2]
+    chunks = _iter_blob(blob, get_chunk_size(blob.size))
+    try:
+        return is_binary(next(chunks, b''))
+    finally:
+        chunks.close()
+
+
+def _iter_lines(chunks):
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+
+def read_lines(repository, blob, start, stop):
+    """
+    Returns lines [start, stop) of blob (as bytes, with their newlines).
+    Big blobs are read from the blob cache, starting at the closest indexed
+    line, so memory use and time only depend on the window size.
+    """
+    if BLOB_CACHE_MIN_SIZE <= blob.size <= BLOB_CACHE_SIZE:
+        _, offsets = get_line_index(repository, blob)
+        mark = start // LINE_INDEX_STEP
+        with open(materialize_blob(repository, blob), 'rb') as f:
+            f.seek(offsets[mark])
+            lines = itertools.islice(f, start - mark * LINE_INDEX_STEP, stop - mark * LINE_INDEX_STEP)
+            return b''.join(lines)
+    # Small blobs (and those too big for the cache) are read through
+    chunks = _iter_blob(blob, get_chunk_size(blob.size))
+    return b''.join(itertools.islice(_iter_lines(chunks), start, stop))
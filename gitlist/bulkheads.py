@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import time
+import threading
+
+from django.conf import settings
+
+# Per view class: the requests served at once (in this process) in total
+# and for any single repository, how long (in seconds) requests queue for
+# a slot before being turned away, and the Retry-After they get then.
+DEFAULT_BULKHEADS = {
+    'browse': dict(limit=32, repository_limit=16, timeout=5, retry_after=1),
+    'expensive': dict(limit=4, repository_limit=2, timeout=2, retry_after=10),
+    'archive': dict(limit=4, repository_limit=2, timeout=1, retry_after=30),
+}
+BULKHEADS = dict(DEFAULT_BULKHEADS, **getattr(settings, 'GITLIST_BULKHEADS', {}))
+
+
+class Bulkhead(object):
+    """
+    Bounds the requests of a view class served at once, in total and per
+    repository, so a burst of requests to some expensive view (or to a
+    single big repository) can't take every worker thread.
+    """
+    def __init__(self, limit, repository_limit, timeout, retry_after):
+        self.limit = limit
+        self.repository_limit = repository_limit
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.condition = threading.Condition()
+        self.active = 0
+        self.repositories = {}  # repo -> active requests
+
+    def acquire(self, repo):
+        """
+        Takes a slot for repo, waiting at most timeout seconds for one to be
+        free. Returns whether a slot was taken.
+        """
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while self.active >= self.limit or self.repositories.get(repo, 0) >= self.repository_limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.active += 1
+            self.repositories[repo] = self.repositories.get(repo, 0) + 1
+            return True
+
+    def release(self, repo):
+        with self.condition:
+            self.active -= 1
+            count = self.repositories.pop(repo) - 1
+            if count:
+                self.repositories[repo] = count
+            # Waiters may be waiting for different repositories
+            self.condition.notify_all()
+
+
+_lock = threading.Lock()
+_bulkheads = {}
+
+
+def get_bulkhead(name):
+    with _lock:
+        try:
+            return _bulkheads[name]
+        except KeyError:
+            bulkhead = _bulkheads[name] = Bulkhead(**BULKHEADS[name])
+            return bulkhead
+
+
+class ReleasingIterator(object):
+    """
+    Iterates over the contents of a streaming response, calling release
+    once they're exhausted or closed (even if never iterated).
+    """
+    def __init__(self, iterable, release):
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.close()
+            raise
+    next = __next__
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            try:
+                if hasattr(self.iterable, 'close'):
+                    self.iterable.close()
+            finally:
+                release()
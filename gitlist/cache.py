@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+import glob
+import time
+import sqlite3
+import hashlib
+import tempfile
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+from django.utils.encoding import force_bytes
+
+CACHE_DIR = getattr(settings, 'GITLIST_CACHE_DIR', None) or os.path.join(tempfile.gettempdir(), 'gitlist')
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping holding at most ``maxsize`` items, discarding the
+    least recently used ones first.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+def ensure_dir(dirname):
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+
+
+def iter_write_through(path, chunks):
+    """
+    Yields chunks while writing them to path. The file is written under a
+    temporary name and only made visible at path once all chunks were
+    written, so readers never see a partial file.
+    """
+    dirname = os.path.dirname(path)
+    ensure_dir(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    completed = False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.rename(tmp_path, path)
+        completed = True
+    finally:
+        if not completed:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+def touch_file(path):
+    """
+    Marks the cached file at path as used (eviction is LRU) and returns it,
+    or returns None if it doesn't exist.
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        return None
+    return path
+
+
+def prune_files(pattern, max_size):
+    """
+    Removes the least recently used files matching the glob pattern (inside
+    the cache directory) until they take at most max_size bytes.
+    """
+    files = []
+    for path in glob.glob(os.path.join(CACHE_DIR, pattern)):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
+
+
+class SQLiteDatabase(object):
+    """
+    Base class for the on-disk indexes. Every thread gets its own sqlite
+    connection (sqlite connections can't be shared between threads) and
+    the statements in ``SCHEMA`` are run when the connection is opened.
+    """
+    SCHEMA = ()
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            ensure_dir(os.path.dirname(self.filename))
+            connection = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            self.local.connection = connection
+        return connection
+
+    def execute(self, sql, params=()):
+        return self.connection.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.connection.executemany(sql, seq_of_params)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups the statements executed inside the block in one transaction.
+        Nested blocks join the outermost one.
+        """
+        connection = self.connection
+        if getattr(self.local, 'in_transaction', False):
+            yield
+            return
+        self.local.in_transaction = True
+        connection.execute('BEGIN')
+        try:
+            yield
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+        finally:
+            self.local.in_transaction = False
+
+
+class DiskStore(SQLiteDatabase):
+    """
+    Persistent key/value store. Keys are strings, values are pickled.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value BLOB)',
+    )
+
+    def get(self, key, default=None):
+        row = self.execute('SELECT value FROM store WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value):
+        value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.execute('INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)', (key, value))
+
+    def set_many(self, items):
+        """
+        Stores a list of (key, value) in one (short) transaction.
+        """
+        items = [(key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))) for key, value in items]
+        with self.transaction():
+            self.executemany('INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)', items)
+
+    def delete(self, key):
+        self.execute('DELETE FROM store WHERE key = ?', (key,))
+
+
+class LRUDiskStore(DiskStore):
+    """
+    DiskStore holding at most ``max_entries`` values, discarding the least
+    recently used ones first. Reads mark values as used, and the store is
+    pruned every ``prune_every`` writes.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value BLOB, used REAL)',
+        'CREATE INDEX IF NOT EXISTS store_used ON store (used)',
+    )
+    max_entries = 10000
+    prune_every = 100
+
+    def __init__(self, filename):
+        super(LRUDiskStore, self).__init__(filename)
+        self.writes = itertools.count(1)
+
+    def get(self, key, default=None):
+        row = self.execute('SELECT value FROM store WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        self.execute('UPDATE store SET used = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value):
+        value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.execute('INSERT OR REPLACE INTO store (key, value, used) VALUES (?, ?, ?)', (key, value, time.time()))
+        if next(self.writes) % self.prune_every == 0:
+            self.prune()
+
+    def set_many(self, items):
+        now = time.time()
+        items = [(key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), now) for key, value in items]
+        with self.transaction():
+            self.executemany('INSERT OR REPLACE INTO store (key, value, used) VALUES (?, ?, ?)', items)
+        self.prune()
+
+    def prune(self):
+        self.execute('DELETE FROM store WHERE key IN (SELECT key FROM store ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                     (self.max_entries,))
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_cache_path(repository, *names):
+    """
+    Returns the path of a file inside the cache directory of repository.
+    """
+    dirname = hashlib.sha1(force_bytes(repository.git_dir)).hexdigest()
+    return os.path.join(CACHE_DIR, dirname, *names)
+
+
+def get_store(repository, name, cls=DiskStore):
+    """
+    Returns the (shared) ``cls`` database called name for repository.
+    """
+    filename = get_cache_path(repository, name + '.sqlite3')
+    with _databases_lock:
+        try:
+            database = _databases[filename]
+        except KeyError:
+            database = cls(filename)
+            _databases[filename] = database
+    return database
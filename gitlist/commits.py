@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import re
+import hashlib
+import itertools
+from collections import namedtuple
+
+import git
+
+from django.conf import settings
+from django.utils import six
+from django.utils.encoding import force_text
+
+from .cache import LRUCache, LRUDiskStore, get_store
+from .instrumentation import instrumented
+from .utils import iter_git_lines, iter_git_records
+
+COMMIT_CACHE_SIZE = getattr(settings, 'GITLIST_COMMIT_CACHE_SIZE', 10000)
+FILE_STATS_CACHE_SIZE = getattr(settings, 'GITLIST_FILE_STATS_CACHE_SIZE', 10000)
+LAST_COMMITS_CACHE_SIZE = getattr(settings, 'GITLIST_LAST_COMMITS_CACHE_SIZE', 1000)
+# Commits walked while rendering a directory to find the last commits of its
+# entries; the rest of the walk is left to a job.
+LAST_COMMITS_WALK = getattr(settings, 'GITLIST_LAST_COMMITS_WALK', 500)
+# Number of commits page cursors kept (per repository).
+CURSOR_STORE_ENTRIES = getattr(settings, 'GITLIST_CURSOR_STORE_ENTRIES', 100000)
+
+# One NUL separated field per CommitRecord slot (parents are space separated)
+COMMIT_FORMAT = '--format=%H%x00%P%x00%an%x00%ae%x00%at%x00%cn%x00%ce%x00%ct%x00%B'
+COMMIT_FIELDS = 9
+
+SHA_RE = re.compile(br'^[0-9a-f]{40}$')
+CURSOR_RE = re.compile(r'^[0-9a-f]{20}$')
+
+commit_cache = LRUCache(COMMIT_CACHE_SIZE)
+file_stats_cache = LRUCache(FILE_STATS_CACHE_SIZE)
+last_commits_cache = LRUCache(LAST_COMMITS_CACHE_SIZE)
+
+Actor = namedtuple('Actor', 'name email')
+
+
+class CommitRecord(object):
+    """
+    The metadata of a commit, as read from ``git log``. Attributes mirror
+    those of ``git.Commit`` used by the views, except ``parents``, which is
+    a tuple of shas.
+    """
+    __slots__ = ('hexsha', 'parents', 'author', 'authored_date', 'committer', 'committed_date', 'message')
+
+    def __init__(self, hexsha, parents, author, authored_date, committer, committed_date, message):
+        self.hexsha = hexsha
+        self.parents = parents
+        self.author = author
+        self.authored_date = authored_date
+        self.committer = committer
+        self.committed_date = committed_date
+        self.message = message
+
+    @property
+    def summary(self):
+        return self.message.split('\n', 1)[0]
+
+
+def _parse_commits(records):
+    fields = []
+    for record in records:
+        fields.append(record)
+        if len(fields) == COMMIT_FIELDS:
+            sha, parents, an, ae, at, cn, ce, ct, message = fields
+            fields = []
+            yield CommitRecord(
+                sha.decode('ascii'),
+                tuple(parents.decode('ascii').split()),
+                Actor(force_text(an, errors='replace'), force_text(ae, errors='replace')),
+                int(at),
+                Actor(force_text(cn, errors='replace'), force_text(ce, errors='replace')),
+                int(ct),
+                force_text(message, errors='replace'),
+            )
+
+
+def _rev_list(repository, *args, **kwargs):
+    path = kwargs.pop('path', None)
+    args = list(args)
+    if path:
+        args.extend(['--', path])
+    return repository.git.rev_list(*args)
+
+
+def is_ancestor(repository, ancestor, commit):
+    """
+    Returns True if ancestor is reachable from commit.
+    """
+    status, _, _ = repository.git.merge_base('--is-ancestor', ancestor, commit, with_extended_output=True, with_exceptions=False)
+    return status == 0
+
+
+def count_commits(repository, commitish, path=''):
+    """
+    Returns the number of commits reachable from commitish which touch path,
+    the same as ``sum(1 for _ in repository.iter_commits(commitish, paths=path))``.
+
+    Counts are persisted per (commit sha, path) and, for named refs, the last
+    indexed tip is remembered so that after a push only the new commits are
+    counted: ``count(new) = count(old) - |old ^new| + |new ^old|``.
+    """
+    store = get_store(repository, 'commit_counts')
+    sha = repository.commit(commitish).hexsha
+
+    key = 'count:%s:%s' % (sha, path)
+    count = store.get(key)
+    if count is not None:
+        return count
+
+    tip_key = 'tip:%s:%s' % (commitish, path)
+    tip = store.get(tip_key)
+    if tip is not None:
+        tip_sha, tip_count = tip
+        try:
+            left, right = _rev_list(repository, '--count', '--left-right', '%s...%s' % (tip_sha, sha), path=path).split()
+        except (git.GitCommandError, ValueError):
+            pass  # The old tip is gone (gc'ed after a forced push)
+        else:
+            count = tip_count - int(left) + int(right)
+
+    if count is None:
+        count = int(_rev_list(repository, '--count', sha, path=path))
+
+    store.set(key, count)
+    if commitish != sha:
+        store.set(tip_key, (sha, count))
+    return count
+
+
+@instrumented('iter_commits')
+def iter_commits(repository, revs, path='', max_count=None, skip=None, topo_order=False):
+    """
+    Yields the CommitRecord of the history of revs (a commitish or a list
+    of them) touching path, as ``repository.iter_commits`` does, parsed from
+    a single ``git log`` stream.
+
+    When path is given, parents are rewritten to the previous commits
+    touching path (so they can be followed); those records aren't cached.
+    """
+    if isinstance(revs, six.string_types):
+        revs = [revs]
+    args = ['-z', COMMIT_FORMAT]
+    if max_count is not None:
+        args.append('--max-count=%d' % max_count)
+    if skip:
+        args.append('--skip=%d' % skip)
+    if topo_order:
+        args.append('--topo-order')
+    if path:
+        args.append('--parents')
+    args.extend(revs)
+    if path:
+        args.extend(['--', path])
+    for commit in _parse_commits(iter_git_records(repository, 'log', *args)):
+        if not path:
+            commit_cache.set(commit.hexsha, commit)
+        yield commit
+
+
+class CursorStore(LRUDiskStore):
+    max_entries = CURSOR_STORE_ENTRIES
+
+
+def save_cursor(repository, shas, previous=None, page=1):
+    """
+    Stores the cursor (list of shas) of a commits page, along with the token
+    of the cursor of the page before it (None for the first page) and its
+    page number, and returns its token. Frontiers can hold any number of
+    shas, so links only carry the (short) token.
+    """
+    token = hashlib.sha1(('%s:%s' % (previous or '', ','.join(shas))).encode('ascii')).hexdigest()[:20]
+    store = get_store(repository, 'cursors', CursorStore)
+    if store.get(token) is None:
+        store.set(token, (shas, previous, page))
+    return token
+
+
+def load_cursor(repository, value):
+    """
+    Returns the (shas, previous token, page number) of the cursor with token
+    value, or None if value isn't the token of a known cursor.
+    """
+    if value is None or not CURSOR_RE.match(value):
+        return None
+    cursor = get_store(repository, 'cursors', CursorStore).get(value)
+    if cursor is None or len(cursor) != 3:
+        return None
+    return cursor
+
+
+def _frontier(cursor, commits):
+    """
+    Returns the shas in cursor or among the parents of commits, a list of
+    (sha, parents) pairs, which aren't in commits.
+    """
+    listed = set(sha for sha, _ in commits)
+    frontier = []
+    for sha in itertools.chain(cursor, *(parents for _, parents in commits)):
+        if sha not in listed:
+            listed.add(sha)
+            frontier.append(sha)
+    return frontier
+
+
+def get_commits_page(repository, commitish, path='', cursor=None, per_page=15):
+    """
+    Returns a page of the history of commitish touching path, and the cursor
+    of the next page (None for the last one).
+
+    A cursor is the frontier of the history walk so far: the (rewritten)
+    parents of the listed commits which haven't been listed yet. Walking
+    from it resumes the history right where the previous page stopped, so
+    every page costs the same regardless of its depth.
+    """
+    if cursor is not None and not cursor:
+        return [], None
+    commits = list(iter_commits(repository, cursor or commitish, path, max_count=per_page + 1))
+    if len(commits) <= per_page:
+        return commits, None
+    commits = commits[:per_page]
+    return commits, _frontier(cursor or [], [(commit.hexsha, commit.parents) for commit in commits])
+
+
+def get_cursors(repository, commitish, path='', skips=(0,)):
+    """
+    Returns the cursors of the pages starting after the first skip commits
+    of the history of commitish touching path, for each of skips, with a
+    single walk (used to redirect ``?page=``).
+    """
+    args = ['--parents', '--max-count=%d' % max(skips), commitish]
+    if path:
+        args.extend(['--', path])
+    commits = []
+    for line in iter_git_lines(repository, 'rev-list', *args):
+        shas = line.decode('ascii').split()
+        commits.append((shas[0], shas[1:]))
+    return [_frontier([], commits[:skip]) if len(commits) >= skip else [] for skip in skips]
+
+
+def get_commits(repository, shas):
+    """
+    Returns the CommitRecord of each of the given shas; the ones not in the
+    commit cache are read with a single ``git log --no-walk``.
+    """
+    commits = dict((sha, commit_cache.get(sha)) for sha in shas)
+    missing = [sha for sha, commit in commits.items() if commit is None]
+    if missing:
+        records = iter_git_records(repository, 'log', '-z', '--no-walk=unsorted', COMMIT_FORMAT, *missing)
+        for commit in _parse_commits(records):
+            commit_cache.set(commit.hexsha, commit)
+            commits[commit.hexsha] = commit
+    return [commits[sha] for sha in shas]
+
+
+def get_commit(repository, commitish):
+    """
+    Returns the CommitRecord of commitish.
+    """
+    return get_commits(repository, [repository.commit(commitish).hexsha])[0]
+
+
+def _log_numstat(repository, shas):
+    """
+    Yields (sha, stats) for the given shas from a single ``git log --numstat``
+    (diffing merges against their first parent, like ``Commit.stats``).
+    """
+    args = ['--no-walk=unsorted', '-m', '--first-parent', '--numstat', '--format=%H'] + list(shas)
+    sha = stats = None
+    for line in iter_git_lines(repository, 'log', *args):
+        if SHA_RE.match(line):
+            if sha is not None:
+                yield sha, stats
+            sha = line.decode('ascii')
+            stats = dict(files=0, insertions=0, deletions=0)
+        elif line and sha is not None:
+            added, deleted, _ = line.split(b'\t', 2)
+            stats['files'] += 1
+            if added != b'-':
+                stats['insertions'] += int(added)
+                stats['deletions'] += int(deleted)
+    if sha is not None:
+        yield sha, stats
+
+
+def get_file_stats(repository, shas):
+    """
+    Returns a dict mapping each commit sha to its file stats (``files``,
+    ``insertions`` and ``deletions``, as in ``Commit.stats.total``).
+
+    Stats never change for a given sha, so they are kept in memory and on
+    disk; the missing ones are gathered in one batched ``git log`` instead
+    of a ``git diff`` per commit.
+    """
+    result = {}
+    missing = []
+    store = None
+    for sha in shas:
+        stats = file_stats_cache.get(sha)
+        if stats is None:
+            if store is None:
+                store = get_store(repository, 'file_stats')
+            stats = store.get(sha)
+            if stats is None:
+                missing.append(sha)
+                continue
+            file_stats_cache.set(sha, stats)
+        result[sha] = stats
+
+    if missing:
+        with store.transaction():
+            for sha, stats in _log_numstat(repository, missing):
+                store.set(sha, stats)
+                file_stats_cache.set(sha, stats)
+                result[sha] = stats
+    return result
+
+
+def _entry_names(paths, path):
+    """
+    Yields the name of the entry of directory path containing each of paths.
+    """
+    prefix = path + '/' if path else ''
+    for name in paths:
+        name = force_text(name, errors='replace')
+        if name.startswith(prefix):
+            yield name[len(prefix):].split('/', 1)[0]
+
+
+def _walk_last_commits(repository, sha, path, names, max_count=None):
+    """
+    Finds the last commit touching each of names in directory path with a
+    single ``git log`` walk, stopped as soon as all of them are found (or
+    after max_count commits).
+    """
+    pending = set(names)
+    result = {}
+    args = ['-z', '--name-only', '-c', '--no-renames', '--format=%x01%H', sha]
+    if max_count is not None:
+        args.insert(0, '--max-count=%d' % max_count)
+    if path:
+        args.extend(['--', path])
+    commit = None
+    for record in iter_git_records(repository, 'log', *args):
+        if record.startswith(b'\x01'):
+            if not pending:
+                break
+            commit = record[1:].decode('ascii')
+            continue
+        for name in _entry_names([record.lstrip(b'\n')], path):
+            if name in pending:
+                pending.discard(name)
+                result[name] = commit
+    return result
+
+
+def _update_last_commits(repository, store, sha, path, names):
+    """
+    Returns the last commits of names derived from the cached answer for
+    the parent of sha (when it has a single one), or an empty dict.
+    """
+    commit = get_commits(repository, [sha])[0]
+    if len(commit.parents) != 1:
+        return {}
+    parent_sha = commit.parents[0]
+    parent = last_commits_cache.get('last:%s:%s' % (parent_sha, path)) or store.get('last:%s:%s' % (parent_sha, path))
+    if parent is None:
+        return {}
+    args = ['--name-only', '--no-renames', '-r', '-z', parent_sha, sha]
+    if path:
+        args.extend(['--', path])
+    changed = set(_entry_names(repository.git.diff_tree(*args).split(b'\0'), path))
+    result = {}
+    for name in names:
+        if name in changed:
+            result[name] = sha
+        elif name in parent:
+            result[name] = parent[name]
+    return result
+
+
+@instrumented('last_commits')
+def get_last_commits(repository, sha, path, names, max_count=None):
+    """
+    Returns a dict mapping each of names (the entries of directory path at
+    commit sha) to the sha of the last commit which touched it.
+
+    Answers are cached per (sha, path). When the single parent of sha has a
+    cached answer, only the entries sha changed (or added) are updated;
+    otherwise all of them are resolved in one history walk. With max_count,
+    the walk stops after that many commits, and the names it didn't reach
+    are left out of the (then uncached) answer.
+    """
+    key = 'last:%s:%s' % (sha, path)
+    result = last_commits_cache.get(key)
+    if result is None:
+        store = get_store(repository, 'last_commits')
+        result = store.get(key)
+        if result is None:
+            result = _update_last_commits(repository, store, sha, path, names)
+            missing = [name for name in names if name not in result]
+            if missing:
+                result.update(_walk_last_commits(repository, sha, path, missing, max_count))
+                if len(result) < len(names):
+                    return result
+            store.set(key, result)
+        last_commits_cache.set(key, result)
+    return result
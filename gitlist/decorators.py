@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import re
+import time
+import hashlib
+import datetime
+from functools import wraps
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.encoding import force_bytes
+from django.views.decorators.http import condition
+
+from .bulkheads import ReleasingIterator, get_bulkhead
+from .instrumentation import record
+from .utils import get_repository_from_name, get_request_refs_stamp, parse_commitish_path
+
+CACHE_VERSION = getattr(settings, 'GITLIST_CACHE_VERSION', 1)
+IMMUTABLE_MAX_AGE = getattr(settings, 'GITLIST_IMMUTABLE_MAX_AGE', 365 * 24 * 60 * 60)
+
+FULL_SHA_RE = re.compile(r'^[0-9a-f]{40}(?:/|$)')
+
+
+def resolve_commit(request, repo, commitishPath):
+    """
+    Resolves the commit the URL of request points to, returning a
+    (commit, path, etag) tuple or None if it can't be resolved (the view
+    itself will then report the error). The result is memoized in the
+    request, as the etag and last modified functions both need it.
+    """
+    try:
+        return request._gitlist_resolved
+    except AttributeError:
+        pass
+
+    resolved = None
+    try:
+        repository = get_repository_from_name(repo)
+        commitish, path = parse_commitish_path(commitishPath, repository)
+        commit = repository.commit(commitish)
+    except (Http404, ValueError):
+        pass
+    else:
+        key = [
+            CACHE_VERSION,
+            request.resolver_match.url_name if request.resolver_match else request.path,
+            commit.hexsha,
+            path,
+            sorted(request.GET.lists()),
+            request.is_ajax(),
+        ]
+        if not FULL_SHA_RE.match(commitishPath):
+            # Pages addressed by name also show the branch and tag menus,
+            # so those need to change whenever the refs change.
+            key.append(get_request_refs_stamp(repository.git_dir))
+        etag = hashlib.sha1(force_bytes(repr(key))).hexdigest()
+        resolved = (commit, path, etag)
+
+    request._gitlist_resolved = resolved
+    return resolved
+
+
+def _get_commitish_path(kwargs):
+    return kwargs.get('commitishPath') or kwargs.get('branch') or ''
+
+
+def _etag(request, repo, *args, **kwargs):
+    resolved = resolve_commit(request, repo, _get_commitish_path(kwargs))
+    if resolved:
+        return resolved[2]
+
+
+def _last_modified(request, repo, *args, **kwargs):
+    # Refs can move back to older commits (and the menus change with the
+    # refs), so only pages addressed by full sha get a Last-Modified.
+    commitishPath = _get_commitish_path(kwargs)
+    if not FULL_SHA_RE.match(commitishPath):
+        return None
+    resolved = resolve_commit(request, repo, commitishPath)
+    if resolved:
+        return datetime.datetime.utcfromtimestamp(resolved[0].committed_date)
+
+
+def commit_condition(view):
+    """
+    Decorator for views whose output only depends on the commit (and path)
+    their URL resolves to. It derives strong ETags (and, for URLs addressed
+    by full sha, Last-Modified) from the resolved commit, answers
+    conditional GETs with a 304 without ever calling the view and, for URLs
+    addressed by full sha, marks successful responses as immutable so
+    browsers and proxies can keep them.
+    """
+    conditional_view = condition(etag_func=_etag, last_modified_func=_last_modified)(view)
+
+    @wraps(view)
+    def _wrapped_view(request, repo, *args, **kwargs):
+        response = conditional_view(request, repo, *args, **kwargs)
+        if response.status_code not in (200, 206, 304):
+            # The computing pages and rejections must not be revalidated
+            # as the content they stand for
+            for header in ('ETag', 'Last-Modified'):
+                if response.has_header(header):
+                    del response[header]
+        # Ajax requests get fragments of the pages
+        patch_vary_headers(response, ['X-Requested-With'])
+        if 'no-cache' in response.get('Cache-Control', ''):
+            # Provisional responses must reach the view again
+            if response.has_header('Last-Modified'):
+                del response['Last-Modified']
+        elif response.status_code in (200, 304) and FULL_SHA_RE.match(_get_commitish_path(kwargs)):
+            patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+        return response
+    return _wrapped_view
+
+
+def mark_provisional(response):
+    """
+    Marks a response of a commit_condition view whose contents depend on
+    caches which are still being filled. It gets a weak ETag of its own
+    (which never matches the commit's one) and no-cache, so clients come
+    back to the view rather than keeping it.
+    """
+    response['ETag'] = 'W/"%s"' % hashlib.md5(response.content).hexdigest()
+    patch_cache_control(response, no_cache=True)
+
+
+def bulkhead(name):
+    """
+    Decorator admitting requests to a view through the named bulkhead (see
+    GITLIST_BULKHEADS), so every view class keeps its own capacity. Requests
+    which can't get a slot in time are turned away with a 503 and a
+    Retry-After. Streaming responses hold their slot until they're done.
+    """
+    def decorator(view):
+        @wraps(view)
+        def _wrapped_view(request, repo, *args, **kwargs):
+            bulkhead = get_bulkhead(name)
+            start = time.time()
+            if not bulkhead.acquire(repo):
+                record('bulkhead.%s.rejected' % name, time.time() - start)
+                response = HttpResponse("Too many requests, please try again later.\n", status=503, content_type='text/plain')
+                response['Retry-After'] = str(bulkhead.retry_after)
+                patch_cache_control(response, no_store=True)
+                return response
+            record('bulkhead.%s.wait' % name, time.time() - start)
+            try:
+                response = view(request, repo, *args, **kwargs)
+            except Exception:
+                bulkhead.release(repo)
+                raise
+            if response.streaming:
+                response.streaming_content = ReleasingIterator(response.streaming_content, lambda: bulkhead.release(repo))
+            else:
+                bulkhead.release(repo)
+            return response
+        return _wrapped_view
+    return decorator
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import re
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.encoding import force_text
+
+from .instrumentation import instrumented
+from .utils import iter_git_lines
+
+# Budgets for the patches rendered inline in the commit page; files past
+# them are loaded on demand, one by one.
+DIFF_MAX_FILES = getattr(settings, 'GITLIST_DIFF_MAX_FILES', 100)
+DIFF_MAX_LINES = getattr(settings, 'GITLIST_DIFF_MAX_LINES', 5000)
+DIFF_MAX_BYTES = getattr(settings, 'GITLIST_DIFF_MAX_BYTES', 512 * 1024)
+# Single file patches bigger than this are never rendered.
+DIFF_MAX_FILE_LINES = getattr(settings, 'GITLIST_DIFF_MAX_FILE_LINES', 20000)
+
+CHUNK_RE = re.compile(br'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+DiffLine = namedtuple('DiffLine', 'getType getNumOld getNumNew getLine')
+
+
+class FileDiff(object):
+    """
+    A file changed by a commit. ``lines`` is None until its patch has been
+    loaded, and stays None when the patch is over the budgets (in which
+    case ``too_large`` is set).
+    """
+    __slots__ = ('file', 'old_file', 'added', 'deleted', 'binary', 'index', 'lines', 'too_large')
+
+    def __init__(self, file, old_file, added, deleted):
+        self.file = file
+        self.old_file = old_file
+        self.added = added
+        self.deleted = deleted
+        self.binary = added is None
+        self.index = ''
+        self.lines = None
+        self.too_large = False
+
+    @property
+    def renamed(self):
+        return self.old_file != self.file
+
+
+def _diff_args(parent, commit, paths):
+    args = ['-M', '--no-color', parent, commit]
+    if paths:
+        args.append('--')
+        args.extend(paths)
+    return args
+
+
+def get_changed_files(repository, parent, commit, paths=()):
+    """
+    Returns the list of FileDiff changed between parent and commit (with
+    their line stats but without patches) from a single ``git diff --numstat``.
+    """
+    output = repository.git.diff('--numstat', '-z', *_diff_args(parent, commit, paths))
+    tokens = output.split(b'\0')
+    files = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        if not token:
+            continue
+        added, deleted, name = token.split(b'\t', 2)
+        if name:
+            old_name = name
+        else:
+            old_name, name = tokens[i], tokens[i + 1]
+            i += 2
+        files.append(FileDiff(
+            force_text(name, errors='replace'),
+            force_text(old_name, errors='replace'),
+            None if added == b'-' else int(added),
+            None if deleted == b'-' else int(deleted),
+        ))
+    return files
+
+
+def _parse_patch(files, lines, max_lines, max_bytes, max_file_lines):
+    """
+    Fills in the lines of files (in the order git outputs them) from the
+    lines of a patch, stopping as soon as the budgets are exhausted.
+    """
+    files = iter(files)
+    current = None
+    buffer = []
+    total_lines = 0
+    total_bytes = 0
+    num_old = num_new = 0
+
+    def flush():
+        if current is not None and not current.too_large:
+            current.lines = buffer
+
+    for line in lines:
+        if line.startswith(b'diff --git '):
+            flush()
+            current = next(files, None)
+            if current is None:
+                return
+            buffer = []
+            continue
+        if current is None or current.too_large:
+            continue
+
+        if line.startswith(b'new file mode '):
+            diff_line = DiffLine('chunk', '', '', "new file, mode %s" % force_text(line[14:]))
+        elif line.startswith(b'deleted file mode '):
+            diff_line = DiffLine('chunk', '', '', "file deleted")
+        elif line.startswith(b'rename to '):
+            diff_line = DiffLine('chunk', '', '', "file renamed from %s to %s" % (current.old_file, current.file))
+        elif line.startswith(b'index '):
+            current.index = force_text(line)
+            continue
+        elif line.startswith(b'Binary files '):
+            diff_line = DiffLine('chunk', '', '', "Binary content")
+        else:
+            chunk = CHUNK_RE.match(line)
+            if chunk:
+                num_old = int(chunk.group(1))
+                num_new = int(chunk.group(3))
+                diff_line = DiffLine('chunk', '...', '...', force_text(line, errors='replace'))
+            elif line[:4] in (b'--- ', b'+++ '):
+                continue
+            elif line[:1] == b'-':
+                diff_line = DiffLine('old', num_old, '', force_text(line, errors='replace'))
+                num_old += 1
+            elif line[:1] == b'+':
+                diff_line = DiffLine('new', '', num_new, force_text(line, errors='replace'))
+                num_new += 1
+            elif line[:1] == b' ':
+                diff_line = DiffLine(None, num_old, num_new, force_text(line, errors='replace'))
+                num_old += 1
+                num_new += 1
+            else:
+                continue
+
+        if len(buffer) >= max_file_lines:
+            current.too_large = True
+            buffer = []
+            continue
+        total_lines += 1
+        total_bytes += len(line)
+        if total_lines > max_lines or total_bytes > max_bytes:
+            # This file (and the ones after it) will be loaded on demand
+            return
+        buffer.append(diff_line)
+    flush()
+
+
+@instrumented('diff')
+def load_commit_diffs(repository, parent, commit, path=''):
+    """
+    Returns the files changed by commit (relative to parent), with the
+    patches of the first ones loaded, as long as they fit in the budgets.
+    Only as much of the ``git diff`` output as fits is ever read.
+    """
+    paths = [path] if path else []
+    files = get_changed_files(repository, parent, commit, paths)
+    if files:
+        lines = iter_git_lines(repository, 'diff', *_diff_args(parent, commit, paths))
+        _parse_patch(files[:DIFF_MAX_FILES], lines, DIFF_MAX_LINES, DIFF_MAX_BYTES, DIFF_MAX_FILE_LINES)
+    return files
+
+
+@instrumented('diff')
+def load_file_diff(repository, parent, commit, file, old_file=None):
+    """
+    Returns the FileDiff of a single file changed by commit, with its patch
+    loaded unless it's over GITLIST_DIFF_MAX_FILE_LINES, or None if commit
+    didn't change file.
+    """
+    paths = [file] if not old_file or old_file == file else [old_file, file]
+    files = get_changed_files(repository, parent, commit, paths)
+    for diff in files:
+        if diff.file == file:
+            lines = iter_git_lines(repository, 'diff', *_diff_args(parent, commit, paths))
+            _parse_patch(files, lines, float('inf'), float('inf'), DIFF_MAX_FILE_LINES)
+            return diff
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import json
+import time
+import inspect
+import logging
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+import git
+
+from django.conf import settings
+
+logger = logging.getLogger('gitlist.requests')
+
+# Upper bounds (in seconds) of the request duration histogram buckets.
+REQUEST_BUCKETS = getattr(settings, 'GITLIST_REQUEST_BUCKETS', (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+_local = threading.local()
+_lock = threading.Lock()
+_operations = {}  # (operation, repo) -> [count, seconds]
+_requests = {}  # (view, repo) -> [bucket counts..., count, seconds]
+_installed = False
+
+
+class RequestMetrics(object):
+    """
+    Counters and timings of the operations run while serving a request.
+    """
+    __slots__ = ('view', 'repo', 'start', 'operations')
+
+    def __init__(self):
+        self.view = ''
+        self.repo = ''
+        self.start = time.time()
+        self.operations = OrderedDict()  # operation -> [count, seconds]
+
+
+def get_request_metrics():
+    return getattr(_local, 'metrics', None)
+
+
+def record(operation, seconds, count=1, metrics=None):
+    """
+    Adds count runs of operation, taking seconds, to the metrics of the
+    current request (or to metrics) and to the process totals.
+    """
+    if metrics is None:
+        metrics = get_request_metrics()
+    repo = ''
+    if metrics is not None:
+        repo = metrics.repo
+        entry = metrics.operations.setdefault(operation, [0, 0.0])
+        entry[0] += count
+        entry[1] += seconds
+    with _lock:
+        entry = _operations.setdefault((operation, repo), [0, 0.0])
+        entry[0] += count
+        entry[1] += seconds
+
+
+def _iter_timed(operation, iterator, metrics):
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - start
+            yield item
+    finally:
+        iterator.close()
+        record(operation, elapsed, metrics=metrics)
+
+
+def instrumented(operation):
+    """
+    Decorator recording the calls to a function as operation. For generator
+    functions, the time spent producing the items is what's recorded (and
+    it's recorded for the request which called them, even when they're
+    consumed later on, as streaming responses are).
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                return _iter_timed(operation, func(*args, **kwargs), get_request_metrics())
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    record(operation, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def _git_operation(command):
+    for arg in command[1:]:
+        if not arg.startswith('-'):
+            return 'git.%s' % arg
+    return 'git'
+
+
+def install():
+    """
+    Instruments GitPython, so every git subprocess (by git command) and
+    every object read through ``data_stream`` is recorded. For commands run
+    with ``as_process``, only starting the process is timed.
+    """
+    global _installed
+    with _lock:
+        if _installed:
+            return
+        _installed = True
+
+    execute = git.cmd.Git.execute
+    data_stream = git.objects.base.Object.data_stream
+
+    def instrumented_execute(self, command, *args, **kwargs):
+        start = time.time()
+        try:
+            return execute(self, command, *args, **kwargs)
+        finally:
+            record(_git_operation(command), time.time() - start)
+
+    def instrumented_data_stream(self):
+        start = time.time()
+        try:
+            return data_stream.fget(self)
+        finally:
+            record('data_stream', time.time() - start)
+
+    git.cmd.Git.execute = instrumented_execute
+    git.objects.base.Object.data_stream = property(instrumented_data_stream)
+
+
+def _record_request(metrics, duration):
+    key = (metrics.view, metrics.repo)
+    with _lock:
+        entry = _requests.get(key)
+        if entry is None:
+            entry = _requests[key] = [0] * len(REQUEST_BUCKETS) + [0, 0.0]
+        for i, bound in enumerate(REQUEST_BUCKETS):
+            if duration <= bound:
+                entry[i] += 1
+        entry[-2] += 1
+        entry[-1] += duration
+
+
+def format_server_timing(metrics, duration):
+    timings = ['%s;dur=%.1f;desc="%d"' % (operation, seconds * 1000, count)
+               for operation, (count, seconds) in metrics.operations.items()]
+    timings.append('total;dur=%.1f' % (duration * 1000))
+    return ', '.join(timings)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Collects the metrics of every request: they're sent back in the
+    ``Server-Timing`` header, logged (as JSON) to the ``gitlist.requests``
+    logger and added to the totals served by the ``metrics`` view.
+
+    The time spent streaming the response body isn't part of the request
+    duration, although the operations run while streaming are recorded.
+    """
+    def __init__(self):
+        install()
+
+    def process_request(self, request):
+        _local.metrics = RequestMetrics()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = get_request_metrics()
+        if metrics is not None:
+            metrics.view = getattr(view_func, '__name__', '')
+            repo = view_kwargs.get('repo')
+            # Only configured repositories, so labels are bounded
+            if repo in settings.GITLIST_REPOSITORIES:
+                metrics.repo = repo
+
+    def process_response(self, request, response):
+        metrics = get_request_metrics()
+        if metrics is None:
+            return response
+        _local.metrics = None
+        duration = time.time() - metrics.start
+        _record_request(metrics, duration)
+        response['Server-Timing'] = format_server_timing(metrics, duration)
+        logger.info(json.dumps(OrderedDict((
+            ('method', request.method),
+            ('path', request.path),
+            ('view', metrics.view),
+            ('repo', metrics.repo),
+            ('status', response.status_code),
+            ('duration', round(duration, 6)),
+            ('operations', OrderedDict((operation, dict(count=count, seconds=round(seconds, 6)))
+                                       for operation, (count, seconds) in metrics.operations.items())),
+        ))))
+        return response
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in sorted(labels.items()))
+
+
+def format_metrics():
+    """
+    Returns the process totals in the Prometheus text exposition format.
+    """
+    with _lock:
+        operations = sorted((key, list(value)) for key, value in _operations.items())
+        requests = sorted((key, list(value)) for key, value in _requests.items())
+
+    lines = [
+        '# HELP gitlist_operations_total Operations (git commands, object reads, history walks...) run.',
+        '# TYPE gitlist_operations_total counter',
+    ]
+    for (operation, repo), (count, seconds) in operations:
+        lines.append('gitlist_operations_total%s %d' % (_labels(operation=operation, repo=repo), count))
+    lines.extend([
+        '# HELP gitlist_operation_seconds_total Time spent running operations.',
+        '# TYPE gitlist_operation_seconds_total counter',
+    ])
+    for (operation, repo), (count, seconds) in operations:
+        lines.append('gitlist_operation_seconds_total%s %f' % (_labels(operation=operation, repo=repo), seconds))
+    lines.extend([
+        '# HELP gitlist_request_duration_seconds Time spent serving requests, by view.',
+        '# TYPE gitlist_request_duration_seconds histogram',
+    ])
+    for (view, repo), entry in requests:
+        for bound, count in zip(REQUEST_BUCKETS, entry):
+            lines.append('gitlist_request_duration_seconds_bucket%s %d' % (_labels(view=view, repo=repo, le='%g' % bound), count))
+        lines.append('gitlist_request_duration_seconds_bucket%s %d' % (_labels(view=view, repo=repo, le='+Inf'), entry[-2]))
+        lines.append('gitlist_request_duration_seconds_sum%s %f' % (_labels(view=view, repo=repo), entry[-1]))
+        lines.append('gitlist_request_duration_seconds_count%s %d' % (_labels(view=view, repo=repo), entry[-2]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import importlib
+import threading
+import traceback
+import subprocess
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+from django.utils.encoding import force_bytes
+
+from . import utils
+from .cache import CACHE_DIR, SQLiteDatabase
+
+# Run the expensive views (stats, searches and archives) as background
+# jobs, queued in a store shared by every process and run by worker
+# processes (GITLIST_JOB_WORKERS per web process, started with
+# GITLIST_JOB_PYTHON) instead of the request thread.
+JOBS = getattr(settings, 'GITLIST_JOBS', False)
+JOB_WORKERS = getattr(settings, 'GITLIST_JOB_WORKERS', 2)
+JOB_PYTHON = getattr(settings, 'GITLIST_JOB_PYTHON', sys.executable)
+# Seconds after which a job still running (its worker may have died) is
+# queued again, and seconds finished jobs are kept.
+JOB_TIMEOUT = getattr(settings, 'GITLIST_JOB_TIMEOUT', 600)
+JOB_EXPIRY = getattr(settings, 'GITLIST_JOB_EXPIRY', 24 * 60 * 60)
+# Seconds before a failed job is run again, doubled after every failure.
+JOB_RETRY = getattr(settings, 'GITLIST_JOB_RETRY', 60)
+# Seconds between reloads of the pages waiting for a job, and between
+# checks for new jobs by idle workers.
+JOB_REFRESH = getattr(settings, 'GITLIST_JOB_REFRESH', 2)
+JOB_POLL = 0.5
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+
+class JobFailed(Exception):
+    """
+    Raised for jobs which failed (with their traceback) until they're due
+    to be run again.
+    """
+
+
+class JobStore(SQLiteDatabase):
+    """
+    The queue of jobs, with the state, (pickled) call and result of every
+    job, shared by all the web and worker processes.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, state TEXT, call BLOB, result BLOB, '
+        'queued REAL, started REAL, finished REAL, failures INTEGER DEFAULT 0)',
+        'CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (state, queued)',
+    )
+
+    def get(self, key):
+        """
+        Returns the (state, result, finished, failures) of job key, or None.
+        """
+        row = self.execute('SELECT state, result, finished, failures FROM jobs WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        state, result, finished, failures = row
+        if result is not None:
+            result = pickle.loads(bytes(result))
+        return state, result, finished, failures
+
+    def queue(self, key, call):
+        """
+        Queues job key, running call, returning whether this call did it (so
+        any given job is only queued once).
+        """
+        now = time.time()
+        self.execute('DELETE FROM jobs WHERE finished < ?', (now - JOB_EXPIRY,))
+        call = sqlite3.Binary(pickle.dumps(call, pickle.HIGHEST_PROTOCOL))
+        cursor = self.execute('INSERT OR IGNORE INTO jobs (key, state, call, queued) VALUES (?, ?, ?, ?)', (key, PENDING, call, now))
+        return cursor.rowcount == 1
+
+    def retry(self, key, finished):
+        """
+        Queues the failed job key, which finished at finished, again.
+        """
+        self.execute('UPDATE jobs SET state = ?, result = NULL, queued = ?, started = NULL, finished = NULL '
+                     'WHERE key = ? AND state = ? AND finished = ?', (PENDING, time.time(), key, FAILED, finished))
+
+    def take(self):
+        """
+        Marks the oldest pending job as running (as of now), returning its
+        (key, (repo, function module, function name, args)), or None. Jobs
+        running for longer than JOB_TIMEOUT are pending again first.
+        """
+        now = time.time()
+        self.execute('UPDATE jobs SET state = ? WHERE state = ? AND started < ?', (PENDING, RUNNING, now - JOB_TIMEOUT))
+        while True:
+            row = self.execute('SELECT key, call FROM jobs WHERE state = ? ORDER BY queued LIMIT 1', (PENDING,)).fetchone()
+            if row is None:
+                return None
+            # Other workers may have taken it in between
+            cursor = self.execute('UPDATE jobs SET state = ?, started = ? WHERE key = ? AND state = ?', (RUNNING, now, row[0], PENDING))
+            if cursor.rowcount == 1:
+                return row[0], pickle.loads(bytes(row[1]))
+
+    def finish(self, key, state, result):
+        result = sqlite3.Binary(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        self.execute('UPDATE jobs SET state = ?, result = ?, finished = ?, failures = failures + ? WHERE key = ?',
+                     (state, result, time.time(), 1 if state == FAILED else 0, key))
+
+    def delete(self, key):
+        self.execute('DELETE FROM jobs WHERE key = ?', (key,))
+
+
+job_store = JobStore(os.path.join(CACHE_DIR, 'job_queue.sqlite3'))
+
+_lock = threading.Lock()
+_workers = []  # Worker processes started by this process
+
+
+def _start_workers():
+    """
+    Starts worker processes until JOB_WORKERS of them are running.
+
+    Workers are new interpreters running this module (rather than forked
+    copies of a web process, with its threads, locks, sqlite connections
+    and git processes in whatever state they were). They take the jobs
+    queued by any process, one after the other, and exit along with the
+    process which started them.
+    """
+    with _lock:
+        _workers[:] = [worker for worker in _workers if worker.poll() is None]
+        while len(_workers) < JOB_WORKERS:
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+            _workers.append(subprocess.Popen([JOB_PYTHON, '-m', 'gitlist.jobs', str(os.getpid())], env=env, close_fds=True))
+
+
+def run_next():
+    """
+    Runs the oldest pending job, returning False if there was none.
+    """
+    job = job_store.take()
+    if job is None:
+        return False
+    key, (repo, module, name, args) = job
+    try:
+        func = getattr(importlib.import_module(module), name)
+        result = func(utils.get_repository_from_name(repo), *args)
+    except Exception:
+        job_store.finish(key, FAILED, traceback.format_exc())
+    else:
+        job_store.finish(key, DONE, result)
+    return True
+
+
+def run_worker(parent):
+    """
+    Runs jobs as they're queued (in a worker process), until the process
+    parent exits.
+    """
+    while os.getppid() == parent:
+        if not run_next():
+            time.sleep(JOB_POLL)
+
+
+def get_job_key(repo, func, args):
+    return hashlib.md5(force_bytes(repr((repo, func.__module__, func.__name__, args)))).hexdigest()
+
+
+def run_job(repository, repo, func, *args):
+    """
+    Returns (done, result) of ``func(repository, *args)``. func must be a
+    module level function and args plain values (shas rather than refs,
+    unless the function is fine with them moving), as they identify the job.
+
+    With GITLIST_JOBS, func runs in a worker process: the first call only
+    queues it (and returns done False), identical calls share the same job
+    while it's queued or running, and later calls get its result. Calls for
+    a job which failed raise JobFailed, until it's due to be run again.
+    """
+    if not JOBS:
+        return True, func(repository, *args)
+
+    key = get_job_key(repo, func, args)
+    job = job_store.get(key)
+    if job is None:
+        job_store.queue(key, (repo, func.__module__, func.__name__, args))
+    elif job[0] == DONE:
+        return True, job[1]
+    elif job[0] == FAILED:
+        _, error, finished, failures = job
+        if time.time() < finished + JOB_RETRY * 2 ** (failures - 1):
+            raise JobFailed(error)
+        job_store.retry(key, finished)
+    _start_workers()
+    return False, None
+
+
+if __name__ == '__main__':
+    run_worker(int(sys.argv[1]))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+import json
+import shutil
+import tempfile
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from gitlist.benchmark import RepositoryGenerator, run_benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmarks every gitlist view against a generated (or an existing) repository."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--commits', type='int', default=500, help="Number of commits to generate."),
+        make_option('--files', type='int', default=200, help="Number of files to generate."),
+        make_option('--depth', type='int', default=3, help="Maximum directory depth of the files."),
+        make_option('--tags', type='int', default=20, help="Number of tags to generate."),
+        make_option('--blob-size', type='int', default=2048, help="Size of the generated blobs, in bytes."),
+        make_option('--merges', type='int', default=5, help="Number of wide merges to generate."),
+        make_option('--merge-width', type='int', default=3, help="Number of parents of each merge."),
+        make_option('--seed', type='int', default=0, help="Seed of the generated contents."),
+        make_option('--path', help="Generate the repository here, and keep it (instead of a temporary directory)."),
+        make_option('--repository', help="Benchmark this existing repository instead of generating one."),
+        make_option('--runs', type='int', default=5, help="Number of (warm) requests per view."),
+        make_option('--views', help="Comma separated names of the views to benchmark (all by default)."),
+        make_option('--output', help="Write the results to this file (instead of the standard output)."),
+    )
+
+    def handle(self, *args, **options):
+        path = options['repository']
+        temporary = None
+        if path is None:
+            path = options['path']
+            if path is None:
+                temporary = tempfile.mkdtemp(prefix='gitlist-benchmark-')
+                path = os.path.join(temporary, 'benchmark.git')
+            elif os.path.exists(path):
+                raise CommandError("%s already exists" % path)
+            generator = RepositoryGenerator(
+                commits=options['commits'], files=options['files'], depth=options['depth'],
+                tags=options['tags'], blob_size=options['blob_size'], merges=options['merges'],
+                merge_width=options['merge_width'], seed=options['seed'],
+            )
+            generator.generate(path)
+
+        settings.GITLIST_REPOSITORIES = dict(settings.GITLIST_REPOSITORIES, benchmark=path)
+        if 'testserver' not in settings.ALLOWED_HOSTS:
+            settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['testserver']
+        views = options['views'].split(',') if options['views'] else None
+        try:
+            results = run_benchmark('benchmark', runs=options['runs'], views=views)
+        finally:
+            if temporary is not None:
+                shutil.rmtree(temporary, ignore_errors=True)
+
+        output = json.dumps(dict(options=options, views=results), indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .cache import LRUCache
+from .utils import REPOSITORY_POOL_SIZE, get_ref_snapshot
+
+# Branches and tags listed in the menu (each); the rest are found by
+# filtering on the server.
+REF_MENU_LIMIT = getattr(settings, 'GITLIST_REF_MENU_LIMIT', 100)
+
+ref_menus = LRUCache(REPOSITORY_POOL_SIZE)
+
+
+def filter_refs(names, query='', limit=REF_MENU_LIMIT):
+    """
+    Returns the first limit names containing query (case insensitively)
+    and the number of names left out.
+    """
+    if query:
+        query = query.lower()
+        names = [name for name in names if query in name.lower()]
+    return names[:limit], max(0, len(names) - limit)
+
+
+def render_ref_menu(repo, snapshot, query='', filterable=False):
+    branches, more_branches = filter_refs(snapshot.branches, query)
+    tags, more_tags = filter_refs(snapshot.tags, query)
+    return render_to_string('ref_menu.html', {
+        'repo': repo,
+        'branches': branches,
+        'more_branches': more_branches,
+        'tags': tags,
+        'more_tags': more_tags,
+        'filterable': filterable,
+    })
+
+
+def get_ref_menu(repository, repo):
+    """
+    Returns the rendered items of the branch and tag menu of repository.
+    They're rendered once per refs change, from the shared RefSnapshot.
+    """
+    snapshot = get_ref_snapshot(repository)
+    cached = ref_menus.get(repo)
+    if cached is not None and cached[0] is snapshot:
+        return cached[1]
+    filterable = len(snapshot.branches) > REF_MENU_LIMIT or len(snapshot.tags) > REF_MENU_LIMIT
+    menu = mark_safe(render_ref_menu(repo, snapshot, filterable=filterable))
+    ref_menus.set(repo, (snapshot, menu))
+    return menu
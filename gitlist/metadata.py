@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+import time
+import datetime
+import warnings
+import threading
+from multiprocessing.pool import ThreadPool
+
+import git
+
+from django.conf import settings
+from django.utils.encoding import force_text
+
+from .utils import get_refs_stamp
+
+METADATA_THREADS = getattr(settings, 'GITLIST_METADATA_THREADS', 8)
+# Seconds between checks for repositories whose refs changed.
+METADATA_REFRESH = getattr(settings, 'GITLIST_METADATA_REFRESH', 10)
+
+_lock = threading.Lock()
+_pool = None
+_metadata = {}  # name -> (path, refs stamp, metadata dict or None)
+_refreshing = False
+_checked = 0
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPool(METADATA_THREADS)
+        return _pool
+
+
+def _read_metadata(name, path):
+    """
+    Reads the description, default branch, last commit and size of the
+    repository at path. Returns None if it isn't a valid repository.
+    """
+    try:
+        repository = git.Repo(path)
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError) as e:
+        warnings.warn("Repository error: %s" % e)
+        return None
+    try:
+        metadata = dict(name=name, description=repository.description, branch=None, date=None, author=None, size=None)
+
+        head = repository.head
+        if not head.is_detached:
+            metadata['branch'] = head.reference.name
+        status, output, _ = repository.git.log('-1', '--format=%ct%x00%an', with_extended_output=True, with_exceptions=False)
+        if status == 0 and output:
+            timestamp, author = output.split(b'\0', 1)
+            metadata['date'] = datetime.datetime.fromtimestamp(int(timestamp))
+            metadata['author'] = force_text(author, errors='replace')
+
+        size = 0
+        for line in repository.git.count_objects('-v').splitlines():
+            key, _, value = line.partition(b': ')
+            if key in (b'size', b'size-pack'):
+                size += int(value) * 1024
+        metadata['size'] = size
+        return metadata
+    finally:
+        repository.git.clear_cache()
+
+
+def _refresh(name, path):
+    path = os.path.expanduser(path)
+    git_dir = os.path.join(path, '.git')
+    stamp = get_refs_stamp(git_dir if os.path.isdir(git_dir) else path)
+    cached = _metadata.get(name)
+    if cached is not None and cached[0] == path and cached[1] == stamp:
+        return
+    _metadata[name] = (path, stamp, _read_metadata(name, path))
+
+
+def _refresh_all(repositories):
+    global _refreshing
+    try:
+        _get_pool().map(lambda item: _refresh(*item), repositories)
+    finally:
+        _refreshing = False
+
+
+def get_repositories_metadata():
+    """
+    Returns the metadata of the configured repositories (a list of dicts
+    with name, description, branch, date and author of the last commit and
+    size) from memory.
+
+    At most every GITLIST_METADATA_REFRESH seconds, the repositories whose
+    refs changed are re-read in the background by a thread pool; only the
+    repositories never seen before are waited for.
+    """
+    global _refreshing, _checked
+    repositories = list(settings.GITLIST_REPOSITORIES.items())
+
+    # Repositories never seen before (or moved) are waited for
+    missing = [(name, path) for name, path in repositories
+               if name not in _metadata or _metadata[name][0] != os.path.expanduser(path)]
+    if missing:
+        _get_pool().map(lambda item: _refresh(*item), missing)
+
+    now = time.time()
+    with _lock:
+        start = not _refreshing and now - _checked > METADATA_REFRESH
+        if start:
+            _refreshing = True
+            _checked = now
+    if start:
+        thread = threading.Thread(target=_refresh_all, args=(repositories,))
+        thread.daemon = True
+        thread.start()
+
+    result = []
+    for name, _ in repositories:
+        metadata = _metadata[name][2]
+        if metadata is not None:
+            result.append(metadata)
+    return result
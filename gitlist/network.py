@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import re
+from hashlib import md5
+
+from django.conf import settings
+
+from .cache import get_store
+from .commits import iter_commits
+from .instrumentation import instrumented
+
+NETWORK_CHUNK_SIZE = getattr(settings, 'GITLIST_NETWORK_CHUNK_SIZE', 500)
+
+LANES_RE = re.compile(r'^(?:[0-9a-f]{40})?(?:,(?:[0-9a-f]{40})?)*$')
+
+
+def parse_lanes(value):
+    """
+    Parses the ``lanes`` cursor of a network chunk: the sha each lane is
+    waiting for, or None for free lanes. Returns None if value isn't one.
+    """
+    if value is None or not LANES_RE.match(value):
+        return None
+    return [sha or None for sha in value.split(',')]
+
+
+def format_lanes(lanes):
+    return ','.join(sha or '' for sha in lanes)
+
+
+def _free_lane(lanes):
+    try:
+        return lanes.index(None)
+    except ValueError:
+        lanes.append(None)
+        return len(lanes) - 1
+
+
+def layout_commits(commits, lanes):
+    """
+    Assigns lanes to commits (in topological order), updating lanes, the
+    list of the commit each lane is waiting for, as it goes.
+
+    A commit takes the leftmost lane waiting for it (freeing the others,
+    which merge into it) or the first free one, and then waits there for its
+    first parent; other parents take the lane already waiting for them or a
+    new one. Returns a list of (commit, lane, parent lanes) where parent
+    lanes are the lanes the edges to each parent run along.
+    """
+    rows = []
+    for commit in commits:
+        lane = None
+        for i, sha in enumerate(lanes):
+            if sha == commit.hexsha:
+                if lane is None:
+                    lane = i
+                else:
+                    lanes[i] = None
+        if lane is None:
+            lane = _free_lane(lanes)
+
+        parents = commit.parents
+        lanes[lane] = parents[0] if parents else None
+        parent_lanes = [lane] if parents else []
+        for parent in parents[1:]:
+            try:
+                i = lanes.index(parent)
+            except ValueError:
+                i = _free_lane(lanes)
+                lanes[i] = parent
+            parent_lanes.append(i)
+
+        while lanes and lanes[-1] is None:
+            lanes.pop()
+        rows.append((commit, lane, parent_lanes))
+    return rows
+
+
+@instrumented('network')
+def get_network_chunk(repository, commitish, path='', lanes=None, size=NETWORK_CHUNK_SIZE):
+    """
+    Returns a chunk of the laid out history of commitish touching path, as
+    a list of (sha, lane, parents, parent lanes, date, summary, author name,
+    author email), and the lanes cursor of the next chunk (None for the
+    last one). lanes is the cursor returned with the previous chunk, or
+    None for the first one.
+
+    The lanes cursor is the whole state of the layout (the commits it waits
+    for are the frontier of the history walk), so chunks are computed
+    independently, and cached per (frontier, path, lanes): only the first
+    chunk depends on the tip of commitish, the ones after it stay cached
+    when new commits are pushed on top.
+    """
+    if lanes is None:
+        revs = [repository.commit(commitish).hexsha]
+        lanes = []
+    else:
+        revs = []
+        for lane in lanes:
+            if lane and lane not in revs:
+                revs.append(lane)
+        if not revs:
+            return [], None
+
+    store = get_store(repository, 'network')
+    key = 'chunk:%s' % md5(('%s:%s:%s:%d' % (','.join(revs), path, format_lanes(lanes), size)).encode('utf-8')).hexdigest()
+    chunk = store.get(key)
+    if chunk is None:
+        commits = list(iter_commits(repository, revs, path, max_count=size + 1, topo_order=True))
+        lanes = list(lanes)
+        rows = [(
+            commit.hexsha, lane, commit.parents, parent_lanes, commit.authored_date,
+            commit.summary, commit.author.name, commit.author.email,
+        ) for commit, lane, parent_lanes in layout_commits(commits[:size], lanes)]
+        chunk = (rows, lanes if len(commits) > size else None)
+        store.set(key, chunk)
+    return chunk
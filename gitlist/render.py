@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+
+from django.conf import settings
+from django.utils.encoding import force_text
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .cache import LRUCache, LRUDiskStore, get_store
+from .const import DEFAULT_FILE_TYPES
+
+try:
+    import markdown
+    MARKDOWN_VERSION = getattr(markdown, '__version_info__', None) or markdown.version_info
+except ImportError:
+    markdown = MARKDOWN_VERSION = None
+
+try:
+    import bleach
+except ImportError:
+    bleach = None
+
+try:
+    import pygments
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_for_filename
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments = None
+
+# Bump whenever the rendered output changes, so cached fragments are redone.
+RENDER_VERSION = 2
+# Fragments kept in memory, and on disk per repository.
+RENDER_CACHE_SIZE = getattr(settings, 'GITLIST_RENDER_CACHE_SIZE', 100)
+RENDER_STORE_ENTRIES = getattr(settings, 'GITLIST_RENDER_STORE_ENTRIES', 5000)
+
+# The HTML allowed in rendered markdown (whether written by markdown or
+# found in the source).
+MARKDOWN_TAGS = [
+    'a', 'abbr', 'b', 'blockquote', 'br', 'code', 'dd', 'del', 'div', 'dl', 'dt', 'em',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'kbd', 'li', 'ol', 'p', 'pre',
+    's', 'span', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'th', 'thead', 'tr', 'ul',
+]
+MARKDOWN_ATTRIBUTES = {
+    '*': ['title'],
+    'a': ['href'],
+    'code': ['class'],
+    'img': ['src', 'alt'],
+    'td': ['align'],
+    'th': ['align'],
+}
+MARKDOWN_PROTOCOLS = ['http', 'https', 'mailto']
+
+render_cache = LRUCache(RENDER_CACHE_SIZE)
+
+
+class RenderStore(LRUDiskStore):
+    max_entries = RENDER_STORE_ENTRIES
+
+
+def _render_markdown(text):
+    # Markdown 3 dropped safe_mode, so raw HTML in the source goes through:
+    # the output is sanitized with bleach, and without it only the older
+    # versions (which still escape raw HTML) render on the server.
+    if markdown is None:
+        return None
+    if bleach is not None:
+        html = markdown.markdown(text, extensions=['tables', 'fenced_code'])
+        return bleach.clean(html, tags=MARKDOWN_TAGS, attributes=MARKDOWN_ATTRIBUTES, protocols=MARKDOWN_PROTOCOLS)
+    if MARKDOWN_VERSION < (3,):
+        return markdown.markdown(text, extensions=['tables', 'fenced_code'], safe_mode='escape')
+    return None
+
+
+def _render_source(text, filename):
+    if pygments is None:
+        return None
+    try:
+        lexer = get_lexer_for_filename(filename, stripnl=False)
+    except ClassNotFound:
+        return None
+    formatter = HtmlFormatter(linenos='table', lineanchors='L', anchorlinenos=True, cssclass='highlight')
+    return pygments.highlight(text, lexer, formatter)
+
+
+def get_highlight_css():
+    """
+    Returns the stylesheet for highlighted source fragments.
+    """
+    if pygments is None:
+        return ''
+    return HtmlFormatter(cssclass='highlight').get_style_defs('.highlight')
+
+
+def render_blob(repository, blob, markdown_file=None):
+    """
+    Returns the fragment showing blob: a dict with its ``html`` and whether
+    it was ``rendered`` on the server (sanitized markdown when the markdown
+    package is installed, along with bleach for markdown 3 and later, and
+    highlighted source with pygments), or just escaped for the
+    browser to render. Markdown files are told by their extension unless
+    markdown_file is given.
+
+    Fragments only depend on the blob contents and the renderer, so they are
+    cached per (RENDER_VERSION, renderer, blob sha), in memory and on disk
+    (the GITLIST_RENDER_STORE_ENTRIES most recently used ones).
+    """
+    if markdown_file is None:
+        markdown_file = DEFAULT_FILE_TYPES.get(os.path.splitext(blob.name)[1], '') == 'markdown'
+    kind = 'markdown' if markdown_file else 'source:%s' % blob.name
+    key = 'render:%d:%s:%s' % (RENDER_VERSION, kind, blob.hexsha)
+
+    fragment = render_cache.get(key)
+    if fragment is None:
+        store = get_store(repository, 'render', RenderStore)
+        fragment = store.get(key)
+        if fragment is None:
+            text = force_text(blob.data_stream.read(), errors='replace')
+            if kind == 'markdown':
+                html = _render_markdown(text)
+            else:
+                html = _render_source(text, blob.name)
+            fragment = dict(html=html or escape(text), rendered=html is not None)
+            store.set(key, fragment)
+        render_cache.set(key, fragment)
+    return dict(fragment, html=mark_safe(fragment['html']))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.http import HttpResponse, CompatibleStreamingHttpResponse
+
+from .cache import CACHE_DIR
+
+FILE_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+# Requests asking for more ranges than this get the whole file instead.
+MAX_RANGES = 16
+
+# Let the web server send cached files: 'X-Sendfile' (Apache, lighttpd) or
+# 'X-Accel-Redirect' (nginx, which also needs GITLIST_SENDFILE_URL to be
+# the internal location aliasing GITLIST_CACHE_DIR).
+SENDFILE_HEADER = getattr(settings, 'GITLIST_SENDFILE_HEADER', None)
+SENDFILE_URL = getattr(settings, 'GITLIST_SENDFILE_URL', '/gitlist-cache/')
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range_header(header, size):
+    """
+    Parses an HTTP Range header for a resource of the given size, returning
+    a list of (start, stop) byte ranges (stop exclusive), an empty list if
+    none of the ranges can be satisfied, or None if the header is absent or
+    invalid (and thus must be ignored).
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[6:].split(','):
+        match = RANGE_RE.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            if last:
+                if int(last) < start:
+                    return None
+                stop = min(int(last) + 1, size)
+            else:
+                stop = size
+        elif last:
+            start = max(0, size - int(last))
+            stop = size
+        else:
+            return None
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def get_chunk_size(size):
+    """
+    Returns the chunk size to stream size bytes with: large enough to keep
+    the per chunk overhead low, small enough to keep memory use bounded.
+    """
+    return max(FILE_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size // 16))
+
+
+def iter_file(f, start, stop, chunk_size=FILE_CHUNK_SIZE):
+    f.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _iter_multipart(f, ranges, size, content_type, boundary, chunk_size):
+    for start, stop in ranges:
+        yield ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            boundary, content_type, start, stop - 1, size)).encode('ascii')
+        for chunk in iter_file(f, start, stop, chunk_size):
+            yield chunk
+        yield b'\r\n'
+    yield ('--%s--\r\n' % boundary).encode('ascii')
+
+
+def _closing_iterator(f, iterator):
+    try:
+        for chunk in iterator:
+            yield chunk
+    finally:
+        f.close()
+
+
+def range_response(request, f, size, content_type, etag=None, seekable=True):
+    """
+    Returns a streaming response sending the file object f (of the given
+    size), honoring byte Range requests: a single range is answered with a
+    206, several with a multipart/byteranges 206. Ranges are ignored when
+    If-Range doesn't match etag, and, unless f is seekable (rather than
+    only seekable forward), when they aren't in ascending order. f is
+    closed once sent.
+    """
+    ranges = None
+    if request.method == 'GET':
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if not if_range or (etag and if_range.strip('"') == etag.strip('"')):
+            ranges = parse_range_header(request.META.get('HTTP_RANGE'), size)
+    if ranges and len(ranges) > MAX_RANGES:
+        ranges = None
+    if ranges and not seekable and any(stop > start for (_, stop), (start, _) in zip(ranges, ranges[1:])):
+        ranges = None  # Out of order or overlapping
+    if ranges == []:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    chunk_size = get_chunk_size(size)
+    if ranges and len(ranges) == 1:
+        start, stop = ranges[0]
+        response = CompatibleStreamingHttpResponse(_closing_iterator(f, iter_file(f, start, stop, chunk_size)), status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        response['Content-Length'] = stop - start
+    elif ranges:
+        boundary = uuid.uuid4().hex
+        response = CompatibleStreamingHttpResponse(
+            _closing_iterator(f, _iter_multipart(f, ranges, size, content_type, boundary, chunk_size)),
+            status=206,
+            content_type='multipart/byteranges; boundary=%s' % boundary,
+        )
+    else:
+        response = CompatibleStreamingHttpResponse(_closing_iterator(f, iter_file(f, 0, size, chunk_size)), content_type=content_type)
+        response['Content-Length'] = size
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def file_response(request, path, content_type, filename=None, etag=None):
+    """
+    Returns a response sending the file at path, honoring byte Range
+    requests. Files inside the cache directory are handed over to the web
+    server when GITLIST_SENDFILE_HEADER is set.
+    """
+    if SENDFILE_HEADER and os.path.abspath(path).startswith(os.path.abspath(CACHE_DIR) + os.sep):
+        response = HttpResponse(content_type=content_type)
+        if SENDFILE_HEADER == 'X-Accel-Redirect':
+            response[SENDFILE_HEADER] = SENDFILE_URL + os.path.relpath(path, CACHE_DIR).replace(os.sep, '/')
+        else:
+            response[SENDFILE_HEADER] = path
+    else:
+        f = open(path, 'rb')
+        response = range_response(request, f, os.fstat(f.fileno()).st_size, content_type, etag)
+
+    if filename:
+        response['Content-Disposition'] = 'attachment; filename="{file}"'.format(file=filename)
+    return response
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import re
+import time
+import datetime
+
+from django.conf import settings
+from django.utils.encoding import force_bytes, force_text
+from django.utils.six.moves import range
+from gitdb.util import hex_to_bin
+
+from .cache import LRUCache, SQLiteDatabase, get_store
+from .commits import is_ancestor
+from .instrumentation import instrumented
+from .utils import iter_git_records
+
+SEARCH_MAX_BLOB_SIZE = getattr(settings, 'GITLIST_SEARCH_MAX_BLOB_SIZE', 1024 * 1024)
+SEARCH_CONTEXT_LINES = 2
+# Queries need a trigram to be looked up in the index.
+SEARCH_MIN_QUERY = 3
+# Number of trees whose blobs the trigram index keeps; the least recently
+# searched ones are dropped first, along with the blobs only they held.
+SEARCH_INDEX_TREES = getattr(settings, 'GITLIST_SEARCH_INDEX_TREES', 16)
+
+# Number of blobs indexed per transaction (and sqlite IN clause size)
+BATCH_SIZE = 500
+# Candidates are looked up by (at most) this many of the rarest trigrams of
+# the query; matches are checked against the blob contents anyway.
+QUERY_TRIGRAMS = 8
+# Number of (ref, path) scopes whose commits the commit index keeps; the
+# least recently searched ones are dropped first.
+COMMIT_INDEX_SCOPES = getattr(settings, 'GITLIST_COMMIT_INDEX_SCOPES', 64)
+
+tree_entries_cache = LRUCache(64)
+
+
+def is_binary(content):
+    """
+    Uses the same heuristic git does: a NUL byte in the first 8000 bytes.
+    """
+    return b'\0' in content[:8000]
+
+
+def get_trigrams(content):
+    """
+    Returns the set of (lower cased) byte trigrams in content, each one
+    packed in an integer.
+    """
+    data = bytearray(content.lower())
+    return set((data[i] << 16) | (data[i + 1] << 8) | data[i + 2] for i in range(len(data) - 2))
+
+
+def get_tree_entries(repository, tree_sha):
+    """
+    Returns a list of (path, blob sha, size) for every blob under tree_sha,
+    sorted by path, listed with a single ``git ls-tree``.
+    """
+    entries = tree_entries_cache.get(tree_sha)
+    if entries is None:
+        entries = []
+        output = repository.git.ls_tree('-r', '-l', '-z', tree_sha)
+        for item in output.split(b'\0'):
+            if not item:
+                continue
+            info, path = item.split(b'\t', 1)
+            mode, type, sha, size = info.split()
+            if type == b'blob':
+                entries.append((force_text(path, errors='replace'), force_text(sha), int(size)))
+        tree_entries_cache.set(tree_sha, entries)
+    return entries
+
+
+class TrigramIndex(SQLiteDatabase):
+    """
+    Inverted trigram index over the blobs of a repository. Blobs are keyed
+    by sha, so unchanged files are shared by every branch and commit and
+    only blobs never seen before need to be read when a new tree is
+    searched. Binary and big blobs are recorded as not indexed. Only the
+    blobs of the SEARCH_INDEX_TREES most recently searched trees are kept.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS blobs (id INTEGER PRIMARY KEY, sha TEXT UNIQUE NOT NULL, indexed INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS trigrams (trigram INTEGER NOT NULL, blob INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS trigrams_trigram ON trigrams (trigram)',
+        'CREATE INDEX IF NOT EXISTS trigrams_blob ON trigrams (blob)',
+        'DROP TABLE IF EXISTS trees',
+        'CREATE TABLE IF NOT EXISTS indexed_trees (sha TEXT PRIMARY KEY, used REAL)',
+    )
+
+    def _index_blob(self, repository, sha, size):
+        content = None
+        if size <= SEARCH_MAX_BLOB_SIZE:
+            content = repository.odb.stream(hex_to_bin(sha)).read()
+            if is_binary(content):
+                content = None
+        cursor = self.execute('INSERT OR IGNORE INTO blobs (sha, indexed) VALUES (?, ?)', (sha, content is not None))
+        if cursor.rowcount and content is not None:
+            blob_id = cursor.lastrowid
+            self.executemany('INSERT INTO trigrams (trigram, blob) VALUES (?, ?)', ((trigram, blob_id) for trigram in get_trigrams(content)))
+
+    def update(self, repository, tree_sha, entries):
+        """
+        Indexes the blobs in entries which aren't in the index yet.
+        """
+        now = time.time()
+        if self.execute('UPDATE indexed_trees SET used = ? WHERE sha = ?', (now, tree_sha)).rowcount:
+            return
+
+        sizes = dict((sha, size) for path, sha, size in entries)
+        shas = list(sizes)
+        for i in range(0, len(shas), BATCH_SIZE):
+            batch = shas[i:i + BATCH_SIZE]
+            known = set(row[0] for row in self.execute('SELECT sha FROM blobs WHERE sha IN (%s)' % ','.join('?' * len(batch)), batch))
+            with self.transaction():
+                for sha in batch:
+                    if sha not in known:
+                        self._index_blob(repository, sha, sizes[sha])
+        self.execute('INSERT OR IGNORE INTO indexed_trees (sha, used) VALUES (?, ?)', (tree_sha, now))
+        self._prune(repository)
+
+    def _prune(self, repository):
+        """
+        Drops all but the SEARCH_INDEX_TREES most recently searched trees,
+        and the blobs (with their trigrams) which aren't in any tree kept.
+        """
+        dropped = [row[0] for row in self.execute('SELECT sha FROM indexed_trees ORDER BY used DESC LIMIT -1 OFFSET ?', (SEARCH_INDEX_TREES,))]
+        if not dropped:
+            return
+        self.execute('DELETE FROM indexed_trees WHERE sha IN (%s)' % ','.join('?' * len(dropped)), dropped)
+        kept = set()
+        for row in self.execute('SELECT sha FROM indexed_trees').fetchall():
+            kept.update(sha for path, sha, size in get_tree_entries(repository, row[0]))
+        unused = [blob_id for blob_id, sha in self.execute('SELECT id, sha FROM blobs') if sha not in kept]
+        for i in range(0, len(unused), BATCH_SIZE):
+            batch = unused[i:i + BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            with self.transaction():
+                self.execute('DELETE FROM trigrams WHERE blob IN (%s)' % placeholders, batch)
+                self.execute('DELETE FROM blobs WHERE id IN (%s)' % placeholders, batch)
+
+    def candidates(self, needle):
+        """
+        Returns the set of shas of the indexed blobs which contain every
+        trigram of needle, or None if needle is too short to use the index.
+        """
+        trigrams = list(get_trigrams(needle))
+        if not trigrams:
+            return None
+        counts = {}
+        for i in range(0, len(trigrams), BATCH_SIZE):
+            batch = trigrams[i:i + BATCH_SIZE]
+            counts.update(self.execute(
+                'SELECT trigram, COUNT(*) FROM trigrams WHERE trigram IN (%s) GROUP BY trigram' % ','.join('?' * len(batch)),
+                batch))
+        if len(counts) < len(trigrams):
+            return set()  # Some trigram isn't in any blob
+        trigrams = sorted(trigrams, key=counts.get)[:QUERY_TRIGRAMS]
+        rows = self.execute(
+            'SELECT blobs.sha FROM trigrams JOIN blobs ON blobs.id = trigrams.blob'
+            ' WHERE trigrams.trigram IN (%s) GROUP BY trigrams.blob HAVING COUNT(*) = ?' % ','.join('?' * len(trigrams)),
+            trigrams + [len(trigrams)])
+        return set(row[0] for row in rows)
+
+
+def _format_lines(lines, start, end):
+    return b''.join(b'%d - %s\n' % (i + 1, lines[i]) for i in range(start, end))
+
+
+@instrumented('search_tree')
+def search_tree(repository, tree_sha, query, page=0, per_page=50, path=''):
+    """
+    Searches query in the files under tree_sha (optionally only those in
+    path), returning a page of matching lines, whether there are more and
+    the files which weren't searched for being bigger than
+    GITLIST_SEARCH_MAX_BLOB_SIZE.
+
+    Only the blobs the trigram index reports as candidates are read, and
+    blobs past the requested page are never opened. Queries shorter than
+    SEARCH_MIN_QUERY bytes don't match anything.
+    """
+    entries = get_tree_entries(repository, tree_sha)
+    index = get_store(repository, 'search', TrigramIndex)
+    index.update(repository, tree_sha, entries)
+
+    prefix = path.rstrip('/') + '/' if path else ''
+    skipped = [file for file, sha, size in entries if size > SEARCH_MAX_BLOB_SIZE and file.startswith(prefix)]
+
+    needle = force_bytes(query)
+    candidates = index.candidates(needle)
+    if candidates is None:
+        return [], False, skipped  # Shorter than SEARCH_MIN_QUERY
+
+    start = page * per_page
+    end = start + per_page
+    results = []
+    seen = 0
+    for file, sha, size in entries:
+        if sha not in candidates or not file.startswith(prefix):
+            continue
+        content = repository.odb.stream(hex_to_bin(sha)).read()
+        if needle not in content:
+            continue
+        lines = content.split(b'\n')
+        for i, line in enumerate(lines):
+            pos = line.find(needle)
+            if pos == -1:
+                continue
+            if seen == end:
+                return results, True, skipped
+            if seen >= start:
+                before = _format_lines(lines, max(0, i - SEARCH_CONTEXT_LINES), i)
+                after = _format_lines(lines, i + 1, min(len(lines), i + 1 + SEARCH_CONTEXT_LINES))
+                results.append(dict(
+                    file=file,
+                    line=i + 1,
+                    match=(
+                        force_text(before + b'%d - %s' % (i + 1, line[:pos]), errors='replace'),
+                        force_text(needle, errors='replace'),
+                        force_text(line[pos + len(needle):] + b'\n' + after, errors='replace'),
+                    ),
+                ))
+            seen += 1
+    return results, False, skipped
+
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+DATE_TERM_RE = re.compile(r'^(after|before):(\d{4})-(\d{1,2})-(\d{1,2})$')
+
+COMMIT_LOG_FORMAT = '--format=%H%x1f%an%x1f%ae%x1f%ct%x1f%B'
+
+
+def _timestamp(year, month, day):
+    return int(time.mktime(datetime.date(int(year), int(month), int(day)).timetuple()))
+
+
+class CommitIndex(SQLiteDatabase):
+    """
+    Inverted index over the messages and authors of the commits of a
+    repository.
+
+    Commits and their terms are stored once per repository. What's shared
+    by reachability is the membership: each searched (ref, path) scope keeps
+    the tip it was indexed at and the list of commits reachable from it, so
+    when the ref moves only the commits in ``old..new`` are read (and when
+    those are already known from some other ref, only their membership is
+    recorded). Only the COMMIT_INDEX_SCOPES most recently searched scopes
+    are kept.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS commits (id INTEGER PRIMARY KEY, sha TEXT UNIQUE NOT NULL, date INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS commits_date ON commits (date)',
+        'CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS postings (term INTEGER NOT NULL, commit_id INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS postings_term ON postings (term)',
+        'CREATE TABLE IF NOT EXISTS scopes (id INTEGER PRIMARY KEY, ref TEXT NOT NULL, path TEXT NOT NULL, tip TEXT, used REAL, UNIQUE (ref, path))',
+        'CREATE TABLE IF NOT EXISTS members (scope INTEGER NOT NULL, commit_id INTEGER NOT NULL, UNIQUE (scope, commit_id))',
+        'CREATE INDEX IF NOT EXISTS scopes_used ON scopes (used)',
+    )
+
+    def _term_id(self, term):
+        row = self.execute('SELECT id FROM terms WHERE term = ?', (term,)).fetchone()
+        if row:
+            return row[0]
+        return self.execute('INSERT INTO terms (term) VALUES (?)', (term,)).lastrowid
+
+    def _add_commit(self, record):
+        sha, author, email, date, message = record.split(b'\x1f', 4)
+        sha = force_text(sha)
+        row = self.execute('SELECT id FROM commits WHERE sha = ?', (sha,)).fetchone()
+        if row:
+            return row[0]
+        commit_id = self.execute('INSERT INTO commits (sha, date) VALUES (?, ?)', (sha, int(date))).lastrowid
+        terms = set(WORD_RE.findall(force_text(message, errors='replace').lower()))
+        terms.update('author:' + word for word in WORD_RE.findall(force_text(author + b' ' + email, errors='replace').lower()))
+        postings = [(self._term_id(term), commit_id) for term in terms]
+        self.executemany('INSERT INTO postings (term, commit_id) VALUES (?, ?)', postings)
+        return commit_id
+
+    def update(self, repository, ref, path, sha):
+        """
+        Brings the (ref, path) scope up to date with the commit sha and
+        returns its id.
+        """
+        row = self.execute('SELECT id, tip FROM scopes WHERE ref = ? AND path = ?', (ref, path)).fetchone()
+        if row is None:
+            self.execute('INSERT OR IGNORE INTO scopes (ref, path, used) VALUES (?, ?, ?)', (ref, path, time.time()))
+            scope, tip = self.execute('SELECT id, tip FROM scopes WHERE ref = ? AND path = ?', (ref, path)).fetchone()
+            self._evict(scope)
+        else:
+            scope, tip = row
+            self.execute('UPDATE scopes SET used = ? WHERE id = ?', (time.time(), scope))
+        if tip == sha:
+            return scope
+
+        if tip and is_ancestor(repository, tip, sha):
+            revs = ['%s..%s' % (tip, sha)]
+        else:
+            self.execute('DELETE FROM members WHERE scope = ?', (scope,))
+            revs = [sha]
+        args = ['-z', COMMIT_LOG_FORMAT] + revs
+        if path:
+            args.extend(['--', path])
+
+        batch = []
+        for record in iter_git_records(repository, 'log', *args):
+            batch.append(record)
+            if len(batch) == 1000:
+                self._add_members(scope, batch)
+                batch = []
+        self._add_members(scope, batch)
+        self.execute('UPDATE scopes SET tip = ? WHERE id = ?', (sha, scope))
+        return scope
+
+    def _evict(self, keep):
+        with self.transaction():
+            stale = [row[0] for row in self.execute('SELECT id FROM scopes WHERE id != ? ORDER BY used DESC LIMIT -1 OFFSET ?',
+                                                    (keep, COMMIT_INDEX_SCOPES - 1))]
+            for scope in stale:
+                self.execute('DELETE FROM members WHERE scope = ?', (scope,))
+                self.execute('DELETE FROM scopes WHERE id = ?', (scope,))
+
+    def _add_members(self, scope, records):
+        with self.transaction():
+            members = [(scope, self._add_commit(record)) for record in records]
+            self.executemany('INSERT OR IGNORE INTO members (scope, commit_id) VALUES (?, ?)', members)
+
+    def search(self, scope, query, offset, limit):
+        """
+        Returns the shas of a page of the commits in scope matching query
+        (newest first) and the total number of matches.
+
+        Every word in the query must prefix a word in the commit message;
+        ``author:word`` matches words in the author name or email, and
+        ``after:YYYY-MM-DD`` and ``before:YYYY-MM-DD`` restrict the date.
+        """
+        where = ['members.scope = ?']
+        params = [scope]
+        for word in query.lower().split():
+            match = DATE_TERM_RE.match(word)
+            if match:
+                where.append('commits.date %s ?' % ('>=' if match.group(1) == 'after' else '<'))
+                params.append(_timestamp(*match.groups()[1:]))
+                continue
+            if word.startswith('author:'):
+                terms = ['author:' + w for w in WORD_RE.findall(word[7:])]
+            else:
+                terms = WORD_RE.findall(word)
+            for term in terms:
+                where.append('commits.id IN (SELECT postings.commit_id FROM postings JOIN terms ON terms.id = postings.term WHERE terms.term >= ? AND terms.term < ?)')
+                params.extend([term, term + '\uffff'])
+
+        sql = 'FROM members JOIN commits ON commits.id = members.commit_id WHERE ' + ' AND '.join(where)
+        total = self.execute('SELECT COUNT(*) ' + sql, params).fetchone()[0]
+        rows = self.execute('SELECT commits.sha ' + sql + ' ORDER BY commits.date DESC LIMIT ? OFFSET ?', params + [limit, offset])
+        return [row[0] for row in rows], total
+
+
+@instrumented('search_commits')
+def search_commits(repository, commitish, path, query, offset=0, limit=50, sha=None):
+    """
+    Searches the commits reachable from commitish (touching path) for query,
+    returning the shas in the requested page and the total number of matches.
+    sha is the commit commitish resolves to, if already known.
+    """
+    index = get_store(repository, 'commits', CommitIndex)
+    if sha is None:
+        sha = repository.commit(commitish).hexsha
+    scope = index.update(repository, commitish, path, sha)
+    return index.search(scope, query, offset, limit)
@@ -10,6 +10,7 @@ $(function () {
         }, {
             value: value,
             lineNumbers: true,
+            firstLineNumber: parseInt($('#sourcecode').data('first-line'), 10) || 1,
             matchBrackets: true,
             lineWrapping: true,
             readOnly: true,
@@ -25,8 +26,31 @@ $(function () {
         $('#md-content').html(converter.makeHtml($('#md-content').text()));
     }
 
+    var refFilterTimeout;
+    $('.ref-menu').on('click', '.ref-filter', function (e) {
+        e.stopPropagation();
+    }).on('input', '.ref-filter input', function () {
+        var $menu = $(this).closest('.ref-menu');
+        var query = $(this).val();
+        clearTimeout(refFilterTimeout);
+        refFilterTimeout = setTimeout(function () {
+            $.get($menu.data('source'), {q: query}, function (html) {
+                $menu.children().not('.ref-filter').remove();
+                $menu.append(html);
+            });
+        }, 200);
+    });
+
+    $('.lazy-diff .load-diff').one('click', function (e) {
+        e.preventDefault();
+        var $diff = $(this).closest('.lazy-diff');
+        $.get($diff.data('source'), function (html) {
+            $diff.replaceWith(html);
+        });
+    });
+
     function paginate() {
-        var $pager = $('.pager');
+        var $pager = $('.pager').not('.search-pager');
 
         $pager.find('.next a').one('click', function (e) {
             e.preventDefault();
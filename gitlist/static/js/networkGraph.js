@@ -69,72 +69,7 @@
 	};
 
 	function graphLaneManager() {
-		var that = {},
-			occupiedLanes = [];
-
-		// "private" methods
-		function findLaneNumberFor( commit ) {
-
-			if( commit.lane ) {
-				// oh? we've already got a lane?
-				return commit.lane.number;
-			}
-
-			// find out which lane may draw our dot on. Start with a free one
-			var laneNumber = findFreeLane();
-
-			// if the child is a merge, we need to figure out which lane we may render this commit on.
-			// Rules are simple: A "parent" by the same author as the merge may render on the same line as the child
-			// others take the next free lane.
-			// furthermore, commits in a linear line of events may stay on the same lane, too
-			if( commit.children.length > 0) {
-				if( !commit.children[0].isMerge // linear ...
-					|| ( commit.children[0].isMerge	&& commit.children[0].author.email === commit.author.email ) // same author
-					) {
-					laneNumber = commit.children[0].lane.number;
-				}
-			}
-
-			return laneNumber;
-		}
-
-		function findFreeLane() {
-			var i = 0;
-
-			while( true ) {
-				// if an array index is not yet defined or set to false, the lane with that number is free.
-				if( !occupiedLanes[i] ) {
-					return i;
-				}
-				i ++;
-			}
-		}
-
-		that.occupy = function( lane ) {
-			// make sure we work with lane numbers here
-			if( typeof lane === 'object' ) {
-				lane = lane.number;
-			}
-
-			occupiedLanes[lane] = true;
-		};
-
-		that.free = function( lane ) {
-			// make sure we work with lane numbers here
-			if( typeof lane === 'object' ) {
-				lane = lane.number;
-			}
-
-			occupiedLanes[lane] = false;
-		};
-
-		that.getLaneForCommit = function( commit ) {
-			// does this commit have a lane already?
-			if( commit.lane ) return commit.lane;
-
-			var laneNumber = findLaneNumberFor( commit );
-			return that.getLane( laneNumber );
-		};
+		var that = {};
 
 		that.getLane = function(laneNumber) {
 			return {
@@ -281,7 +216,24 @@
 				callback( null );
 			}
 
-			callback(data.commits);
+			callback( expandCommits( data ) );
+		}
+
+		// commits come as compact rows, with their lanes laid out by the server:
+		// [hash, lane, parentsHash, parentLanes, date, message, details, author index]
+		function expandCommits( data ) {
+			return $.map( data.commits, function( row ) {
+				return {
+					hash: row[0],
+					lane: row[1],
+					parentsHash: row[2],
+					parentLanes: row[3],
+					date: row[4],
+					message: row[5],
+					details: row[6],
+					author: data.authors[row[7]]
+				};
+			});
 		}
 
 		function handleNetworkDataError() {
@@ -372,21 +324,7 @@
 			// we will want to store this commit's children
 			commit.children = getChildrenFor( commit );
 
-			commit.isFork  = ( commit.children.length > 1 );
-			commit.isMerge = ( commit.parentsHash.length > 1 );
-
-			// after a fork, the occupied lanes must be cleaned up. The children used some lanes we no longer occupy
-			if ( commit.isFork === true ) {
-				$.each( commit.children, function( key, thisChild ) {
-					// free this lane
-					laneManager.occupy( thisChild.lane );
-				});
-			}
-
-			commit.lane = laneManager.getLaneForCommit( commit );
-
-			// now the lane we chose must be marked occupied again.
-			laneManager.occupy( commit.lane );
+			commit.lane = laneManager.getLane( commit.lane );
 
 			registerAwaitedParentsFor( commit );
 		}
@@ -472,14 +410,10 @@
 			}
 
 			$.each( commit.children, function ( idx, thisChild ) {
+				// the edge runs along the lane the child waited for this commit on
+				var parentIndex = $.inArray( commit.hash, thisChild.parentsHash );
 
-				// if there is one child only, stay on the commit's lane as long as possible when connecting the dots.
-				// but if there is more than one child, switch to the child's lane ASAP.
-				// this is to display merges and forks where they happen (ie. at a commit node/ a dot), rather than
-				// connecting from a line.
-				// So: commit.isFork decides whether or not we must switch lanes early
-
-				connectDots( commit, thisChild, commit.isFork );
+				connectDots( commit, thisChild, laneManager.getLane( thisChild.parentLanes[parentIndex] ) );
 			});
 		}
 
@@ -487,14 +421,9 @@
 		 *
 		 * @param firstCommit
 		 * @param secondCommit
-		 * @param switchLanesEarly (boolean): Move the line to the secondCommit's lane ASAP? Defaults to false
+		 * @param lineLane the lane the connection runs along
 		 */
-		function connectDots( firstCommit, secondCommit, switchLanesEarly ) {
-			// default value for switchLanesEarly
-			switchLanesEarly = switchLanesEarly || false;
-
-			var lineLane = switchLanesEarly ? secondCommit.lane : firstCommit.lane;
-
+		function connectDots( firstCommit, secondCommit, lineLane ) {
 			// the connection has 4 stops, resulting in the following 3 segments:
 			// - from the x/y center of firstCommit.dot to the rightmost end (x) of the commit's column, with y=lineLane
 			// - from the rightmost end of firstCommit's column, to the leftmost end of secondCommit's column
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+import datetime
+
+from django.conf import settings
+from django.utils.encoding import force_text
+
+from .cache import LRUCache, get_store
+from .commits import is_ancestor
+from .instrumentation import instrumented
+from .utils import iter_git_lines
+
+STATS_WEEKS = getattr(settings, 'GITLIST_STATS_WEEKS', 26)
+TREE_STATS_CACHE_SIZE = getattr(settings, 'GITLIST_TREE_STATS_CACHE_SIZE', 10000)
+# New tree aggregates are written in batches of this many, each in its own
+# transaction, so the stats database is never locked for a whole traversal.
+TREE_STATS_BATCH = 500
+
+LOG_FORMAT = '--format=%an%x00%ae%x00%at'
+
+
+def _fold_commits(state, repository, revs, path):
+    authors = state['authors']
+    days = state['days']
+    args = [LOG_FORMAT] + revs
+    if path:
+        args.extend(['--', path])
+    for line in iter_git_lines(repository, 'log', *args):
+        if not line:
+            continue
+        name, email, timestamp = line.split(b'\0')
+        author = (name, email)
+        authors[author] = authors.get(author, 0) + 1
+        day = datetime.date.fromtimestamp(int(timestamp)).toordinal()
+        days[day] = days.get(day, 0) + 1
+
+
+@instrumented('commit_stats')
+def get_commit_stats(repository, commitish, path=''):
+    """
+    Returns the per author commit counts and the commits per day and per
+    week of the history of commitish touching path.
+
+    The aggregates are persisted per (commitish, path) together with the tip
+    they were computed at. When the ref moves forward only the new commits
+    (``old..new``) are folded in; if history was rewritten the aggregates
+    are rebuilt from scratch.
+    """
+    store = get_store(repository, 'stats')
+    sha = repository.commit(commitish).hexsha
+
+    key = 'stats:%s:%s' % (commitish, path)
+    state = store.get(key)
+    if state is None or state['tip'] != sha:
+        if state is not None and is_ancestor(repository, state['tip'], sha):
+            _fold_commits(state, repository, ['%s..%s' % (state['tip'], sha)], path)
+        else:
+            state = dict(authors={}, days={})
+            _fold_commits(state, repository, [sha], path)
+        state['tip'] = sha
+        store.set(key, state)
+
+    authors = sorted((dict(
+        name=force_text(name, errors='replace'),
+        email=force_text(email, errors='replace'),
+        commits=count,
+    ) for (name, email), count in state['authors'].items()), key=lambda o: o['commits'], reverse=True)
+
+    days = sorted((datetime.date.fromordinal(day), count) for day, count in state['days'].items())
+
+    weeks = {}
+    for day, count in days:
+        week = day - datetime.timedelta(days=day.weekday())
+        weeks[week] = weeks.get(week, 0) + count
+    weeks = sorted(weeks.items())
+
+    return dict(
+        authors=authors,
+        commits=sum(state['authors'].values()),
+        days=days,
+        weeks=weeks[-STATS_WEEKS:],
+    )
+
+
+tree_stats_cache = LRUCache(TREE_STATS_CACHE_SIZE)
+
+
+def _tree_stats(store, tree, cached_only, pending):
+    key = tree.hexsha
+    stats = tree_stats_cache.get(key)
+    if stats is None:
+        stats = store.get('tree:%s' % key)
+        if stats is None:
+            if cached_only:
+                return None
+            files = 0
+            size = 0
+            extensions = {}
+            for blob in tree.blobs:
+                files += 1
+                size += blob.size
+                _, ext = os.path.splitext(blob.name)
+                if ext:
+                    ext_files, ext_size = extensions.get(ext, (0, 0))
+                    extensions[ext] = (ext_files + 1, ext_size + blob.size)
+            for subtree in tree.trees:
+                sub_files, sub_size, sub_extensions = _tree_stats(store, subtree, cached_only, pending)
+                files += sub_files
+                size += sub_size
+                for ext, (sub_ext_files, sub_ext_size) in sub_extensions.items():
+                    ext_files, ext_size = extensions.get(ext, (0, 0))
+                    extensions[ext] = (ext_files + sub_ext_files, ext_size + sub_ext_size)
+            stats = (files, size, extensions)
+            pending.append(('tree:%s' % key, stats))
+            if len(pending) >= TREE_STATS_BATCH:
+                store.set_many(pending)
+                del pending[:]
+        tree_stats_cache.set(key, stats)
+    return stats
+
+
+@instrumented('tree_stats')
+def get_tree_stats(repository, tree, cached_only=False):
+    """
+    Returns the number of files, total size and per extension file counts
+    and sizes of everything under tree.
+
+    Trees are content addressed, so the aggregates are memoized per tree sha
+    and combined bottom-up: after a commit only the trees along the changed
+    paths are read again. With cached_only, returns None instead of
+    computing aggregates which aren't known yet.
+    """
+    store = get_store(repository, 'stats')
+    pending = []
+    try:
+        stats = _tree_stats(store, tree, cached_only, pending)
+    finally:
+        if pending:
+            store.set_many(pending)
+    if stats is None:
+        return None
+    files, size, extensions = stats
+    return dict(
+        files=files,
+        size=size,
+        extensions=sorted(((ext, ext_files, ext_size) for ext, (ext_files, ext_size) in extensions.items()), key=lambda o: o[1], reverse=True),
+    )
+
+
+def get_stats(repository, sha, commitish, path=''):
+    """
+    Returns the commit stats of commitish touching path and the tree stats
+    of commit sha, as a tuple (for background jobs, which are told apart by
+    sha while commitish keeps the commit stats incremental).
+    """
+    return get_commit_stats(repository, commitish, path), get_tree_stats(repository, repository.tree(sha))
@@ -1,3 +1,1164 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
 
-# Create your tests here.
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from collections import namedtuple
+from unittest import skipUnless
+
+import git
+
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.test import Client, RequestFactory, TestCase
+from django.test.utils import override_settings
+from django.utils.encoding import force_str
+
+from . import benchmark, blame, blobs, bulkheads, commits, diff, instrumentation, jobs, render, search, stats, urls, utils, views
+from .archive import get_cached_archive
+from .benchmark import RepositoryGenerator, count_git_commands, get_sample_urls, run_benchmark
+from .blame import get_blame
+from .blobs import get_cached_blob
+from .bulkheads import Bulkhead, ReleasingIterator
+from .cache import get_cache_path, get_store
+from .commits import commit_cache, file_stats_cache, last_commits_cache, count_commits, get_commits, get_file_stats, get_last_commits, iter_commits
+from .diff import load_commit_diffs, load_file_diff
+from .instrumentation import RequestMetrics, format_metrics, format_server_timing, instrumented
+from .network import format_lanes, get_network_chunk, layout_commits, parse_lanes
+from .render import render_blob
+from .responses import range_response
+from .search import search_commits, search_tree
+from .stats import get_commit_stats, get_stats, get_tree_stats
+from .utils import RepositoryPool, get_refs_stamp, get_repository_from_name, parse_commitish_path, parse_line_range, repository_pool
+
+HAS_MARKDOWN = render.markdown is not None
+# Whether markdown is rendered on the server
+SAFE_MARKDOWN = HAS_MARKDOWN and (render.bleach is not None or render.MARKDOWN_VERSION < (3,))
+
+
+@contextmanager
+def patch_setting(module, name, value):
+    """
+    Temporarily changes a setting read into a module constant.
+    """
+    old = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield
+    finally:
+        setattr(module, name, old)
+
+
+class RepositoryTestCase(TestCase):
+    """
+    Runs against a throwaway repository, configured as ``test``, with a
+    README, a source file and a text file in a subdirectory.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='gitlist-test-')
+        self.timestamp = 1400000000
+        self.git('init', '-q')
+        self.git('symbolic-ref', 'HEAD', 'refs/heads/master')
+        self.initial = self.commit({
+            'README.md': '# Test\n\nA *test* repository.\n',
+            'main.py': 'print("hello")\n',
+            'docs/guide.txt': 'line 1\nline 2\nline 3\n',
+        }, 'Initial commit')
+        self.settings_override = override_settings(GITLIST_REPOSITORIES={'test': self.path})
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        repository_pool.clear()
+        shutil.rmtree(os.path.dirname(get_cache_path(self.repository(), 'x')), ignore_errors=True)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def git(self, *args):
+        env = dict(os.environ, GIT_AUTHOR_NAME='Tester', GIT_AUTHOR_EMAIL='tester@example.com',
+                   GIT_COMMITTER_NAME='Tester', GIT_COMMITTER_EMAIL='tester@example.com',
+                   GIT_AUTHOR_DATE='%d +0000' % self.timestamp, GIT_COMMITTER_DATE='%d +0000' % self.timestamp)
+        return subprocess.check_output(['git'] + [force_str(arg) for arg in args], cwd=self.path, env=env).decode('utf-8').strip()
+
+    def commit(self, files, message):
+        """
+        Writes files (a dict of path -> contents, None to remove) and
+        commits them, returning the sha of the new commit.
+        """
+        for name, content in files.items():
+            filename = os.path.join(self.path, name)
+            if content is None:
+                self.git('rm', '-q', name)
+                continue
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'wb') as f:
+                f.write(content.encode('utf-8') if not isinstance(content, bytes) else content)
+        self.git('add', '-A')
+        self.timestamp += 3600
+        self.git('commit', '-q', '--allow-empty', '-m', message)
+        return self.git('rev-parse', 'HEAD')
+
+    def repository(self):
+        return git.Repo(self.path)
+
+
+class ViewsTest(RepositoryTestCase):
+    def assertView(self, name, status=200, **kwargs):
+        response = self.client.get(reverse(name, kwargs=dict(kwargs, repo='test')))
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def test_tree(self):
+        self.assertContains(self.assertView('repository'), 'main.py')
+        self.assertContains(self.assertView('branch', branch='master'), 'docs')
+        self.assertContains(self.assertView('tree', commitishPath='master/docs'), 'guide.txt')
+
+    def test_homepage(self):
+        response = self.client.get(reverse('homepage'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['name'] for r in response.context['repositories']], ['test'])
+        self.assertEqual(response.context['repositories'][0]['branch'], 'master')
+
+
+class RefsTest(RepositoryTestCase):
+    def test_nested_refs_change_stamp(self):
+        git_dir = os.path.join(self.path, '.git')
+        self.git('branch', 'feature/x')
+        stamp = get_refs_stamp(git_dir)
+        self.assertEqual(get_refs_stamp(git_dir), stamp)
+        self.git('branch', 'feature/y')
+        self.assertNotEqual(get_refs_stamp(git_dir), stamp)
+        stamp = get_refs_stamp(git_dir)
+        self.git('update-ref', 'refs/heads/feature/x', self.commit({'main.py': 'print("bye")\n'}, 'Change'))
+        self.assertNotEqual(get_refs_stamp(git_dir), stamp)
+
+    def test_packed_refs_change_stamp(self):
+        git_dir = os.path.join(self.path, '.git')
+        self.git('tag', 'v1.0')
+        stamp = get_refs_stamp(git_dir)
+        self.git('pack-refs', '--all')
+        self.assertNotEqual(get_refs_stamp(git_dir), stamp)
+        stamp = get_refs_stamp(git_dir)
+        self.git('tag', '-d', 'v1.0')
+        self.assertNotEqual(get_refs_stamp(git_dir), stamp)
+
+    def test_stamp_taken_once_per_request(self):
+        calls = []
+
+        def counting_stamp(git_dir):
+            calls.append(git_dir)
+            return get_refs_stamp(git_dir)
+
+        with patch_setting(utils, 'get_refs_stamp', counting_stamp):
+            response = self.client.get(reverse('tree', kwargs=dict(repo='test', commitishPath='master/docs')))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(calls), 1)
+            self.git('branch', 'feature/x')
+            response = self.client.get(reverse('tree', kwargs=dict(repo='test', commitishPath='feature/x/docs')))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(calls), 2)
+
+    def test_new_nested_branch_resolves(self):
+        self.git('branch', 'feature/x')
+        response = self.client.get(reverse('blob', kwargs=dict(repo='test', commitishPath='feature/x/main.py')))
+        self.assertEqual(response.status_code, 200)
+        self.git('branch', 'feature/y')
+        response = self.client.get(reverse('blob', kwargs=dict(repo='test', commitishPath='feature/y/main.py')))
+        self.assertEqual(response.status_code, 200)
+
+    def test_parse_commitish_path(self):
+        self.git('branch', 'feature/x')
+        self.git('tag', 'v1.0')
+        repository = self.repository()
+        self.assertEqual(parse_commitish_path('feature/x/docs/guide.txt', repository), ('feature/x', 'docs/guide.txt'))
+        self.assertEqual(parse_commitish_path('v1.0', repository), ('v1.0', ''))
+        self.assertEqual(parse_commitish_path('%s/main.py' % self.initial, repository), (self.initial, 'main.py'))
+        self.assertEqual(parse_commitish_path('', repository), ('master', ''))
+
+
+class ConditionalTest(RepositoryTestCase):
+    def test_ref_urls(self):
+        url = reverse('tree', kwargs=dict(repo='test', commitishPath='master/docs'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertNotIn('immutable', response.get('Cache-Control', ''))
+        self.assertIn('X-Requested-With', response['Vary'])
+        etag = response['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertNotEqual(self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')['ETag'], etag)
+
+        self.commit({'docs/guide.txt': 'line 1\n'}, 'Change guide')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_sha_urls(self):
+        url = reverse('blob', kwargs=dict(repo='test', commitishPath='%s/main.py' % self.initial))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('X-Requested-With', response['Vary'])
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_placeholders_have_no_etag(self):
+        url = reverse('stats', kwargs=dict(repo='test', branch=self.initial))
+        jobs.job_store.execute('DELETE FROM jobs')
+        with patch_setting(jobs, 'JOBS', True), patch_setting(jobs, '_start_workers', lambda: None):
+            response = self.client.get(url)
+        jobs.job_store.execute('DELETE FROM jobs')
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        bulkhead = Bulkhead(limit=1, repository_limit=1, timeout=0, retry_after=1)
+        bulkhead.acquire('test')
+        with patch_setting(bulkheads, '_bulkheads', {'browse': bulkhead}):
+            response = self.client.get(reverse('blob', kwargs=dict(repo='test', commitishPath='%s/main.py' % self.initial)))
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+
+
+class TreeStatsTest(RepositoryTestCase):
+    def test_aggregates(self):
+        self.commit({'docs/api/index.txt': 'api\n'}, 'Add api docs')
+        repository = self.repository()
+        stats = get_tree_stats(repository, repository.tree('master'))
+        self.assertEqual(stats['files'], 4)
+        self.assertEqual(stats['size'], sum(b.size for b in repository.tree('master').traverse() if b.type == 'blob'))
+        self.assertEqual(dict((ext, files) for ext, files, size in stats['extensions']), {'.md': 1, '.py': 1, '.txt': 2})
+        self.assertEqual(get_tree_stats(repository, repository.tree('master')['docs'], cached_only=True)['files'], 2)
+
+    def test_batches(self):
+        self.commit(dict(('dir%d/file.txt' % i, '%d\n' % i) for i in range(5)), 'Add directories')
+        repository = self.repository()
+        with patch_setting(stats, 'TREE_STATS_BATCH', 2):
+            stats.tree_stats_cache.clear()
+            self.assertEqual(get_tree_stats(repository, repository.tree('master'))['files'], 8)
+        stats.tree_stats_cache.clear()
+        self.assertEqual(get_tree_stats(repository, repository.tree('master'), cached_only=True)['files'], 8)
+
+    def test_tree_view(self):
+        self.commit({'docs/api/index.txt': 'api\n'}, 'Add api docs')
+        stats.tree_stats_cache.clear()
+        get_store(self.repository(), 'stats').execute('DELETE FROM store')
+        url = reverse('tree', kwargs=dict(repo='test', commitishPath='master'))
+        # Aggregates are computed by the view, so its ETag holds at once
+        response = self.client.get(url)
+        self.assertFalse(response['ETag'].startswith('W/'))
+        self.assertNotIn('no-cache', response.get('Cache-Control', ''))
+        self.assertEqual(dict((f.name, f.files) for f in response.context['files'] if f.type == 'tree'), {'docs': 2})
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+
+class SearchTreeTest(RepositoryTestCase):
+    def test_pages(self):
+        self.commit({'a.txt': 'needle one\nhay\nneedle two\n', 'b.txt': 'hay\n', 'c/d.txt': 'a needle\n'}, 'Add files')
+        repository = self.repository()
+        tree_sha = repository.tree('master').hexsha
+        results, more, skipped = search_tree(repository, tree_sha, 'needle', page=0, per_page=2)
+        self.assertEqual([(r['file'], r['line']) for r in results], [('a.txt', 1), ('a.txt', 3)])
+        self.assertTrue(more)
+        results, more, skipped = search_tree(repository, tree_sha, 'needle', page=1, per_page=2)
+        self.assertEqual([(r['file'], r['line']) for r in results], [('c/d.txt', 1)])
+        self.assertFalse(more)
+        self.assertEqual(search_tree(repository, tree_sha, 'needle', path='c')[0][0]['file'], 'c/d.txt')
+        self.assertEqual(search_tree(repository, tree_sha, 'nothing like it')[0], [])
+
+    def test_long_query(self):
+        repository = self.repository()
+        query = ''.join(chr(ord('a') + (i * 7) % 26) + chr(ord('a') + (i * 11) % 26) for i in range(2000))
+        self.assertEqual(search_tree(repository, repository.tree('master').hexsha, query), ([], False, []))
+        self.assertEqual(search_tree(repository, repository.tree('master').hexsha, 'line 2')[0][0]['file'], 'docs/guide.txt')
+
+    def test_short_queries(self):
+        repository = self.repository()
+        self.assertEqual(search_tree(repository, repository.tree('master').hexsha, 'li'), ([], False, []))
+        response = self.client.get(reverse('searchbranch', kwargs=dict(repo='test', branch='master')), {'query': 'li'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['too_short'])
+        self.assertContains(response, 'at least 3 characters')
+
+    def test_index_pruned(self):
+        index = get_store(self.repository(), 'search', search.TrigramIndex)
+        trees = []
+        for i in range(3):
+            self.commit({'docs/guide.txt': 'version %d\n' % i}, 'Change %d' % i)
+            trees.append(self.repository().tree('master').hexsha)
+        repository = self.repository()
+        with patch_setting(search, 'SEARCH_INDEX_TREES', 2):
+            for tree_sha in trees:
+                self.assertEqual(search_tree(repository, tree_sha, 'version')[0][0]['file'], 'docs/guide.txt')
+        # The first version of the guide was only in the tree dropped
+        shas = set(row[0] for row in index.execute('SELECT sha FROM blobs'))
+        self.assertEqual(shas, set(sha for tree_sha in trees[1:] for path, sha, size in search.get_tree_entries(repository, tree_sha)))
+        self.assertEqual(index.execute('SELECT COUNT(*) FROM trigrams WHERE blob NOT IN (SELECT id FROM blobs)').fetchone()[0], 0)
+        self.assertEqual(search_tree(repository, trees[0], 'version 0')[0][0]['line'], 1)
+
+    def test_big_files_are_reported(self):
+        self.commit({'big.txt': 'needle\n' * 100}, 'Add a big file')
+        repository = self.repository()
+        with patch_setting(search, 'SEARCH_MAX_BLOB_SIZE', 100):
+            results, more, skipped = search_tree(repository, repository.tree('master').hexsha, 'needle')
+        self.assertEqual(results, [])
+        self.assertEqual(skipped, ['big.txt'])
+
+    def test_view(self):
+        response = self.client.get(reverse('searchbranch', kwargs=dict(repo='test', branch='master')), {'query': 'hello'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['file'] for r in response.context['results']], ['main.py'])
+
+
+class CommitIndexTest(RepositoryTestCase):
+    def test_search(self):
+        fix = self.commit({'main.py': 'print("fixed")\n'}, 'Fix the greeting')
+        docs = self.commit({'docs/guide.txt': 'line 1\n'}, 'Shorten the guide')
+        repository = self.repository()
+        self.assertEqual(search_commits(repository, 'master', '', 'fix'), ([fix], 1))
+        self.assertEqual(search_commits(repository, 'master', '', 'the'), ([docs, fix], 2))
+        self.assertEqual(search_commits(repository, 'master', 'docs', 'the'), ([docs], 1))
+        self.assertEqual(search_commits(repository, 'master', '', 'author:tester', offset=1, limit=1), ([fix], 3))
+
+        more = self.commit({'main.py': 'print("fixed again")\n'}, 'Fix it again')
+        self.assertEqual(search_commits(repository, 'master', '', 'fix'), ([more, fix], 2))
+
+    def test_scopes_are_evicted(self):
+        repository = self.repository()
+        index = get_store(repository, 'commits', search.CommitIndex)
+        with patch_setting(search, 'COMMIT_INDEX_SCOPES', 2):
+            for path in ('', 'docs', 'main.py', ''):
+                self.assertEqual(search_commits(repository, 'master', path, 'initial'), ([self.initial], 1))
+        self.assertEqual(sorted(row[0] for row in index.execute('SELECT path FROM scopes')), ['', 'main.py'])
+        self.assertEqual(index.execute('SELECT COUNT(DISTINCT scope) FROM members').fetchone()[0], 2)
+
+
+class ArchiveTest(RepositoryTestCase):
+    def download(self, commitish):
+        response = self.client.get(reverse('archive', kwargs=dict(repo='test', format='zip', branch=commitish)))
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_commits_sharing_a_tree(self):
+        empty = self.commit({}, 'Nothing changed')
+        repository = self.repository()
+        self.assertEqual(repository.commit(empty).tree, repository.commit(self.initial).tree)
+
+        first = self.download(self.initial)
+        self.assertIsNotNone(get_cached_archive(repository, self.initial, 'zip'))
+        self.assertIsNone(get_cached_archive(repository, empty, 'zip'))
+        second = self.download(empty)
+        self.assertIn(self.git('rev-parse', 'HEAD').encode('ascii'), second)
+        self.assertNotIn(self.initial.encode('ascii'), second)
+
+        self.assertEqual(self.download(self.initial), first)
+        self.assertEqual(self.download('master'), second)
+
+
+class BlameTest(RepositoryTestCase):
+    def blames(self, **params):
+        response = self.client.get(reverse('blame', kwargs=dict(repo='test', commitishPath='master/docs/guide.txt')), params)
+        self.assertEqual(response.status_code, 200)
+        return [(blame['commitShort'], blame['line']) for blame in response.context['blames']]
+
+    def test_view(self):
+        change = self.commit({'docs/guide.txt': 'line 1\nline 2 changed\nline 3'}, 'Change the guide')
+        # The last line lost its newline, so it changed too
+        self.assertEqual(self.blames(), [(self.initial[:8], 'line 1'), (change[:8], 'line 2 changed\nline 3')])
+        with patch_setting(views, 'BLAME_WINDOW', 2):
+            self.assertEqual(self.blames(lines='1-2'), [(self.initial[:8], 'line 1'), (change[:8], 'line 2 changed')])
+            self.assertEqual(self.blames(lines='3-4'), [(change[:8], 'line 3')])
+
+    def test_store_is_bounded(self):
+        store = get_store(self.repository(), 'blame', blame.BlameStore)
+        store.max_entries = 3
+        store.prune_every = 1
+        for key in 'abcd':
+            store.set(key, key)
+        store.get('b')
+        store.set('e', 'e')
+        self.assertEqual(sorted(row[0] for row in store.execute('SELECT key FROM store')), ['b', 'd', 'e'])
+
+
+class LineRangeTest(RepositoryTestCase):
+    def test_parse_line_range(self):
+        self.assertEqual(parse_line_range('3-5', 10, 4), (2, 5))
+        self.assertEqual(parse_line_range('3-100', 10, 4), (2, 6))
+        self.assertEqual(parse_line_range('1-1000000', 10, 100), (0, 10))
+        self.assertEqual(parse_line_range('8', 10, 4), (7, 10))
+        self.assertEqual(parse_line_range('5-3', 10, 4), (0, 4))
+        self.assertEqual(parse_line_range('x', 10, 4), (0, 4))
+        self.assertEqual(parse_line_range(None, 3, 4), (0, 3))
+
+    def test_blob_window(self):
+        url = reverse('blob', kwargs=dict(repo='test', commitishPath='master/docs/guide.txt'))
+        with patch_setting(views, 'BLOB_WINDOW', 2):
+            response = self.client.get(url, {'lines': '1-3'})
+        self.assertEqual(response.context['blob'], 'line 1\nline 2\n')
+        self.assertEqual(response.context['window']['next'], '3-3')
+
+    def test_big_binary_blob(self):
+        self.commit({'data.bin': b'\0' * 1000, 'data.txt': 'text\n' * 200}, 'Add big files')
+        repository = self.repository()
+        tree = repository.tree('master')
+        with patch_setting(blobs, 'BLOB_VIEW_MAX_SIZE', 100):
+            # Sniffed while the line index is built
+            self.assertTrue(blobs.is_binary_blob(repository, tree['data.bin']))
+            self.assertEqual(get_store(repository, 'line_index').get(tree['data.bin'].hexsha)[2], True)
+            self.assertFalse(blobs.is_binary_blob(repository, tree['data.txt']))
+            response = self.client.get(reverse('blob', kwargs=dict(repo='test', commitishPath='master/data.bin')))
+            self.assertTrue(response.context['binary'])
+            self.assertIsNone(response.context['blob'])
+        self.assertFalse(blobs.is_binary_blob(repository, tree['main.py']))
+
+    def test_partial_reads(self):
+        self.commit({'data.txt': 'text\n' * 100000}, 'Add a big file')
+        repository = self.repository()
+        tree = repository.tree('master')
+        self.assertEqual(blobs.read_lines(repository, tree['data.txt'], 0, 2), b'text\ntext\n')
+        # The rest of the blob was skipped, so the next object is read right
+        self.assertEqual(tree['main.py'].data_stream.read(), b'print("hello")\n')
+
+    def test_blame_chunks(self):
+        self.commit({'docs/guide.txt': 'line 1\nline 2 changed\nline 3\nline 4\nline 5\n'}, 'Change the guide')
+        repository = self.repository()
+        shas, owners = get_blame(repository, 'master', 'docs/guide.txt')
+        whole = [shas[owner] for owner in owners]
+        store = get_store(repository, 'blame')
+        store.execute('DELETE FROM store')
+        with patch_setting(blame, 'BLAME_WINDOW', 2):
+            for start, stop in ((1, 3), (2, 3), (3, 5), (0, 5)):
+                shas, owners = get_blame(repository, 'master', 'docs/guide.txt', start, stop)
+                self.assertEqual([shas[owner] for owner in owners], whole[start:stop])
+        keys = [row[0].rsplit(':', 1)[1] for row in store.execute("SELECT key FROM store WHERE key LIKE 'blame:%'")]
+        self.assertEqual(sorted(keys, key=int), ['0', '2', '4'])
+
+
+class RenderTest(RepositoryTestCase):
+    def render(self, content, name='README.md'):
+        self.commit({name: content}, 'Change %s' % name)
+        repository = self.repository()
+        return render_blob(repository, repository.tree('master')[name])
+
+    @skipUnless(SAFE_MARKDOWN, 'needs markdown, and bleach for markdown 3')
+    def test_markdown_is_sanitized(self):
+        fragment = self.render('# Title\n\n<script>alert(1)</script>\n\n[link](javascript:alert(1)) <b onclick="x()">b</b>\n')
+        self.assertTrue(fragment['rendered'])
+        self.assertIn('<h1>Title</h1>', fragment['html'])
+        self.assertNotIn('<script', fragment['html'])
+        self.assertNotIn('javascript:', fragment['html'])
+        self.assertNotIn('<b onclick', fragment['html'])
+
+    @skipUnless(HAS_MARKDOWN, 'needs markdown')
+    def test_unsafe_markdown_is_left_to_the_browser(self):
+        with patch_setting(render, 'bleach', None), patch_setting(render, 'MARKDOWN_VERSION', (3, 0, 0)):
+            fragment = self.render('<script>alert(1)</script>\n')
+        self.assertFalse(fragment['rendered'])
+        self.assertEqual(fragment['html'], '&lt;script&gt;alert(1)&lt;/script&gt;\n')
+
+    @skipUnless(SAFE_MARKDOWN, 'needs markdown, and bleach for markdown 3')
+    def test_readme(self):
+        self.assertContains(self.client.get(reverse('repository', kwargs=dict(repo='test'))), '<em>test</em>')
+        self.assertIsInstance(get_store(self.repository(), 'render', render.RenderStore), render.RenderStore)
+
+
+class CommitCountTest(RepositoryTestCase):
+    def count(self, *args):
+        return int(self.git('rev-list', '--count', *args))
+
+    def test_count(self):
+        self.commit({'main.py': 'print("bye")\n'}, 'Change main')
+        repository = self.repository()
+        self.assertEqual(count_commits(repository, 'master'), 2)
+        self.assertEqual(count_commits(repository, 'master', 'main.py'), 2)
+        self.assertEqual(count_commits(repository, 'master', 'docs'), 1)
+        self.assertEqual(count_commits(repository, self.initial), 1)
+
+    def test_invalidated_by_pushes(self):
+        repository = self.repository()
+        store = get_store(repository, 'commit_counts')
+        self.assertEqual(count_commits(repository, 'master'), 1)
+        for i in range(3):
+            self.commit({'main.py': 'print(%d)\n' % i}, 'Change %d' % i)
+        # Counted from the difference with the last tip
+        with count_git_commands([0]) as counter:
+            self.assertEqual(count_commits(repository, 'master'), 4)
+        self.assertEqual(counter[0], 1)
+        self.assertEqual(store.get('tip:master:'), (self.git('rev-parse', 'master'), 4))
+
+        # Forced pushes rewinding the ref, and old tips gone
+        self.git('reset', '-q', '--hard', 'HEAD~2')
+        self.commit({'docs/guide.txt': 'rewritten\n'}, 'Rewrite')
+        self.assertEqual(count_commits(repository, 'master'), self.count('master'))
+        store.set('tip:master:', ('f' * 40, 100))
+        self.commit({'main.py': 'print("bye")\n'}, 'Change main')
+        self.assertEqual(count_commits(repository, 'master'), self.count('master'))
+
+
+class CommitsPagingTest(RepositoryTestCase):
+    def setUp(self):
+        super(CommitsPagingTest, self).setUp()
+        # A merge, so some cursors hold more than one sha
+        self.git('checkout', '-q', '-b', 'topic')
+        for i in range(3):
+            self.commit({'topic.txt': '%d\n' % i}, 'Topic %d' % i)
+        self.git('checkout', '-q', 'master')
+        for i in range(3):
+            self.commit({'main.py': 'print(%d)\n' % i}, 'Main %d' % i)
+        self.timestamp += 3600
+        self.git('merge', '-q', '--no-ff', '-m', 'Merge topic', 'topic')
+        self.history = self.git('log', '--format=%H', 'master').split()
+        self.url = reverse('commits', kwargs=dict(repo='test', commitishPath='master'))
+
+    def page(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        shas = [commit.hexsha for _, day in response.context['commits'] for commit in day]
+        return shas, response.context['pager']
+
+    def test_pages(self):
+        with patch_setting(views, 'COMMITS_PER_PAGE', 2):
+            pages = []
+            shas, pager = self.page()
+            tokens = [None]
+            while True:
+                pages.append(shas)
+                self.assertEqual(pager['first'], len(pages) == 1)
+                self.assertEqual(pager['current'], len(pages) - 1)
+                self.assertEqual((pager['total'], pager['last']), (len(self.history), 3))
+                self.assertEqual(pager['previous'], tokens[-2] if len(tokens) > 1 else None)
+                if not pager['next']:
+                    break
+                self.assertRegexpMatches(pager['next'], r'^[0-9a-f]{20}$')
+                tokens.append(pager['next'])
+                shas, pager = self.page(**{'from': pager['next']})
+            self.assertEqual(sorted(sum(pages, [])), sorted(self.history))
+            self.assertEqual(len(pages), 4)
+
+            # Going back lands on the same pages
+            self.assertEqual(self.page(**{'from': tokens[2]})[0], pages[2])
+            self.assertEqual(self.page(**{'from': tokens[1]})[1]['previous'], None)
+
+            # Old style URLs are redirected to cursors
+            response = self.client.get(self.url, {'page': 2})
+            self.assertEqual(response.status_code, 302)
+            token = response['Location'].rsplit('from=', 1)[1]
+            shas, pager = self.page(**{'from': token})
+            self.assertEqual(shas, pages[2])
+            self.assertEqual(pager['current'], 2)
+            self.assertEqual(self.page(**{'from': pager['previous']})[0], pages[1])
+
+            # Down to the oldest page
+            response = self.client.get(self.url, {'page': pager['last']})
+            shas, pager = self.page(**{'from': response['Location'].rsplit('from=', 1)[1]})
+            self.assertEqual(shas, pages[-1])
+            self.assertEqual(pager['current'], pager['last'])
+            self.assertIsNone(pager['next'])
+
+    def test_unknown_cursor(self):
+        response = self.client.get(self.url, {'from': '0' * 20})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.get(self.url, {'from': 'x'}).status_code, 302)
+
+
+class NetworkTest(RepositoryTestCase):
+    def test_lanes(self):
+        self.assertEqual(parse_lanes('%s,,%s' % ('a' * 40, 'b' * 40)), ['a' * 40, None, 'b' * 40])
+        self.assertEqual(format_lanes(['a' * 40, None, 'b' * 40]), '%s,,%s' % ('a' * 40, 'b' * 40))
+        self.assertEqual(parse_lanes(''), [None])
+        self.assertIsNone(parse_lanes('xyz'))
+        self.assertIsNone(parse_lanes(None))
+
+    def test_layout(self):
+        Commit = namedtuple('Commit', 'hexsha parents')
+        # merge(a, b) on top of a and b, both children of root
+        commits = [Commit('m', ('a', 'b')), Commit('b', ('r',)), Commit('a', ('r',)), Commit('r', ())]
+        lanes = []
+        rows = [(commit.hexsha, lane, parent_lanes) for commit, lane, parent_lanes in layout_commits(commits, lanes)]
+        self.assertEqual(rows, [('m', 0, [0, 1]), ('b', 1, [1]), ('a', 0, [0]), ('r', 0, [])])
+        self.assertEqual(lanes, [])
+
+        # Laying out in two chunks gives the same rows
+        lanes = []
+        first = layout_commits(commits[:2], lanes)
+        self.assertEqual(lanes, ['a', 'r'])
+        second = layout_commits(commits[2:], list(lanes))
+        self.assertEqual([(c.hexsha, lane, parent_lanes) for c, lane, parent_lanes in first + second], rows)
+
+    def test_old_page_urls(self):
+        for i in range(3):
+            self.commit({'main.py': 'print(%d)\n' % i}, 'Change %d' % i)
+        with patch_setting(views, 'COMMITS_PER_PAGE', 2):
+            response = self.client.get(reverse('network_data', kwargs=dict(repo='test', commitishPath='master', page=1)))
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get(response['Location'])
+        self.assertEqual([commit[0] for commit in json.loads(response.content.decode('utf-8'))['commits']],
+                         self.git('log', '--format=%H', '--skip=2').split())
+
+    def test_chunks_survive_pushes(self):
+        for i in range(4):
+            self.commit({'main.py': 'print(%d)\n' % i}, 'Change %d' % i)
+        repository = self.repository()
+        rows, lanes = get_network_chunk(repository, 'master', size=2)
+        self.assertEqual(len(rows), 2)
+        rest, end = get_network_chunk(repository, 'master', lanes=lanes, size=2)
+        self.assertEqual([row[0] for row in rows + rest], self.git('log', '--format=%H', '-4').split())
+
+        self.commit({'main.py': 'print("new")\n'}, 'New commit')
+        store = get_store(repository, 'network')
+        count = store.execute('SELECT COUNT(*) FROM store').fetchone()[0]
+        self.assertEqual(get_network_chunk(repository, 'master', lanes=lanes, size=2), (rest, end))
+        self.assertEqual(store.execute('SELECT COUNT(*) FROM store').fetchone()[0], count)
+        self.assertEqual(get_network_chunk(repository, 'master', size=1)[0][0][5], 'New commit')
+
+    def test_view(self):
+        response = self.client.get(reverse('network_data', kwargs=dict(repo='test', commitishPath='master', page=0)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['commits'][0][0], self.initial)
+        self.assertEqual(self.client.get(reverse('network', kwargs=dict(repo='test', commitishPath='master'))).status_code, 200)
+
+
+class BenchmarkTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='gitlist-benchmark-')
+        self.generator = RepositoryGenerator(commits=12, files=10, tags=2, merges=1, blob_size=256)
+        self.generator.generate(os.path.join(self.path, 'benchmark.git'))
+        self.settings_override = override_settings(GITLIST_REPOSITORIES={'benchmark': os.path.join(self.path, 'benchmark.git')})
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        repository_pool.clear()
+        shutil.rmtree(os.path.dirname(get_cache_path(git.Repo(os.path.join(self.path, 'benchmark.git')), 'x')), ignore_errors=True)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_generator(self):
+        repository = git.Repo(os.path.join(self.path, 'benchmark.git'))
+        again = RepositoryGenerator(commits=12, files=10, tags=2, merges=1, blob_size=256)
+        self.assertEqual(git.Repo(again.generate(os.path.join(self.path, 'again.git'))).head.commit, repository.head.commit)
+        self.assertEqual(len(repository.tags), 2)
+        self.assertTrue(all(commit.message.endswith('\n') for commit in repository.iter_commits()))
+
+    def test_every_view(self):
+        results = run_benchmark('benchmark', runs=1)
+        self.assertEqual(len(results), len(urls.urlpatterns))
+        for name, result in results.items():
+            self.assertNotEqual(result['status'], 'failed', '%s: %s' % (name, result.get('error')))
+            self.assertLess(result['status'], 500, name)
+            self.assertGreaterEqual(result['peak_rss_growth_kb'], 0)
+
+    def test_failures_are_recorded(self):
+        class FailingClient(Client):
+            def get(self, path, *args, **kwargs):
+                if '/blame/' in path:
+                    raise ValueError("Broken view")
+                return super(FailingClient, self).get(path, *args, **kwargs)
+
+        with patch_setting(benchmark, 'Client', FailingClient):
+            results = run_benchmark('benchmark', runs=1, views=['blame', 'blob'])
+        self.assertEqual(results['blame+ref']['status'], 'failed')
+        self.assertIn('Broken view', results['blame+ref']['error'])
+        self.assertEqual(results['blob+ref']['status'], 200)
+
+
+class SampleUrlsTest(RepositoryTestCase):
+    def test_root_file(self):
+        self.commit({'main.py': 'print("bye")\n'}, 'Change main')
+        samples = dict(get_sample_urls('test', self.repository()))
+        self.assertEqual(samples['tree+ref'], reverse('tree', kwargs=dict(repo='test', commitishPath='master')))
+        self.assertEqual(samples['blob+ref'], reverse('blob', kwargs=dict(repo='test', commitishPath='master/main.py')))
+
+
+class JobsTest(RepositoryTestCase):
+    def setUp(self):
+        super(JobsTest, self).setUp()
+        self.call = ('test', get_stats, (self.initial, 'master', ''))
+        # Fails, as the commit doesn't exist
+        self.failing = ('test', get_stats, ('0' * 40, 'master', ''))
+        self.keys = [jobs.get_job_key(*call) for call in (self.call, self.failing)]
+        jobs.job_store.execute('DELETE FROM jobs')
+
+    def tearDown(self):
+        jobs.job_store.execute('DELETE FROM jobs')
+        super(JobsTest, self).tearDown()
+
+    @contextmanager
+    def jobs(self):
+        # Jobs are run by calling run_next, rather than by worker processes
+        with patch_setting(jobs, 'JOBS', True), patch_setting(jobs, '_start_workers', lambda: None):
+            yield
+
+    def run_job(self, call):
+        repo, func, args = call
+        return jobs.run_job(self.repository(), repo, func, *args)
+
+    def test_queued_and_run(self):
+        expected = get_stats(self.repository(), *self.call[2])
+        with self.jobs():
+            self.assertEqual(self.run_job(self.call), (False, None))
+            self.assertEqual(self.run_job(self.call), (False, None))
+            self.assertEqual(jobs.job_store.get(self.keys[0])[0], jobs.PENDING)
+            self.assertTrue(jobs.run_next())
+            self.assertFalse(jobs.run_next())
+            self.assertEqual(self.run_job(self.call), (True, expected))
+
+    def test_started_when_run(self):
+        with self.jobs():
+            self.run_job(self.call)
+        started = "SELECT started FROM jobs WHERE key = ?"
+        self.assertIsNone(jobs.job_store.execute(started, (self.keys[0],)).fetchone()[0])
+        self.assertEqual(jobs.job_store.take()[0], self.keys[0])
+        self.assertIsNotNone(jobs.job_store.execute(started, (self.keys[0],)).fetchone()[0])
+        self.assertIsNone(jobs.job_store.take())
+        # Running for too long: its worker died
+        jobs.job_store.execute("UPDATE jobs SET started = 0 WHERE key = ?", (self.keys[0],))
+        self.assertEqual(jobs.job_store.take()[0], self.keys[0])
+
+    def test_failures_back_off(self):
+        with self.jobs():
+            self.assertEqual(self.run_job(self.failing), (False, None))
+            jobs.run_next()
+            self.assertEqual(jobs.job_store.get(self.keys[1])[0], jobs.FAILED)
+            with self.assertRaises(jobs.JobFailed):
+                self.run_job(self.failing)
+            with patch_setting(jobs, 'JOB_RETRY', 0):
+                self.assertEqual(self.run_job(self.failing), (False, None))
+            self.assertEqual(jobs.job_store.get(self.keys[1])[0], jobs.PENDING)
+            jobs.run_next()
+            self.assertEqual(jobs.job_store.get(self.keys[1])[3], 2)
+
+
+class RepositoryPoolTest(RepositoryTestCase):
+    def test_handles_are_reused_until_refs_change(self):
+        repository = get_repository_from_name('test')
+        self.assertIs(get_repository_from_name('test'), repository)
+        self.commit({'main.py': 'print("bye")\n'}, 'Change')
+        fresh = get_repository_from_name('test')
+        self.assertIsNot(fresh, repository)
+        self.assertEqual(fresh.head.commit.hexsha, self.git('rev-parse', 'HEAD'))
+
+    def test_handles_per_thread(self):
+        repository = get_repository_from_name('test')
+        other = []
+        thread = threading.Thread(target=lambda: other.append(get_repository_from_name('test')))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], repository)
+        self.assertIs(get_repository_from_name('test'), repository)
+
+    def test_bounded(self):
+        pool = RepositoryPool(1)
+        repository = pool.get('test', self.path)
+        self.assertIs(pool.get('test', self.path), repository)
+        pool.get('other', self.path)
+        self.assertEqual(list(pool.entries), ['other'])
+        self.assertIsNot(pool.get('test', self.path), repository)
+
+    def test_unknown_repository(self):
+        self.assertRaises(Http404, get_repository_from_name, 'missing')
+        self.assertEqual(self.client.get(reverse('repository', kwargs=dict(repo='missing'))).status_code, 404)
+
+
+class CommitStatsTest(RepositoryTestCase):
+    def authors(self, stats):
+        return [(author['name'], author['commits']) for author in stats['authors']]
+
+    def test_incremental(self):
+        repository = self.repository()
+        stats = get_commit_stats(repository, 'master')
+        self.assertEqual((self.authors(stats), stats['commits']), ([('Tester', 1)], 1))
+
+        self.commit({'main.py': 'print("bye")\n'}, 'Change')
+        self.timestamp += 3600
+        self.git('commit', '-q', '--allow-empty', '-m', 'Other', '--author', 'Other <other@example.com>')
+        stats = get_commit_stats(repository, 'master')
+        self.assertEqual(self.authors(stats), [('Tester', 2), ('Other', 1)])
+        self.assertEqual(sum(count for _, count in stats['days']), 3)
+        self.assertEqual(self.authors(get_commit_stats(repository, 'master', 'main.py')), [('Tester', 2)])
+        self.assertEqual(self.authors(get_commit_stats(repository, 'master', 'docs')), [('Tester', 1)])
+
+        # Rewritten history is counted again from scratch
+        self.git('reset', '-q', '--hard', self.initial)
+        self.commit({'docs/guide.txt': 'rewritten\n'}, 'Rewrite')
+        self.assertEqual(self.authors(get_commit_stats(repository, 'master')), [('Tester', 2)])
+
+    def test_view(self):
+        response = self.client.get(reverse('stats', kwargs=dict(repo='test', branch='master')))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['commits'], 1)
+        self.assertEqual(response.context['stats']['files'], 3)
+
+
+class DiffTest(RepositoryTestCase):
+    def setUp(self):
+        super(DiffTest, self).setUp()
+        self.change = self.commit({
+            'README.md': '# Test\n\nA *changed* repository.\n',
+            'main.py': 'print("bye")\n',
+            'docs/guide.txt': None,
+            'docs/manual.txt': 'line 1\nline 2\nline 3\n',
+        }, 'Change everything')
+
+    def test_budgets(self):
+        repository = self.repository()
+        files = load_commit_diffs(repository, self.initial, self.change)
+        self.assertEqual([(f.file, f.added, f.deleted) for f in files],
+                         [('README.md', 1, 1), ('docs/manual.txt', 0, 0), ('main.py', 1, 1)])
+        self.assertTrue(files[1].renamed)
+        self.assertEqual(files[1].old_file, 'docs/guide.txt')
+        self.assertEqual([line.getType for line in files[2].lines], ['chunk', 'old', 'new'])
+
+        with patch_setting(diff, 'DIFF_MAX_LINES', 5):
+            files = load_commit_diffs(repository, self.initial, self.change)
+        self.assertIsNotNone(files[0].lines)
+        self.assertEqual([f.lines for f in files[1:]], [None, None])
+
+        loaded = load_file_diff(repository, self.initial, self.change, 'main.py')
+        self.assertEqual([line.getLine for line in loaded.lines][1:], ['-print("hello")', '+print("bye")'])
+        self.assertIsNone(load_file_diff(repository, self.initial, self.change, 'missing.txt'))
+
+    def test_too_large(self):
+        with patch_setting(diff, 'DIFF_MAX_FILE_LINES', 2):
+            files = load_commit_diffs(self.repository(), self.initial, self.change)
+        self.assertTrue(files[0].too_large)
+        self.assertIsNone(files[0].lines)
+        self.assertFalse(files[1].too_large)
+
+    def test_views(self):
+        response = self.client.get(reverse('commit', kwargs=dict(repo='test', commitishPath=self.change)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['diffs']), 3)
+        url = reverse('diff', kwargs=dict(repo='test', commitishPath='%s/docs/manual.txt' % self.change))
+        self.assertEqual(self.client.get(url, {'from': 'docs/guide.txt'}).status_code, 200)
+        url = reverse('diff', kwargs=dict(repo='test', commitishPath='%s/missing.txt' % self.change))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class FileStatsTest(RepositoryTestCase):
+    def test_batched(self):
+        self.git('checkout', '-q', '-b', 'topic')
+        self.commit({'topic.txt': 'a\nb\n', 'image.png': b'\x89PNG\0\1\2'}, 'Topic')
+        self.git('checkout', '-q', 'master')
+        self.commit({'main.py': 'print("bye")\nprint("again")\n', 'docs/guide.txt': None}, 'Change')
+        self.timestamp += 3600
+        self.git('merge', '-q', '--no-ff', '-m', 'Merge topic', 'topic')
+        repository = self.repository()
+        shas = self.git('log', '--format=%H').split()
+        self.assertEqual(len(shas), 4)
+
+        file_stats_cache.clear()
+        with count_git_commands([0]) as counter:
+            stats = get_file_stats(repository, shas)
+        self.assertEqual(counter[0], 1)
+        for sha in shas:
+            total = repository.commit(sha).stats.total
+            self.assertEqual(stats[sha], dict(files=total['files'], insertions=total['insertions'], deletions=total['deletions']), sha)
+
+        # Known stats are never read again
+        file_stats_cache.clear()
+        with count_git_commands([0]) as counter:
+            self.assertEqual(get_file_stats(repository, shas), stats)
+        self.assertEqual(counter[0], 0)
+
+    def test_commits_view(self):
+        self.commit({'main.py': 'print("bye")\n'}, 'Change')
+        response = self.client.get(reverse('commits', kwargs=dict(repo='test', commitishPath='master')))
+        self.assertEqual(response.status_code, 200)
+        commit = response.context['commits'][0][1][0]
+        self.assertEqual((commit.changedFiles, commit.insertions, commit.deletions), (1, 1, 1))
+
+
+class CommitRecordsTest(RepositoryTestCase):
+    def test_records_match_gitpython(self):
+        self.commit({'main.py': 'print("bye")\n'}, 'Change main\n\nWith a body.')
+        self.timestamp += 3600
+        self.git('commit', '-q', '--allow-empty', '-m', 'Ünïcode', '--author', 'Jösé <jose@example.com>')
+        repository = self.repository()
+        records = list(iter_commits(repository, 'master'))
+        expected = list(repository.iter_commits('master'))
+        self.assertEqual([r.hexsha for r in records], [c.hexsha for c in expected])
+        for record, commit in zip(records, expected):
+            self.assertEqual(record.parents, tuple(p.hexsha for p in commit.parents))
+            self.assertEqual(tuple(record.author), (commit.author.name, commit.author.email))
+            self.assertEqual(record.authored_date, commit.authored_date)
+            self.assertEqual(record.committed_date, commit.committed_date)
+            self.assertEqual(record.message.rstrip('\n'), commit.message.rstrip('\n'))
+        self.assertEqual(records[1].summary, 'Change main')
+        self.assertEqual(records[0].author.name, 'Jösé')
+
+    def test_paths_and_pages(self):
+        change = self.commit({'main.py': 'print("bye")\n'}, 'Change main')
+        docs = self.commit({'docs/guide.txt': 'line 1\n'}, 'Change docs')
+        repository = self.repository()
+        records = list(iter_commits(repository, 'master', 'main.py'))
+        self.assertEqual([r.hexsha for r in records], [change, self.initial])
+        # Parents are rewritten to the previous commit touching the path
+        self.assertEqual(records[0].parents, (self.initial,))
+        self.assertEqual([r.hexsha for r in iter_commits(repository, 'master', max_count=1, skip=1)], [change])
+
+        file_stats_cache.clear()
+        commit_cache.clear()
+        with count_git_commands([0]) as counter:
+            self.assertEqual([r.hexsha for r in get_commits(repository, [self.initial, docs, change])], [self.initial, docs, change])
+            self.assertEqual(get_commits(repository, [docs])[0].summary, 'Change docs')
+        self.assertEqual(counter[0], 1)
+
+
+class LastCommitsTest(RepositoryTestCase):
+    def expected(self, sha, path, names):
+        return dict((name, self.git('log', '-1', '--format=%H', sha, '--', '/'.join(filter(None, [path, name])))) for name in names)
+
+    def test_last_commits(self):
+        docs = self.commit({'docs/api.txt': 'api\n'}, 'Add api docs')
+        main = self.commit({'main.py': 'print("bye")\n'}, 'Change main')
+        repository = self.repository()
+        last_commits_cache.clear()
+        names = ['docs', 'README.md', 'main.py']
+        self.assertEqual(get_last_commits(repository, main, '', names), self.expected(main, '', names))
+        self.assertEqual(get_last_commits(repository, main, 'docs', ['api.txt', 'guide.txt']),
+                         {'api.txt': docs, 'guide.txt': self.initial})
+
+        # Derived from the answer for the parent, without walking history
+        readme = self.commit({'README.md': '# Changed\n'}, 'Change README')
+        with patch_setting(commits, '_walk_last_commits', None):
+            self.assertEqual(get_last_commits(repository, readme, '', names), self.expected(readme, '', names))
+
+    def test_tree_view(self):
+        main = self.commit({'main.py': 'print("bye")\n'}, 'Change main')
+        response = self.client.get(reverse('tree', kwargs=dict(repo='test', commitishPath='master')))
+        self.assertEqual(dict((f.name, f.last_commit.hash) for f in response.context['files']),
+                         {'docs': self.initial, 'README.md': self.initial, 'main.py': main})
+
+    def test_walk_budget(self):
+        main = self.commit({'main.py': 'print("bye")\n'}, 'Change main')
+        repository = self.repository()
+        last_commits_cache.clear()
+        self.assertEqual(get_last_commits(repository, main, '', ['docs', 'main.py'], 1), {'main.py': main})
+        # Partial answers aren't cached
+        self.assertEqual(get_last_commits(repository, main, '', ['docs', 'main.py'], 1), {'main.py': main})
+
+    def test_tree_view_pending(self):
+        main = self.commit({'main.py': 'print("bye")\n'}, 'Change main')
+        last_commits_cache.clear()
+        jobs.job_store.execute('DELETE FROM jobs')
+        url = reverse('tree', kwargs=dict(repo='test', commitishPath='master'))
+        with patch_setting(views, 'LAST_COMMITS_WALK', 1), patch_setting(jobs, 'JOBS', True), patch_setting(jobs, '_start_workers', lambda: None):
+            try:
+                response = self.client.get(url)
+                self.assertEqual(dict((f.name, f.pending) for f in response.context['files']),
+                                 {'docs': True, 'README.md': True, 'main.py': False})
+                self.assertTrue(response['ETag'].startswith('W/'))
+                self.assertContains(response, 'Looking up the last commit')
+                self.assertTrue(jobs.run_next())
+                response = self.client.get(url)
+            finally:
+                jobs.job_store.execute('DELETE FROM jobs')
+        self.assertEqual(dict((f.name, f.last_commit.hash) for f in response.context['files']),
+                         {'docs': self.initial, 'README.md': self.initial, 'main.py': main})
+        self.assertFalse(response['ETag'].startswith('W/'))
+
+
+class BlobRawTest(RepositoryTestCase):
+    content = ''.join('line %d\n' % i for i in range(100)).encode('ascii')
+
+    def setUp(self):
+        super(BlobRawTest, self).setUp()
+        self.sha = self.commit({'data.txt': self.content}, 'Add data')
+        self.url = reverse('blob_raw', kwargs=dict(repo='test', commitishPath='master/data.txt'))
+
+    def content_of(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_ranges(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content_of(response), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        etag = response['ETag']
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=7-13')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 7-13/%d' % len(self.content))
+        self.assertEqual(self.content_of(response), self.content[7:14])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(self.content_of(response), self.content[-5:])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1,10-11')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        body = self.content_of(response)
+        self.assertIn(b'Content-Range: bytes 0-1/', body)
+        self.assertIn(b'Content-Range: bytes 10-11/', body)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=%d-' % len(self.content))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % len(self.content))
+
+        # Ranges only apply to the version they were asked against
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content_of(response), self.content)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_hot_blob_cache(self):
+        repository = self.repository()
+        blob = repository.tree('master')['data.txt']
+        blobs.blob_hits.clear()
+        with patch_setting(views, 'BLOB_CACHE_MIN_SIZE', 100), patch_setting(blobs, 'BLOB_CACHE_MIN_SIZE', 100):
+            # Cached once requested often enough
+            self.assertEqual(self.content_of(self.client.get(self.url)), self.content)
+            self.assertIsNone(get_cached_blob(repository, blob.hexsha))
+            self.assertEqual(self.content_of(self.client.get(self.url)), self.content)
+            path = get_cached_blob(repository, blob.hexsha)
+            self.assertIsNotNone(path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.content)
+
+            # And then served from the cache
+            response = self.client.get(self.url, HTTP_RANGE='bytes=5-9')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(self.content_of(response), self.content[5:10])
+
+            # Or streamed, if pruned meanwhile
+            with patch_setting(views, 'get_cached_blob', lambda repository, sha: path + '.pruned'):
+                response = self.client.get(self.url, HTTP_RANGE='bytes=5-9')
+                self.assertEqual(self.content_of(response), self.content[5:10])
+
+    def test_first_range_is_streamed(self):
+        repository = self.repository()
+        blob = repository.tree('master')['data.txt']
+        with patch_setting(views, 'BLOB_CACHE_MIN_SIZE', 100), patch_setting(blobs, 'BLOB_CACHE_MIN_SIZE', 100):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=500-509,600-')
+            self.assertEqual(response.status_code, 206)
+            body = self.content_of(response)
+            self.assertIn(self.content[500:510], body)
+            self.assertIn(self.content[600:], body)
+
+            # While the blob is written to the cache in the background
+            for _ in range(50):
+                if get_cached_blob(repository, blob.hexsha) is not None:
+                    break
+                time.sleep(0.1)
+            with open(get_cached_blob(repository, blob.hexsha), 'rb') as f:
+                self.assertEqual(f.read(), self.content)
+            self.assertEqual(blobs._filling, set())
+
+        # Ranges out of order can't be read from a stream
+        request = RequestFactory().get(self.url, HTTP_RANGE='bytes=600-609,0-9')
+        response = range_response(request, blobs.BlobReader(blobs.iter_blob(repository, blob)), blob.size, 'text/plain', seekable=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content_of(response), self.content)
+
+
+class InstrumentationTest(RepositoryTestCase):
+    def test_server_timing(self):
+        response = self.client.get(reverse('tree', kwargs=dict(repo='test', commitishPath='master')))
+        timings = [timing.split(';')[0] for timing in response['Server-Timing'].split(', ')]
+        self.assertEqual(timings[-1], 'total')
+        self.assertTrue(any(timing.startswith('git') for timing in timings), timings)
+
+        metrics = format_metrics()
+        self.assertIn('gitlist_request_duration_seconds_bucket{le="+Inf",repo="test",view="tree"}', metrics)
+        self.assertIn('gitlist_request_duration_seconds_count{repo="test",view="tree"}', metrics)
+        self.assertIn('# TYPE gitlist_operations_total counter', metrics)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'view="tree"', response.content)
+
+    def test_operations(self):
+        metrics = RequestMetrics()
+        instrumentation.record('test.op', 0.25, metrics=metrics)
+        instrumentation.record('test.op', 0.25, count=2, metrics=metrics)
+        self.assertEqual(format_server_timing(metrics, 1), 'test.op;dur=500.0;desc="3", total;dur=1000.0')
+
+        # Generators are timed (and recorded) once consumed
+        @instrumented('test.generator')
+        def generate():
+            yield 1
+            yield 2
+
+        iterator = generate()
+        self.assertNotIn('operation="test.generator"', format_metrics())
+        self.assertEqual(list(iterator), [1, 2])
+        self.assertIn('gitlist_operations_total{operation="test.generator",repo=""} 1', format_metrics())
+
+    def test_labels_escaped(self):
+        instrumentation.record('test "quoted"\\op', 0)
+        self.assertIn('operation="test \\"quoted\\"\\\\op"', format_metrics())
+
+
+class BulkheadTest(RepositoryTestCase):
+    def test_limits(self):
+        bulkhead = Bulkhead(limit=2, repository_limit=1, timeout=0, retry_after=1)
+        self.assertTrue(bulkhead.acquire('a'))
+        self.assertFalse(bulkhead.acquire('a'))
+        self.assertTrue(bulkhead.acquire('b'))
+        self.assertFalse(bulkhead.acquire('c'))
+        bulkhead.release('a')
+        self.assertTrue(bulkhead.acquire('c'))
+        self.assertEqual(bulkhead.repositories, {'b': 1, 'c': 1})
+
+    def test_waits_for_release(self):
+        bulkhead = Bulkhead(limit=1, repository_limit=1, timeout=5, retry_after=1)
+        self.assertTrue(bulkhead.acquire('a'))
+        timer = threading.Timer(0.1, bulkhead.release, ['a'])
+        timer.start()
+        self.assertTrue(bulkhead.acquire('a'))
+        timer.join()
+        self.assertEqual(bulkhead.active, 1)
+
+    def test_rejected(self):
+        bulkhead = Bulkhead(limit=1, repository_limit=1, timeout=0, retry_after=7)
+        bulkhead.acquire('test')
+        with patch_setting(bulkheads, '_bulkheads', {'browse': bulkhead}):
+            response = self.client.get(reverse('tree', kwargs=dict(repo='test', commitishPath='master')))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '7')
+            self.assertIn('no-store', response['Cache-Control'])
+
+            # Served again once a slot is free
+            bulkhead.release('test')
+            self.assertEqual(self.client.get(reverse('tree', kwargs=dict(repo='test', commitishPath='master'))).status_code, 200)
+            self.assertEqual(bulkhead.active, 0)
+
+    def test_streaming_holds_slot(self):
+        bulkhead = Bulkhead(limit=1, repository_limit=1, timeout=0, retry_after=1)
+        with patch_setting(bulkheads, '_bulkheads', {'browse': bulkhead}):
+            response = self.client.get(reverse('blob_raw', kwargs=dict(repo='test', commitishPath='master/main.py')))
+            self.assertEqual(bulkhead.active, 1)
+            self.assertEqual(b''.join(response.streaming_content), b'print("hello")\n')
+            self.assertEqual(bulkhead.active, 0)
+
+    def test_releasing_iterator(self):
+        released = []
+        iterator = ReleasingIterator(iter([1, 2]), lambda: released.append(True))
+        self.assertEqual(list(iterator), [1, 2])
+        iterator.close()
+        self.assertEqual(released, [True])
+
+        # Released when closed unconsumed, closing what it iterates
+        closed = []
+
+        def generate():
+            try:
+                yield 1
+            finally:
+                closed.append(True)
+
+        generator = generate()
+        next(generator)
+        iterator = ReleasingIterator(generator, lambda: released.append(True))
+        iterator.close()
+        self.assertEqual(released, [True, True])
+        self.assertEqual(closed, [True])
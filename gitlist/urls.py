@@ -39,6 +39,7 @@ FORMATS = {
 urlpatterns = patterns('gitlist.views',
     # Main
     url(r'^$', 'homepage', name='homepage'),
+    url(r'^metrics$', 'metrics', name='metrics'),
     url(r'^{repo}/stats/$'.format(**FORMATS), 'stats', name='stats'),
     url(r'^{repo}/stats/{branch}/$'.format(**FORMATS), 'stats', name='stats'),
     url(r'^{repo}/rss/$'.format(**FORMATS), 'rss', name='rss'),
@@ -56,12 +57,14 @@ urlpatterns = patterns('gitlist.views',
     url(r'^{repo}/commits/{branch}/search/$'.format(**FORMATS), 'searchcommits', name='searchcommits'),
     url(r'^{repo}/commits/{commitishPath}$'.format(**FORMATS), 'commits', name='commits'),
     url(r'^{repo}/commit/{commitishPath}$'.format(**FORMATS), 'commit', name='commit'),
+    url(r'^{repo}/diff/{commitishPath}$'.format(**FORMATS), 'diff', name='diff'),
     url(r'^{repo}/blame/{commitishPath}$'.format(**FORMATS), 'blame', name='blame'),
     # Tree
     url(r'^{repo}/tree/$'.format(**FORMATS), 'tree', name='tree'),
     url(r'^{repo}/tree/{branch}/search/$'.format(**FORMATS), 'searchbranch', name='searchbranch'),
     url(r'^{repo}/tree/{commitishPath}/$'.format(**FORMATS), 'tree', name='tree'),
     url(r'^{repo}/{format}ball/{branch}/$'.format(**FORMATS), 'archive', name='archive'),
+    url(r'^{repo}/refs/$'.format(**FORMATS), 'refs', name='refs'),
     url(r'^{repo}/{branch}/$'.format(**FORMATS), 'branch', name='branch'),
     url(r'^{repo}/$'.format(**FORMATS), 'repository', name='repository'),
 )
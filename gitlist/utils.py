@@ -3,10 +3,197 @@ from __future__ import absolute_import, unicode_literals
 
 import os
 import re
+import hashlib
+import threading
+from collections import OrderedDict
+
 import git
 
 from django.conf import settings
+from django.core.signals import request_finished, request_started
 from django.http import Http404
+from django.utils.encoding import force_bytes
+
+from .cache import LRUCache
+
+REPOSITORY_POOL_SIZE = getattr(settings, 'GITLIST_REPOSITORY_POOL_SIZE', 32)
+
+
+def _stat_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+def _stat_ref_dirs(path, stamps):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    stamps.append((path, st.st_ino, st.st_mtime, st.st_size))
+    # Directories without subdirectories have 2 links on most filesystems,
+    # so listing the (possibly huge) leaf directories is skipped there.
+    if st.st_nlink == 2:
+        return
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        return  # Deleted while walking
+    for name in names:
+        child = os.path.join(path, name)
+        if os.path.isdir(child):
+            _stat_ref_dirs(child, stamps)
+
+
+def get_refs_stamp(git_dir):
+    """
+    Returns a fingerprint of the refs of the repository at git_dir, from
+    stat alone: git writes HEAD, packed-refs and every loose ref to a lock
+    file renamed over the old one, so any ref created, updated, deleted or
+    packed changes HEAD, packed-refs or the directory (however deeply
+    nested under refs/) holding it, without any ref file being read.
+    """
+    stamps = [_stat_stamp(os.path.join(git_dir, 'HEAD')), _stat_stamp(os.path.join(git_dir, 'packed-refs'))]
+    _stat_ref_dirs(os.path.join(git_dir, 'refs'), stamps)
+    return hashlib.sha1(force_bytes(repr(stamps))).hexdigest()
+
+
+_request = threading.local()  # Refs stamps taken while serving the current request
+
+
+def _start_request(**kwargs):
+    _request.stamps = {}
+
+
+def _finish_request(**kwargs):
+    _request.stamps = None
+
+request_started.connect(_start_request)
+request_finished.connect(_finish_request)
+
+
+def get_request_refs_stamp(git_dir):
+    """
+    Like get_refs_stamp, but taken once per request (by the thread serving
+    it): the repository pool, the ref snapshot and the ETags all share it,
+    so every part of the request sees the same refs.
+    """
+    stamps = getattr(_request, 'stamps', None)
+    if stamps is None:
+        return get_refs_stamp(git_dir)
+    try:
+        return stamps[git_dir]
+    except KeyError:
+        stamp = stamps[git_dir] = get_refs_stamp(git_dir)
+        return stamp
+
+
+class RepositoryPool(object):
+    """
+    Process-wide pool of ``git.Repo`` handles keyed by repository name,
+    bounded to the ``maxsize`` most recently used repositories.
+
+    GitPython's persistent ``git cat-file --batch`` helpers can't be shared
+    between threads, so every thread gets its own warm handle for each
+    pooled repository. Handles are discarded (and their helper processes
+    reaped) as soon as the refs of the repository change.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, repo, path):
+        with self.lock:
+            try:
+                entry = self.entries.pop(repo)
+            except KeyError:
+                entry = threading.local()
+            self.entries[repo] = entry
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        repository = getattr(entry, 'repository', None)
+        if repository is not None:
+            if entry.path == path and entry.stamp == get_request_refs_stamp(repository.git_dir):
+                return repository
+            repository.git.clear_cache()
+
+        repository = git.Repo(path)
+        entry.repository = repository
+        entry.path = path
+        entry.stamp = get_request_refs_stamp(repository.git_dir)
+        return repository
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+repository_pool = RepositoryPool(REPOSITORY_POOL_SIZE)
+
+
+class RefSnapshot(object):
+    """
+    Snapshot of the branches and tags of a repository, read with a single
+    ``git for-each-ref``. Ref names are kept in a dictionary so the longest
+    ref prefixing a commit-ish path is found with one lookup per path
+    component, regardless of the number of refs in the repository.
+    """
+    def __init__(self, repository):
+        self.branches = []
+        self.tags = []
+        self.refs = {}
+        output = repository.git.for_each_ref('--format=%(objectname) %(*objectname) %(refname)', 'refs/heads', 'refs/tags')
+        for line in output.splitlines():
+            sha, peeled, refname = line.split(' ', 2)
+            if refname.startswith('refs/heads/'):
+                name = refname[11:]
+                self.branches.append(name)
+            else:
+                name = refname[10:]
+                self.tags.append(name)
+            # Like git, tags shadow branches with the same name
+            if name not in self.refs or refname.startswith('refs/tags/'):
+                self.refs[name] = peeled or sha
+        self.branches.sort()
+        self.tags.sort()
+
+        head = repository.head
+        try:
+            self.head_sha = head.commit.hexsha
+        except ValueError:
+            self.head_sha = None  # Empty repository
+        self.head = None if head.is_detached else head.reference.name
+
+    def match(self, commitishPath):
+        """
+        Returns the longest ref name which commitishPath starts with (followed
+        by a slash or by the end of the string) or None.
+        """
+        refs = self.refs
+        prefix = commitishPath
+        while prefix:
+            if prefix in refs:
+                return prefix
+            prefix = prefix.rpartition('/')[0]
+
+ref_snapshots = LRUCache(REPOSITORY_POOL_SIZE)
+
+
+def get_ref_snapshot(repository):
+    """
+    Returns the RefSnapshot of repository, re-reading the refs only after
+    they change.
+    """
+    stamp = get_request_refs_stamp(repository.git_dir)
+    cached = ref_snapshots.get(repository.git_dir)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    snapshot = RefSnapshot(repository)
+    ref_snapshots.set(repository.git_dir, (stamp, snapshot))
+    return snapshot
 
 
 def get_repository_from_name(repo):
@@ -15,12 +202,42 @@ def get_repository_from_name(repo):
         raise Http404("Repository %s is not configured" % repo)
     path = os.path.expanduser(path)
     try:
-        repository = git.Repo(path)
+        repository = repository_pool.get(repo, path)
     except (git.InvalidGitRepositoryError, git.NoSuchPathError) as e:
         raise Http404("Invalid Git Repository: %s" % e)
     return repository
 
 
+def iter_git_lines(repository, command, *args):
+    """
+    Runs the git command with args, yielding its output line by line (as
+    bytes, without the newline) while it's being produced, so big outputs
+    such as whole history logs never sit in memory. The process is killed
+    if the caller stops iterating early.
+    """
+    proc = getattr(repository.git, command)(*args, as_process=True)
+    for line in proc.stdout:
+        yield line.rstrip(b'\n')
+    proc.wait()
+
+
+def iter_git_records(repository, command, *args):
+    """
+    Like iter_git_lines, but for commands whose records are NUL terminated
+    (such as ``git log -z``).
+    """
+    proc = getattr(repository.git, command)(*args, as_process=True)
+    pending = b''
+    for chunk in iter(lambda: proc.stdout.read(65536), b''):
+        records = (pending + chunk).split(b'\0')
+        pending = records.pop()
+        for record in records:
+            yield record
+    if pending:
+        yield pending
+    proc.wait()
+
+
 # @brief Return commitish, path parsed from commitishPath, based on
 # what's in repo. Raise a 404 if $branchpath does not represent a
 # valid branch and path.
@@ -29,41 +246,69 @@ def get_repository_from_name(repo):
 # separated by /, since route regexes are not enough to get that right.
 #
 def parse_commitish_path(commitishPath, repository):
-    for r in repository.branches + repository.tags:
-        if commitishPath.startswith(r.name):
-            commitish = r.name
-            path = commitishPath[len(commitish) + 1:]
-            break
-    else:
-        try:
-            slash_position = commitishPath.index('/')
-            commitish = commitishPath[:slash_position]
-            path = commitishPath[slash_position + 1:]
-        except ValueError:
-            commitish = commitishPath
-            path = ''
+    refs = get_ref_snapshot(repository)
+    commitishPath = commitishPath or ''
 
-    try:
-        commit = repository.commit(commitish)
-    except git.BadName as e:
-        if not path:
-            commitish, path = '', commitish
+    commitish = refs.match(commitishPath)
+    if commitish:
+        path = commitishPath[len(commitish) + 1:]
+    else:
+        commitish, _, path = commitishPath.partition('/')
+        if commitish:
             try:
-                commit = repository.commit(commitish)
-            except git.BadName as e:
-                raise ValueError("%s" % e)
-        raise ValueError("%s" % e)
+                repository.commit(commitish)
+            except (git.BadName, git.BadObject, ValueError) as e:
+                if path:
+                    raise ValueError("%s" % e)
+                commitish, path = '', commitish
 
     if not commitish:
-        commitish = commit.name_rev.split()[-1]
+        # Default to whatever HEAD points to, without asking `git name-rev`
+        if refs.head_sha is None:
+            raise ValueError("Repository has no commits")
+        commitish = refs.head or refs.head_sha
 
     return commitish, path
 
 
+def parse_line_range(value, total, window):
+    """
+    Parses a ``?lines=first-last`` (1-based, inclusive) request parameter
+    for a file of total lines, returning the (start, stop) slice to show,
+    at most window lines long. Without a valid value, the first window
+    lines are shown.
+    """
+    try:
+        first, _, last = value.partition('-')
+        start = max(0, int(first) - 1)
+        stop = min(total, start + window, int(last) if last else start + window)
+    except (AttributeError, ValueError):
+        start, stop = 0, min(total, window)
+    if stop <= start:
+        start, stop = 0, min(total, window)
+    return start, stop
+
+
+def get_line_window(start, stop, total, window):
+    """
+    Returns the navigation of the lines [start, stop) of a file of total
+    lines shown window lines at a time, or None if all of them are shown.
+    """
+    if start == 0 and stop == total:
+        return None
+    return dict(
+        first=start + 1,
+        last=stop,
+        total=total,
+        previous='%d-%d' % (max(1, start + 1 - window), start) if start else None,
+        next='%d-%d' % (stop + 1, min(total, stop + window)) if stop < total else None,
+    )
+
+
 def get_readme(tree):
+    """
+    Returns the README blob of tree, or None.
+    """
     for blob in tree.blobs:
         if re.match(r'readme.*', blob.name, re.I):
-            return {
-                'filename': blob.name,
-                'content': blob.data_stream.read,
-            }
+            return blob
@@ -2,118 +2,69 @@
 from __future__ import absolute_import, unicode_literals
 
 import os
-import re
 import json
 import datetime
-import warnings
+from io import BytesIO
 from hashlib import md5
-from cStringIO import StringIO
 
-from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect, CompatibleStreamingHttpResponse, Http404
 from django.shortcuts import render
 from django.template.defaultfilters import filesizeformat
+from django.utils.cache import patch_cache_control
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import urlencode
 
+from .archive import build_archive, get_cached_archive, stream_archive
+from .blame import BLAME_WINDOW, get_blame
+from .blobs import BLOB_CACHE_SIZE, BLOB_CACHE_MIN_SIZE, BLOB_VIEW_MAX_SIZE, BLOB_WINDOW, BlobReader, fill_blob_cache, get_cached_blob, get_line_index, is_binary_blob, is_hot, iter_blob, read_lines
 from .const import DEFAULT_FILE_TYPES, DEFAULT_BINARY_TYPES
-from .utils import get_repository_from_name, parse_commitish_path, get_readme
+from .commits import count_commits, load_cursor, save_cursor, get_cursors, get_commits_page, get_commit, get_commits, get_file_stats, get_last_commits, LAST_COMMITS_WALK
+from .decorators import bulkhead, commit_condition, mark_provisional, resolve_commit
+from .diff import load_commit_diffs, load_file_diff
+from .instrumentation import format_metrics
+from .jobs import JOBS, JOB_REFRESH, JobFailed, run_job
+from .menus import get_ref_menu, render_ref_menu
+from .metadata import get_repositories_metadata
+from .network import parse_lanes, format_lanes, get_network_chunk
+from .render import get_highlight_css, render_blob
+from .responses import file_response, range_response
+from .search import SEARCH_MIN_QUERY, search_tree, search_commits
+from .stats import get_stats, get_tree_stats
+from .utils import get_repository_from_name, get_ref_snapshot, parse_commitish_path, parse_line_range, get_line_window, get_readme
 
 COMMITS_PER_PAGE = 15
 SEARCH_PER_PAGE = 50
-STREAM_CHUNK_SIZE = 4096
 
 
-class WrappedDiff(object):
-    CHUNK_RE = re.compile(r'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
-
-    def __init__(self, diff, encoding):
-        self.diff = diff
-        self.encoding = encoding
+class WrappedObject(object):
+    def __init__(self, obj, stats=None, last_commit=None, pending=False):
+        self.obj = obj
+        self.stats = stats
+        self.last_commit = last_commit
+        self.pending = pending
 
     def __getattr__(self, attr):
-        return getattr(self.diff, attr)
+        return getattr(self.obj, attr)
 
     @property
-    def file(self):
-        if self.diff.b_blob:
-            return self.diff.b_blob.path
-        if self.diff.a_blob:
-            return self.diff.a_blob.path
-        return 'unknown'
+    def size(self):
+        if self.obj.type == 'tree':
+            # Directories get the size of everything under them
+            return self.stats and self.stats['size']
+        return self.obj.size
 
     @property
-    def index(self):
-        return "index %s..%s" % (self.diff.a_blob.hexsha[:7], self.diff.b_blob.hexsha[:7])
-
-    def getLines(self):
-        lines = []
-        if self.diff.new_file:
-            lines.append(dict(
-                getType='chunk',
-                getNumOld='',
-                getNumNew='',
-                getLine="new file, mode %o" % (self.diff.b_mode,)
-            ))
-        elif self.diff.deleted_file:
-            lines.append(dict(
-                getType='chunk',
-                getNumOld='',
-                getNumNew='',
-                getLine="file deleted"
-            ))
-        elif self.diff.renamed:
-            lines.append(dict(
-                getType='chunk',
-                getNumOld='',
-                getNumNew='',
-                getLine="file renamed from %s to %s" % (self.diff.rename_from, self.diff.rename_to,)
-            ))
-
-        try:
-            diff_lines = self.diff.diff.decode(self.encoding)
-        except Exception:
-            diff_lines = "Binary content (%s)" % filesizeformat(len(self.diff.diff))
-        for line in diff_lines.split('\n'):
-            if line[:4] in ('', '--- ', '+++ '):
-                continue
-            chunk = self.CHUNK_RE.match(line)
-            if chunk:
-                getType = 'chunk'
-                num_old = int(chunk.group(1))
-                num_new = int(chunk.group(3))
-                getNumOld = '...'
-                getNumNew = '...'
-            elif line[0] == '-':
-                getType = 'old'
-                getNumOld = num_old
-                getNumNew = ''
-                num_old += 1
-            elif line[0] == '+':
-                getType = 'new'
-                getNumOld = ''
-                getNumNew = num_new
-                num_new += 1
-            elif line[0] == ' ':
-                getType = None
-                getNumOld = num_old
-                getNumNew = num_new
-                num_old += 1
-                num_new += 1
-            else:
-                continue
-            lines.append(dict(
-                getType=getType,
-                getNumOld=getNumOld,
-                getNumNew=getNumNew,
-                getLine=line,
-            ))
-        return lines
+    def files(self):
+        return self.stats and self.stats['files']
 
 
 class WrappedCommit(object):
-    def __init__(self, commit, paths=None):
+    def __init__(self, repository, commit, paths=None, file_stats=None):
+        self.repository = repository
         self.commit = commit
         self.paths = paths
+        self.file_stats = file_stats
 
     def __getattr__(self, attr):
         return getattr(self.commit, attr)
@@ -140,17 +91,20 @@ class WrappedCommit(object):
 
     @property
     def changedFiles(self):
-        return self.commit.stats.total['files']
+        return self.get_file_stats()['files']
 
     @property
-    def diffs(self):
-        if self.commit.parents:
-            parent = self.commit.parents[0]
-            diffs = parent.diff(self.commit, paths=self.paths, create_patch=True)
-            diffs = [WrappedDiff(diff, self.commit.encoding) for diff in diffs]
-        else:
-            diffs = []
-        return diffs
+    def insertions(self):
+        return self.get_file_stats()['insertions']
+
+    @property
+    def deletions(self):
+        return self.get_file_stats()['deletions']
+
+    def get_file_stats(self):
+        if self.file_stats is None:
+            self.file_stats = get_file_stats(self.repository, [self.commit.hexsha])[self.commit.hexsha]
+        return self.file_stats
 
     @property
     def message(self):
@@ -158,92 +112,116 @@ class WrappedCommit(object):
 
     @property
     def body(self):
-        return self.commit.message.split('\n', 1)[1].strip()
+        return ''.join(self.commit.message.split('\n', 1)[1:]).strip()
+
+
+def wrap_commits(repository, commits):
+    """
+    Wraps a page of commits, gathering the file stats of all of them at once.
+    """
+    commits = list(commits)
+    file_stats = get_file_stats(repository, [commit.hexsha for commit in commits])
+    return [WrappedCommit(repository, commit, file_stats=file_stats.get(commit.hexsha)) for commit in commits]
+
+
+def get_page_cursor(request, repository, branch, path, page=None):
+    """
+    Returns the cursor of the commits page requested (None for the first
+    one), the token of the cursor of the page before it, the (0 based)
+    page number and, for old style ``?page=N`` URLs and unknown cursors,
+    the URL to redirect to.
+    """
+    value = request.GET.get('from')
+    if value is not None:
+        cursor = load_cursor(repository, value)
+        if cursor is None:
+            return None, None, 0, request.path
+        return cursor + (None,)
+    if page is None:
+        try:
+            page = int(request.GET.get('page', 0))
+        except ValueError:
+            page = 0
+    if page > 0:
+        skips = [page * COMMITS_PER_PAGE]
+        if page > 1:
+            skips.insert(0, (page - 1) * COMMITS_PER_PAGE)
+        previous = None
+        for skip, cursor in zip(skips, get_cursors(repository, branch, path, skips)):
+            previous = save_cursor(repository, cursor, previous, skip // COMMITS_PER_PAGE)
+        return None, None, page, '{path}?from={token}'.format(path=request.path, token=previous)
+    return None, None, 0, None
+
+
+def computing(request, context, message):
+    """
+    Renders the page shown while a background job runs, which reloads
+    itself (with a GET, even for searches posted) until the result is in.
+    """
+    refresh_url = request.path
+    params = request.POST if request.method == 'POST' else request.GET
+    if params:
+        refresh_url += '?' + urlencode([(key, value) for key, value in params.items() if key != 'csrfmiddlewaretoken'])
+    response = render(request, 'computing.html', dict(context, message=message, refresh=JOB_REFRESH, refresh_url=refresh_url))
+    response.status_code = 202
+    # Never revalidated, or the reloads would keep getting this page
+    patch_cache_control(response, no_cache=True, no_store=True, must_revalidate=True)
+    return response
 
 
 # Main
 def homepage(request):
-    repositories = []
-    for repo in settings.GITLIST_REPOSITORIES:
-        try:
-            repository = get_repository_from_name(repo)
-        except Http404 as e:
-            warnings.warn("Repository error: %s" % e)
-            continue
-        repositories.append(dict(
-            name=repo,
-            description=repository.description
-        ))
     return render(request, 'index.html', {
-        'repositories': repositories,
+        'repositories': get_repositories_metadata(),
     })
 
 
+def metrics(request):
+    return HttpResponse(format_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@commit_condition
+@bulkhead('expensive')
 def stats(request, repo, branch=''):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(branch, repository)
-    branches = repository.branches
-    tags = repository.tags
-
-    authors = {}
-    for c in repository.iter_commits(branch, paths=path):
-        try:
-            authors[c.author] += 1
-        except KeyError:
-            authors[c.author] = 1
-
-    extensions = {}
-    total_files = 0
-    total_size = 0
-    for blob in repository.tree().traverse():
-        if blob.type == 'blob':
-            total_files += 1
-            total_size += blob.size
-            _, ext = os.path.splitext(blob.name)
-            if ext:
-                try:
-                    extensions[ext] += 1
-                except KeyError:
-                    extensions[ext] = 1
-
-    stats = dict(
-        extensions=sorted(extensions.items(), key=lambda o: o[1], reverse=True),
-        files=total_files,
-        size=total_size,
-    )
-
-    authors = sorted((dict(
-        email=a.email,
-        name=a.name,
-        commits=c,
-    ) for a, c in authors.items()), key=lambda o: o['commits'], reverse=True)
+    ref_menu = get_ref_menu(repository, repo)
 
     breadcrumbs = [{'dir': 'Statistics', 'path': ''}]
-    return render(request, 'stats.html', {
+    context = {
         'page': 'stats',
         'repo': repo,
         'branch': branch,
-        'branches': branches,
-        'tags': tags,
-        'stats': stats,
-        'authors': authors,
+        'ref_menu': ref_menu,
         'breadcrumbs': breadcrumbs,
-    })
+    }
+
+    sha = repository.commit(branch).hexsha
+    done, result = run_job(repository, repo, get_stats, sha, branch, path)
+    if not done:
+        return computing(request, context, "Computing statistics...")
+    commit_stats, stats = result
+
+    return render(request, 'stats.html', dict(context, **{
+        'stats': stats,
+        'authors': commit_stats['authors'],
+        'commits': commit_stats['commits'],
+        'weeks': commit_stats['weeks'],
+    }))
 
 
+@commit_condition
+@bulkhead('browse')
 def rss(request, repo, branch=None):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(branch, repository)
 
-    try:
-        page = int(request.GET.get('page', 0))
-    except ValueError:
-        page = 0
+    cursor, _, _, redirect = get_page_cursor(request, repository, branch, path)
+    if redirect is not None:
+        return HttpResponseRedirect(redirect)
 
-    commits = []
-    for commit in repository.iter_commits(branch, paths=path, max_count=COMMITS_PER_PAGE, skip=page * COMMITS_PER_PAGE):
-        commit = WrappedCommit(commit)
-        commits.append(commit)
+    commits, _ = get_commits_page(repository, branch, path, cursor, COMMITS_PER_PAGE)
+    commits = wrap_commits(repository, commits)
 
     response = render(request, 'rss.html', {
         'repo': repo,
@@ -254,11 +232,12 @@ def rss(request, repo, branch=None):
 
 
 # Blob
+@commit_condition
+@bulkhead('browse')
 def blob(request, repo, commitishPath):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(commitishPath, repository)
-    branches = repository.branches
-    tags = repository.tags
+    ref_menu = get_ref_menu(repository, repo)
 
     tree = repository.tree(branch)
     if path:
@@ -268,10 +247,26 @@ def blob(request, repo, commitishPath):
     else:
         split_path = []
 
-    blob = tree.data_stream.read
     file = tree.name
     fileType = DEFAULT_FILE_TYPES.get(os.path.splitext(tree.name)[1], '')
 
+    # Big files are shown a window of lines at a time, binary ones not at all
+    blob = window = None
+    rendered = False
+    binary = fileType != 'image' and is_binary_blob(repository, tree)
+    if fileType != 'image' and not binary:
+        if tree.size <= BLOB_VIEW_MAX_SIZE and 'lines' not in request.GET:
+            fragment = render_blob(repository, tree)
+            blob, rendered = fragment['html'], fragment['rendered']
+        else:
+            total, _ = get_line_index(repository, tree)
+            start, stop = parse_line_range(request.GET.get('lines'), total, BLOB_WINDOW)
+            blob = read_lines(repository, tree, start, stop)
+            window = get_line_window(start, stop, total, BLOB_WINDOW)
+            if window and fileType == 'markdown':
+                fileType = ''
+            blob = force_text(blob, errors='replace')
+
     breadcrumbs = []
     for i, b in enumerate(split_path):
         commitishPath = '/'.join([branch] + split_path[:i + 1])
@@ -287,33 +282,63 @@ def blob(request, repo, commitishPath):
         'path': path,
         'fileType': fileType,
         'blob': blob,
+        'rendered': rendered,
+        'highlight_css': get_highlight_css() if rendered and fileType != 'markdown' else '',
+        'binary': binary,
+        'size': tree.size,
+        'window': window,
         'repo': repo,
         'branch': branch,
-        'branches': branches,
-        'tags': tags,
+        'ref_menu': ref_menu,
         'breadcrumbs': breadcrumbs,
     })
 
 
+@commit_condition
+@bulkhead('browse')
 def blob_raw(request, repo, commitishPath):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(commitishPath, repository)
     tree = repository.tree(branch)
 
     blob = tree[path]
-    f = blob.data_stream
-    response = CompatibleStreamingHttpResponse(
-        iter(lambda: f.read(STREAM_CHUNK_SIZE), b''),
-        content_type=blob.mime_type,
-    )
 
     _, ext = os.path.splitext(blob.name)
     if ext in DEFAULT_BINARY_TYPES:
-        response["Content-Disposition"] = 'attachment; filename="{file}"'.format(file=blob.name)
-        response["Content-Type"] = 'application/octet-stream'
+        content_type = 'application/octet-stream'
     else:
-        response["Content-Type"] = 'text/plain'
-    response["Content-Length"] = blob.size
+        content_type = 'text/plain'
+
+    # Ranges of small blobs are served from memory, those of big ones from
+    # the blob cache, where big blobs go once they are requested often or
+    # with a range. Until then, ranges are read from the blob stream.
+    etag = resolve_commit(request, repo, commitishPath)[2]
+    cacheable = BLOB_CACHE_MIN_SIZE <= blob.size <= BLOB_CACHE_SIZE
+    ranged = 'HTTP_RANGE' in request.META
+    cached = get_cached_blob(repository, blob.hexsha) if cacheable else None
+    response = None
+    if cached is not None:
+        try:
+            response = file_response(request, cached, content_type, etag=etag)
+        except IOError:
+            pass  # Pruned in between
+    if response is None:
+        if ranged and blob.size < BLOB_CACHE_MIN_SIZE:
+            response = range_response(request, BytesIO(blob.data_stream.read()), blob.size, content_type, etag)
+        elif ranged:
+            if cacheable:
+                fill_blob_cache(repository, blob)
+            response = range_response(request, BlobReader(iter_blob(repository, blob)), blob.size, content_type, etag, seekable=False)
+        else:
+            response = CompatibleStreamingHttpResponse(
+                iter_blob(repository, blob, cache=cacheable and is_hot(repository, blob)),
+                content_type=content_type,
+            )
+            response["Content-Length"] = blob.size
+            response["Accept-Ranges"] = 'bytes'
+
+    if ext in DEFAULT_BINARY_TYPES:
+        response["Content-Disposition"] = 'attachment; filename="{file}"'.format(file=blob.name)
     return response
 
 
@@ -323,25 +348,32 @@ def search(request, repo):
     return HttpResponseRedirect(url)
 
 
+@commit_condition
+@bulkhead('browse')
 def commits(request, repo, commitishPath=None):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(commitishPath, repository)
-    branches = repository.branches
-    tags = repository.tags
-
-    try:
-        page = int(request.GET.get('page', 0))
-    except ValueError:
-        page = 0
-
-    total_commits = sum(1 for _ in repository.iter_commits(branch, paths=path))
-    last = (total_commits + COMMITS_PER_PAGE - 1) / COMMITS_PER_PAGE - 1
-    pager = dict(previous=max(0, page - 1), current=page, next=min(page + 1, last), last=last)
+    ref_menu = get_ref_menu(repository, repo)
+
+    cursor, previous, page, redirect = get_page_cursor(request, repository, branch, path)
+    if redirect is not None:
+        return HttpResponseRedirect(redirect)
+
+    page_commits, next_cursor = get_commits_page(repository, branch, path, cursor, COMMITS_PER_PAGE)
+    token = request.GET.get('from')
+    total = count_commits(repository, branch, path)
+    pager = dict(
+        first=cursor is None,
+        previous=previous,
+        next=save_cursor(repository, next_cursor, token, page + 1) if next_cursor is not None else None,
+        current=page,
+        last=max(0, total - 1) // COMMITS_PER_PAGE,
+        total=total,
+    )
 
     categorized = {}
     commits = []
-    for commit in repository.iter_commits(branch, paths=path, max_count=COMMITS_PER_PAGE, skip=page * COMMITS_PER_PAGE):
-        commit = WrappedCommit(commit)
+    for commit in wrap_commits(repository, page_commits):
         date = commit.commiterDate
         grouped_date = datetime.datetime(year=date.year, month=date.month, day=date.day)
         try:
@@ -362,19 +394,18 @@ def commits(request, repo, commitishPath=None):
         'pager': pager,
         'repo': repo,
         'branch': branch,
-        'branches': branches,
-        'tags': tags,
+        'ref_menu': ref_menu,
         'commits': commits,
         'file': path,
         'breadcrumbs': [{'dir': 'Commit history', 'path': ''}],
     })
 
 
+@bulkhead('expensive')
 def searchcommits(request, repo, branch):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(branch, repository)
-    branches = repository.branches
-    tags = repository.tags
+    ref_menu = get_ref_menu(repository, repo)
 
     query = request.REQUEST.get('query', '')
     try:
@@ -382,27 +413,34 @@ def searchcommits(request, repo, branch):
     except ValueError:
         page = 0
 
-    total = 0
-    total_commits = 0
+    breadcrumbs = [{'dir': 'Commits search results for: {query}'.format(query=query), 'path': ''}]
+    sha = repository.commit(branch).hexsha
+    done, result = run_job(repository, repo, search_commits, branch, path, query, page * SEARCH_PER_PAGE, SEARCH_PER_PAGE, sha)
+    if not done:
+        return computing(request, {
+            'page': 'searchcommits',
+            'repo': repo,
+            'branch': branch,
+            'ref_menu': ref_menu,
+            'query': query,
+            'breadcrumbs': breadcrumbs,
+        }, "Searching commits...")
+    shas, total = result
+    last = max(0, (total + SEARCH_PER_PAGE - 1) // SEARCH_PER_PAGE - 1)
+    pager = dict(previous=max(0, page - 1), current=page, next=min(page + 1, last), last=last, total=total)
+
     categorized = {}
     commits = []
-    for commit in repository.iter_commits(branch, paths=path):
-        if query in commit.message:
-            if total >= page * SEARCH_PER_PAGE:
-                commit = WrappedCommit(commit)
-                date = commit.commiterDate
-                grouped_date = datetime.datetime(year=date.year, month=date.month, day=date.day)
-                try:
-                    dated_commits = categorized[grouped_date]
-                except KeyError:
-                    dated_commits = []
-                    categorized[grouped_date] = dated_commits
-                    commits.append((grouped_date, dated_commits))
-                dated_commits.append(commit)
-                total_commits += 1
-            if total_commits > SEARCH_PER_PAGE:
-                break
-            total += 1
+    for commit in wrap_commits(repository, get_commits(repository, shas)):
+        date = commit.commiterDate
+        grouped_date = datetime.datetime(year=date.year, month=date.month, day=date.day)
+        try:
+            dated_commits = categorized[grouped_date]
+        except KeyError:
+            dated_commits = []
+            categorized[grouped_date] = dated_commits
+            commits.append((grouped_date, dated_commits))
+        dated_commits.append(commit)
 
     file = None
     return render(request, 'searchcommits.html', {
@@ -412,19 +450,25 @@ def searchcommits(request, repo, branch):
         'file': file,
         'path': path,
         'commits': commits,
-        'branches': branches,
-        'tags': tags,
+        'ref_menu': ref_menu,
         'query': query,
-        'breadcrumbs': [{'dir': 'Commits search results for: {query}'.format(query=query), 'path': ''}],
+        'pager': pager,
+        'breadcrumbs': breadcrumbs,
     })
 
 
+@commit_condition
+@bulkhead('browse')
 def commit(request, repo, commitishPath=None):
     branch = 'master'
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(commitishPath, repository)
 
-    commit = WrappedCommit(repository.commit(branch), paths=path)
+    commit = WrappedCommit(repository, get_commit(repository, branch), paths=path)
+    if commit.parents:
+        diffs = load_commit_diffs(repository, commit.parents[0], commit.hexsha, path)
+    else:
+        diffs = []
 
     breadcrumbs = [{'dir': "{commit}".format(commit=commit.hash), 'path': reverse('commit', kwargs=dict(repo=repo, commitishPath=branch))}]
     if path:
@@ -435,60 +479,127 @@ def commit(request, repo, commitishPath=None):
         'branch': branch,
         'repo': repo,
         'commit': commit,
+        'diffs': diffs,
         'breadcrumbs': breadcrumbs,
     })
 
 
+@commit_condition
+@bulkhead('browse')
+def diff(request, repo, commitishPath):
+    repository = get_repository_from_name(repo)
+    branch, path = parse_commitish_path(commitishPath, repository)
+
+    commit = get_commit(repository, branch)
+    diff = None
+    if commit.parents and path:
+        diff = load_file_diff(repository, commit.parents[0], commit.hexsha, path, request.GET.get('from'))
+    if diff is None:
+        raise Http404("File %s was not changed by commit %s" % (path, commit.hexsha))
+
+    return render(request, 'diff.html', {
+        'repo': repo,
+        'diff': diff,
+    })
+
+
+@commit_condition
+@bulkhead('expensive')
 def blame(request, repo, commitishPath):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(commitishPath, repository)
-    branches = repository.branches
-    tags = repository.tags
+    ref_menu = get_ref_menu(repository, repo)
+
+    # Only the lines shown are read, through the line index
+    commit = repository.commit(branch)
+    blob = commit.tree[path]
+    total, _ = get_line_index(repository, blob)
+    start, stop = parse_line_range(request.GET.get('lines'), total, BLAME_WINDOW)
+    if start == 0 and stop == total:
+        commits, owners = get_blame(repository, commit.hexsha, path)
+    else:
+        commits, owners = get_blame(repository, commit.hexsha, path, start, stop)
+    lines = read_lines(repository, blob, start, stop).split(b'\n')
+
+    blocks = []
+    for i, owner in enumerate(owners):
+        sha = commits[owner]
+        if blocks and blocks[-1][0] == sha:
+            blocks[-1][1].append(lines[i])
+        else:
+            blocks.append((sha, [lines[i]]))
 
     blames = []
-    for blame in repository.blame(branch, path):
+    for sha, block in blocks:
+        block = b'\n'.join(block)
         try:
-            line = '\n'.join(blame[1])
-        except Exception:
-            line = "Binary content (%s)" % filesizeformat(sum(map(len, blame[1])))
+            line = block.decode('utf-8')
+        except UnicodeDecodeError:
+            line = "Binary content (%s)" % filesizeformat(len(block))
         blames.append(dict(
             line=line,
-            commit=blame[0].hexsha,
-            commitShort=blame[0].hexsha[:8],
+            commit=sha,
+            commitShort=sha[:8],
         ))
 
+    window = get_line_window(start, stop, total, BLAME_WINDOW)
+
     return render(request, 'blame.html', {
         'page': 'commits',
         'file': path,
         'repo': repo,
         'branch': branch,
-        'branches': branches,
-        'tags': tags,
+        'ref_menu': ref_menu,
         'blames': blames,
+        'window': window,
         'breadcrumbs': [{'dir': 'Blame', 'path': ''}],
     })
 
 
 # Tree
+@commit_condition
+@bulkhead('browse')
 def tree(request, repo, commitishPath=''):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(commitishPath, repository)
-    branches = repository.branches
-    tags = repository.tags
+    ref_menu = get_ref_menu(repository, repo)
 
-    readme = None
     tree = repository.tree(branch)
-    readme = get_readme(tree)
+    trees = [tree]
     if path:
         split_path = path.split('/')
         for part in split_path:
             tree = tree[part]
-            readme = get_readme(tree) or readme
+            trees.append(tree)
         parent = '/'.join(split_path[:-1])
     else:
         split_path = []
         parent = None
-    files = tree.trees + tree.blobs
+
+    # The closest README up the path is shown
+    readme = None
+    for t in reversed(trees):
+        blob = get_readme(t)
+        if blob is not None:
+            readme = dict(filename=blob.name, content=render_blob(repository, blob, markdown_file=True))
+            break
+    sha = repository.commit(branch).hexsha
+    names = [e.name for e in tree.trees + tree.blobs]
+    last_commits = get_last_commits(repository, sha, path, names, LAST_COMMITS_WALK)
+    if len(last_commits) < len(names):
+        # Entries untouched by the latest commits are looked up by a job,
+        # and shown as pending until it's done
+        try:
+            done, result = run_job(repository, repo, get_last_commits, sha, path, names)
+        except JobFailed:
+            done = False
+        if done:
+            last_commits = result
+    commits = dict((c.hexsha, WrappedCommit(repository, c)) for c in get_commits(repository, list(set(last_commits.values()))))
+    # Aggregates are memoized per tree sha, so after a push only the trees
+    # along the changed paths are read again
+    files = [WrappedObject(t, get_tree_stats(repository, t), commits.get(last_commits.get(t.name)), pending=t.name not in last_commits) for t in tree.trees]
+    files += [WrappedObject(b, last_commit=commits.get(last_commits.get(b.name)), pending=b.name not in last_commits) for b in tree.blobs]
 
     breadcrumbs = []
     for i, b in enumerate(split_path):
@@ -499,25 +610,27 @@ def tree(request, repo, commitishPath=''):
             'path': path_,
         })
 
-    return render(request, 'tree.html', {
+    response = render(request, 'tree.html', {
         'page': 'files',
         'files': files,
         'repo': repo,
         'branch': branch,
         'path': path,
         'parent': parent,
-        'branches': branches,
-        'tags': tags,
+        'ref_menu': ref_menu,
         'readme': readme,
         'breadcrumbs': breadcrumbs,
     })
+    if any(f.pending for f in files):
+        mark_provisional(response)
+    return response
 
 
+@bulkhead('expensive')
 def searchbranch(request, repo, branch):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(branch, repository)
-    branches = repository.branches
-    tags = repository.tags
+    ref_menu = get_ref_menu(repository, repo)
 
     query = request.REQUEST.get('query', '')
     try:
@@ -525,42 +638,43 @@ def searchbranch(request, repo, branch):
     except ValueError:
         page = 0
 
-    total = 0
-    total_results = 0
-    results = []
-    for blob in repository.tree().traverse():
-        if blob.type == 'blob':
-            content = blob.data_stream.read()
-            if query.encode('utf-8') in content:
-                content = b'\n'.join(b'%d - %s' % (i + 1, c) for i, c in enumerate(content.split(b'\n')))
-                if total >= page * SEARCH_PER_PAGE:
-                    regex = r'((?:.*\n){0,2})(\d+)(.*)(%s)(.*(?:\n.*){0,2})' % query
-                    for m in re.findall(regex.encode('utf-8'), content):
-                        results.append(dict(
-                            file=blob.path,
-                            line=int(m[1]),
-                            match=(m[0] + m[1] + m[2], m[3], m[4]),
-                        ))
-                total_results += 1
-            if total_results > SEARCH_PER_PAGE:
-                break
-            total += 1
+    tree = repository.tree(branch)
+    too_short = len(force_bytes(query)) < SEARCH_MIN_QUERY
+    if too_short:
+        done, result = True, ([], False, [])
+    else:
+        done, result = run_job(repository, repo, search_tree, tree.hexsha, query, page, SEARCH_PER_PAGE, path)
+    if not done:
+        return computing(request, {
+            'page': 'files',
+            'repo': repo,
+            'branch': branch,
+            'ref_menu': ref_menu,
+            'query': query,
+            'breadcrumbs': [{'dir': 'Searching for: {query}'.format(query=query), 'path': ''}],
+        }, "Searching files...")
+    results, more, skipped = result
+    pager = dict(previous=max(0, page - 1), current=page, next=page + 1 if more else None)
 
     path = None
     breadcrumbs = None
     return render(request, 'search.html', {
         'page': 'files',
         'results': results,
+        'skipped': skipped,
+        'too_short': too_short,
         'repo': repo,
         'branch': branch,
         'path': path,
-        'branches': branches,
-        'tags': tags,
+        'ref_menu': ref_menu,
         'query': query,
+        'pager': pager,
         'breadcrumbs': breadcrumbs,
     })
 
 
+@commit_condition
+@bulkhead('archive')
 def archive(request, repo, format, branch):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(branch, repository)
@@ -568,75 +682,95 @@ def archive(request, repo, format, branch):
     commit = repository.commit(branch)
     file = "%s-%s.%s" % (repo, commit.hexsha, format)
 
-    f = StringIO()
-    repository.archive(f, branch, format=format)
-    size = f.tell()
-    f.seek(0)
-    response = CompatibleStreamingHttpResponse(iter(lambda: f.read(STREAM_CHUNK_SIZE), b''),
-                                               content_type='application/%s' % format)
-
+    cached = get_cached_archive(repository, commit.hexsha, format)
+    if cached is None and JOBS:
+        done, _ = run_job(repository, repo, build_archive, commit.hexsha, format)
+        if not done:
+            return computing(request, {
+                'page': 'files',
+                'repo': repo,
+                'branch': branch,
+                'ref_menu': get_ref_menu(repository, repo),
+                'breadcrumbs': [{'dir': 'Archive', 'path': ''}],
+            }, "Building the archive...")
+        cached = get_cached_archive(repository, commit.hexsha, format)
+    if cached:
+        return file_response(request, cached, 'application/octet-stream', filename=file)
+
+    response = CompatibleStreamingHttpResponse(stream_archive(repository, commit.hexsha, format),
+                                               content_type='application/octet-stream')
     response["Content-Disposition"] = 'attachment; filename="{file}"'.format(file=file)
-    response["Content-Type"] = 'application/octet-stream'
-    response["Content-Length"] = size
     return response
 
 
 def branch(request, repo, branch):
-    return tree(request, repo, branch)
+    return tree(request, repo, commitishPath=branch)
 
 
 def repository(request, repo):
     return tree(request, repo)
 
 
+@bulkhead('browse')
+def refs(request, repo):
+    repository = get_repository_from_name(repo)
+    menu = render_ref_menu(repo, get_ref_snapshot(repository), request.GET.get('q', ''))
+    return HttpResponse(menu)
+
+
 # Network
+@commit_condition
+@bulkhead('browse')
 def network_data(request, repo, commitishPath, page):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(commitishPath, repository)
     page = int(page)
 
-    commits = []  # Get repository commits
-    for commit in repository.iter_commits(branch, paths=path, max_count=COMMITS_PER_PAGE, skip=page * COMMITS_PER_PAGE):
-        commit = WrappedCommit(commit)
-        commits.append(commit)
-
-    formatted_commits = {}
-    if commits:
-        for commit in commits:
-            formatted_commits[commit.hash] = {
-                'hash': commit.hash,
-                'parentsHash': [p.hexsha for p in commit.parents],
-                'date': commit.authored_date,
-                'message': commit.summary,
-                'details': reverse('commit', kwargs=dict(repo=repo, commitishPath=commit.hash)),
-                'author': {
-                    'name': commit.author.name,
-                    'email': commit.author.email,
-                    'image': 'http://gravatar.com/avatar/{md5}?s=40'.format(md5=md5(commit.author.email.lower()).hexdigest())
-                }
-            }
-
-        next_page_url = None
-        next_page_url = reverse('network_data', kwargs=dict(repo=repo, commitishPath=commitishPath, page=page + 1))
-
-        result = {
-            'repo': repo,
-            'commitishPath': commitishPath,
-            'nextPage': next_page_url,
-            'start': commits[0].hash,
-            'commits': formatted_commits,
-        }
-    else:
-        result = {
-            'repo': repo,
-            'commitishPath': commitishPath,
-            'nextPage': None,
-            'start': None,
-            'commits': formatted_commits,
-        }
-    return HttpResponse(json.dumps(result), content_type='application/json')
+    lanes = parse_lanes(request.GET.get('lanes'))
+    if lanes is None and page > 0:
+        # Old style page URLs: lay out the skipped commits once and redirect
+        _, lanes = get_network_chunk(repository, branch, path, size=page * COMMITS_PER_PAGE)
+        return HttpResponseRedirect('{path}?lanes={lanes}'.format(path=request.path, lanes=format_lanes(lanes or [])))
+
+    rows, next_lanes = get_network_chunk(repository, branch, path, lanes)
+
+    authors = []
+    author_indexes = {}
+    commits = []
+    for sha, lane, parents, parent_lanes, date, message, name, email in rows:
+        author = (name, email)
+        try:
+            author_index = author_indexes[author]
+        except KeyError:
+            author_index = author_indexes[author] = len(authors)
+            authors.append({
+                'name': name,
+                'email': email,
+                'image': 'http://gravatar.com/avatar/{md5}?s=40'.format(md5=md5(email.lower().encode('utf-8')).hexdigest())
+            })
+        details = reverse('commit', kwargs=dict(repo=repo, commitishPath=sha))
+        commits.append([sha, lane, parents, parent_lanes, date, message, details, author_index])
+
+    next_page_url = None
+    if next_lanes is not None:
+        next_page_url = '{url}?lanes={lanes}'.format(
+            url=reverse('network_data', kwargs=dict(repo=repo, commitishPath=commitishPath, page=page + 1)),
+            lanes=format_lanes(next_lanes),
+        )
+
+    result = {
+        'repo': repo,
+        'commitishPath': commitishPath,
+        'nextPage': next_page_url,
+        'start': commits[0][0] if commits else None,
+        'authors': authors,
+        'commits': commits,
+    }
+    return HttpResponse(json.dumps(result, separators=(',', ':')), content_type='application/json')
 
 
+@commit_condition
+@bulkhead('browse')
 def network(request, repo, commitishPath=None):
     repository = get_repository_from_name(repo)
     branch, path = parse_commitish_path(commitishPath, repository)